@@ -6,7 +6,7 @@ on those channels.
 Notes:
   - This code is based on experimental APIs and is subject to change.
   - Notification does not do deduplication of notification ids, that's up to
-    the receiver.
+    the receiver. NotificationReceiver does it for channels it receives on.
   - Storing the Channel between calls is up to the caller.
 
 
@@ -54,9 +54,34 @@ always be upper case.
 Example of unsubscribing.
 
   service.channels().stop(channel.body())
+
+
+Example of watching a calendar from a long running process, with a webhook
+receiver on a local port that https://example.com/my_web_hook forwards to.
+ChannelWatch opens the channel, renews it before it expires, and stops it
+when closed.
+
+  def changed(channel, notification):
+    if notification.state != 'sync':
+      cache.clear()
+
+  receiver = NotificationReceiver(changed, port=8090)
+  receiver.start()
+  watch = ChannelWatch(
+      functools.partial(service.events().watch, calendarId='primary'),
+      service.channels().stop, "https://example.com/my_web_hook",
+      receiver=receiver)
+  watch.start()
+  ...
+  watch.close()
+  receiver.stop()
 """
 
+import collections
 import datetime
+import logging
+import threading
+import time
 import uuid
 
 from apiclient import errors
@@ -84,6 +109,17 @@ X_GOOG_MESSAGE_NUMBER = 'X-GOOG-MESSAGE-NUMBER'
 X_GOOG_RESOURCE_STATE = 'X-GOOG-RESOURCE-STATE'
 X_GOOG_RESOURCE_URI   = 'X-GOOG-RESOURCE-URI'
 X_GOOG_RESOURCE_ID    = 'X-GOOG-RESOURCE-ID'
+X_GOOG_CHANNEL_TOKEN  = 'X-GOOG-CHANNEL-TOKEN'
+
+# Message numbers remembered per channel for deduplication. Notifications
+# are redelivered until acknowledged, so duplicates arrive close together.
+DEDUP_WINDOW = 1000
+
+# How long before a channel expires ChannelWatch replaces it.
+RENEW_MARGIN = datetime.timedelta(hours=1)
+
+# How long ChannelWatch waits before trying again when renewal fails.
+RENEW_RETRY_DELAY = datetime.timedelta(minutes=1)
 
 
 def _upper_header_keys(headers):
@@ -283,3 +319,254 @@ def new_webhook_channel(url, token=None, expiration=None, params=None):
                    token, url, expiration=expiration_ms,
                    params=params)
 
+
+
+def _to_seconds(delta):
+  return delta.days * 24 * 3600 + delta.seconds + delta.microseconds / 1e6
+
+
+class NotificationReceiver(object):
+  """Receives the notifications of webhook channels on a local HTTP server.
+
+  Each notification for a channel added with add_channel() is validated with
+  notification_from_headers() and its token, and passed to the callback
+  once, however many times it is delivered.
+
+  Attributes:
+    address: str, The URL the server is listening on, once started.
+  """
+
+  @util.positional(2)
+  def __init__(self, callback, host='', port=0):
+    """Constructor.
+
+    Args:
+      callback: callable, called as callback(channel, notification) for each
+        new notification, on the server's thread.
+      host: str, The address to listen on, all of them by default.
+      port: int, The port to listen on, a free one by default.
+    """
+    self._callback = callback
+    self._host = host
+    self._port = port
+    self._lock = threading.Lock()
+    self._channels = {}
+    self._seen = {}
+    self._server = None
+    self.address = None
+
+  def add_channel(self, channel):
+    """Starts accepting notifications for channel."""
+    with self._lock:
+      self._channels[channel.id] = channel
+      self._seen.setdefault(channel.id, collections.OrderedDict())
+
+  def remove_channel(self, channel):
+    """Stops accepting notifications for channel."""
+    with self._lock:
+      self._channels.pop(channel.id, None)
+      self._seen.pop(channel.id, None)
+
+  def handle(self, headers):
+    """Handles the headers of one webhook request.
+
+    Args:
+      headers: dict, A dictionary like object that contains the request
+        headers from the webhook HTTP request.
+
+    Returns:
+      The HTTP status to answer with: 200 once the notification has been
+      handled or if it is a duplicate, 404 for an unknown channel, and 400
+      for an invalid notification.
+    """
+    upper = _upper_header_keys(headers)
+    with self._lock:
+      channel = self._channels.get(upper.get(X_GOOG_CHANNEL_ID))
+    if channel is None:
+      return 404
+    if channel.token and upper.get(X_GOOG_CHANNEL_TOKEN) != channel.token:
+      return 400
+    try:
+      notification = notification_from_headers(channel, upper)
+    except (KeyError, ValueError, errors.InvalidNotificationError):
+      return 400
+
+    with self._lock:
+      seen = self._seen.get(channel.id)
+      if seen is None or notification.message_number in seen:
+        return 200
+      seen[notification.message_number] = True
+      if len(seen) > DEDUP_WINDOW:
+        seen.popitem(last=False)
+    self._callback(channel, notification)
+    return 200
+
+  def start(self):
+    """Starts the server on a background thread."""
+    import BaseHTTPServer
+
+    receiver = self
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+      def do_POST(self):
+        length = int(self.headers.get('content-length') or 0)
+        if length:
+          self.rfile.read(length)
+        try:
+          status = receiver.handle(dict(self.headers.items()))
+        except Exception:
+          logging.exception('Notification callback failed')
+          status = 500
+        self.send_response(status)
+        self.send_header('content-length', '0')
+        self.end_headers()
+
+      def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+    self._server = BaseHTTPServer.HTTPServer((self._host, self._port), Handler)
+    host, port = self._server.server_address[:2]
+    self.address = 'http://%s:%d/' % (host, port)
+    thread = threading.Thread(target=self._server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+  def stop(self):
+    """Stops the server."""
+    if self._server is not None:
+      self._server.shutdown()
+      self._server.server_close()
+      self._server = None
+
+
+class ChannelWatch(object):
+  """Keeps a webhook channel open on a resource.
+
+  The channel is replaced by a new one RENEW_MARGIN before it expires, and
+  the old one stopped, so that there is no gap in notifications. Channels
+  are added to and removed from a NotificationReceiver as they are opened
+  and stopped.
+
+  Channels are renewed from a timer thread. If the watch and stop requests
+  share their http with other threads, as requests of the same service do,
+  pass a lock that those threads hold while they use it.
+  """
+
+  @util.positional(4)
+  def __init__(self, watch, stop, address, receiver=None, token=None,
+               ttl=None, renew_margin=RENEW_MARGIN, http_lock=None):
+    """Constructor.
+
+    Args:
+      watch: callable, takes the channel as body= and returns the
+        HttpRequest of the resource's watch method, eg
+        functools.partial(service.events().watch, calendarId='primary').
+      stop: callable, takes a channel as body= and returns the HttpRequest
+        that stops it, eg service.channels().stop.
+      address: str, URL to post notifications to.
+      receiver: NotificationReceiver, receives the notifications, or None.
+      token: str, Token delivered with each notification, or None for a
+        random one.
+      ttl: datetime.timedelta, How long to ask channels to last for, or None
+        for the service's default.
+      renew_margin: datetime.timedelta, How long before a channel expires to
+        replace it.
+      http_lock: threading.Lock, Held while the watch and stop requests are
+        sent, or None.
+    """
+    self._watch = watch
+    self._stop = stop
+    self._address = address
+    self._receiver = receiver
+    self._token = token or str(uuid.uuid4())
+    self._ttl = ttl
+    self._renew_margin = renew_margin
+    self._http_lock = http_lock
+    self._lock = threading.Lock()
+    self._timer = None
+    self._closed = False
+    self.channel = None
+
+  @property
+  def active(self):
+    """Whether a channel is open and has not expired."""
+    channel = self.channel
+    return (channel is not None and
+            (not channel.expiration or
+             int(channel.expiration) > time.time() * 1000))
+
+  def start(self):
+    """Opens the first channel.
+
+    Raises:
+      apiclient.errors.HttpError if the watch request fails.
+    """
+    self.renew()
+
+  def renew(self):
+    """Opens a new channel, and then stops the one it replaces."""
+    with self._lock:
+      if self._closed:
+        return
+      expiration = None
+      if self._ttl is not None:
+        expiration = datetime.datetime.utcnow() + self._ttl
+      channel = new_webhook_channel(self._address, token=self._token,
+                                    expiration=expiration)
+      # Notifications may arrive before the watch request returns.
+      if self._receiver is not None:
+        self._receiver.add_channel(channel)
+      try:
+        channel.update(self._execute(self._watch(body=channel.body())))
+      except Exception:
+        if self._receiver is not None:
+          self._receiver.remove_channel(channel)
+        raise
+      old, self.channel = self.channel, channel
+      self._schedule()
+    if old is not None:
+      self._close_channel(old)
+
+  def close(self):
+    """Stops renewing, and stops the current channel."""
+    with self._lock:
+      self._closed = True
+      if self._timer is not None:
+        self._timer.cancel()
+      channel, self.channel = self.channel, None
+    if channel is not None:
+      self._close_channel(channel)
+
+  def _close_channel(self, channel):
+    try:
+      self._execute(self._stop(body=channel.body()))
+    except Exception, e:
+      logging.warning('Failed to stop channel %s: %s', channel.id, e)
+    if self._receiver is not None:
+      self._receiver.remove_channel(channel)
+
+  def _execute(self, request):
+    if self._http_lock is None:
+      return request.execute()
+    with self._http_lock:
+      return request.execute()
+
+  def _schedule(self, delay=None):
+    if delay is None:
+      if not self.channel.expiration:
+        return
+      expires = int(self.channel.expiration) / 1000.0
+      delay = expires - _to_seconds(self._renew_margin) - time.time()
+    self._timer = threading.Timer(max(0, delay), self._renew_in_background)
+    self._timer.daemon = True
+    self._timer.start()
+
+  def _renew_in_background(self):
+    try:
+      self.renew()
+    except Exception, e:
+      logging.warning('Failed to renew channel: %s', e)
+      with self._lock:
+        if not self._closed:
+          self._schedule(_to_seconds(RENEW_RETRY_DELAY))
@@ -28,13 +28,12 @@ __all__ = [
 
 # Standard library imports
 import copy
-from email.mime.multipart import MIMEMultipart
-from email.mime.nonmultipart import MIMENonMultipart
 import keyword
 import logging
-import mimetypes
 import os
+import random
 import re
+import sys
 import urllib
 import urlparse
 
@@ -55,9 +54,11 @@ from apiclient.errors import MediaUploadSizeError
 from apiclient.errors import UnacceptableMimeTypeError
 from apiclient.errors import UnknownApiNameOrVersion
 from apiclient.errors import UnknownFileType
+from apiclient.http import BatchHttpRequest
 from apiclient.http import HttpRequest
 from apiclient.http import MediaFileUpload
 from apiclient.http import MediaUpload
+from apiclient.http import MediaUploadBody
 from apiclient.model import JsonModel
 from apiclient.model import MediaModel
 from apiclient.model import RawModel
@@ -170,14 +171,33 @@ def build(serviceName,
   Returns:
     A Resource object with methods for interacting with the service.
   """
+  if http is None:
+    http = httplib2.Http()
+
+  service = _retrieve_discovery_doc(serviceName, version, http,
+                                    discoveryServiceUrl)
+  return build_from_document(service, base=discoveryServiceUrl, http=http,
+      developerKey=developerKey, model=model, requestBuilder=requestBuilder)
+
+
+def _retrieve_discovery_doc(serviceName, version, http, discoveryServiceUrl):
+  """Retrieves the discovery document for a service.
+
+  Args:
+    serviceName: string, name of the service.
+    version: string, the version of the service.
+    http: httplib2.Http, the transport to fetch the document with.
+    discoveryServiceUrl: string, a URI Template that points to the location of
+      the discovery service.
+
+  Returns:
+    The deserialized discovery document.
+  """
   params = {
       'api': serviceName,
       'apiVersion': version
       }
 
-  if http is None:
-    http = httplib2.Http()
-
   requested_url = uritemplate.expand(discoveryServiceUrl, params)
 
   # REMOTE_ADDR is defined by the CGI spec [RFC3875] as the environment
@@ -198,14 +218,11 @@ def build(serviceName,
     raise HttpError(resp, content, uri=requested_url)
 
   try:
-    service = simplejson.loads(content)
+    return simplejson.loads(content)
   except ValueError, e:
     logger.error('Failed to parse as JSON: ' + content)
     raise InvalidJsonError()
 
-  return build_from_document(content, base=discoveryServiceUrl, http=http,
-      developerKey=developerKey, model=model, requestBuilder=requestBuilder)
-
 
 @positional(1)
 def build_from_document(
@@ -565,6 +582,9 @@ def createMethod(methodName, methodDesc, rootDesc, schema):
 
   parameters = ResourceMethodParameters(methodDesc)
 
+  # Field masks already checked against the response schema.
+  checked_fields = set()
+
   def method(self, **kwargs):
     # Don't bother with doc string, it will be over-written by createMethod.
 
@@ -610,6 +630,22 @@ def createMethod(methodName, methodDesc, rootDesc, schema):
                 'Parameter "%s" value "%s" is not an allowed value in "%s"' %
                 (name, value, str(enums)))
 
+    # Catch typos in partial response field masks here, rather than have
+    # the server answer with a 400 or leave the fields out.
+    fields = kwargs.get('fields')
+    if (fields is not None and 'response' in methodDesc and
+        fields not in checked_fields):
+      try:
+        unknown = schema.unknownFields(methodDesc['response'], fields)
+      except ValueError, e:
+        raise TypeError('Parameter "fields" value "%s" is malformed: %s' %
+                        (fields, e))
+      if unknown:
+        raise TypeError(
+            'Parameter "fields" value "%s" names fields not in the "%s" '
+            'response: %s' % (fields, methodId, ', '.join(unknown)))
+      checked_fields.add(fields)
+
     actual_query_params = {}
     actual_path_params = {}
     for key, value in kwargs.iteritems():
@@ -648,6 +684,7 @@ def createMethod(methodName, methodDesc, rootDesc, schema):
     if media_filename:
       # Ensure we end up with a valid MediaUpload object.
       if isinstance(media_filename, basestring):
+        import mimetypes
         (media_mime_type, encoding) = mimetypes.guess_type(media_filename)
         if media_mime_type is None:
           raise UnknownFileType(media_filename)
@@ -679,29 +716,24 @@ def createMethod(methodName, methodDesc, rootDesc, schema):
         if body is None:
           # This is a simple media upload
           headers['content-type'] = media_upload.mimetype()
-          body = media_upload.getbytes(0, media_upload.size())
+          body = MediaUploadBody([media_upload])
           url = _add_query_parameter(url, 'uploadType', 'media')
         else:
-          # This is a multipart/related upload.
-          msgRoot = MIMEMultipart('related')
-          # msgRoot should not write out it's own headers
-          setattr(msgRoot, '_write_headers', lambda self: None)
-
-          # attach the body as one part
-          msg = MIMENonMultipart(*headers['content-type'].split('/'))
-          msg.set_payload(body)
-          msgRoot.attach(msg)
-
-          # attach the media as the second part
-          msg = MIMENonMultipart(*media_upload.mimetype().split('/'))
-          msg['Content-Transfer-Encoding'] = 'binary'
-
-          payload = media_upload.getbytes(0, media_upload.size())
-          msg.set_payload(payload)
-          msgRoot.attach(msg)
-          body = msgRoot.as_string()
-
-          multipart_boundary = msgRoot.get_boundary()
+          # This is a multipart/related upload. The parts are laid out the way
+          # the email package would write them, but the media is streamed from
+          # media_upload instead of being copied into the message.
+          multipart_boundary = '===============%d==' % random.randrange(
+              sys.maxint)
+          body = MediaUploadBody([
+              '--%s\nContent-Type: %s\nMIME-Version: 1.0\n\n' % (
+                  multipart_boundary, headers['content-type']),
+              body,
+              ('\n--%s\nContent-Type: %s\nMIME-Version: 1.0\n'
+               'Content-Transfer-Encoding: binary\n\n') % (
+                  multipart_boundary, media_upload.mimetype()),
+              media_upload,
+              '\n--%s--\n' % multipart_boundary,
+              ])
           headers['content-type'] = ('multipart/related; '
                                      'boundary="%s"') % multipart_boundary
           url = _add_query_parameter(url, 'uploadType', 'multipart')
@@ -894,6 +926,27 @@ class Resource(object):
     self._add_next_methods(self._resourceDesc, self._schema)
 
   def _add_basic_methods(self, resourceDesc, rootDesc, schema):
+    # If this is the root Resource, add a new_batch_http_request() method.
+    if resourceDesc == rootDesc:
+      batch_uri = '%s%s' % (
+          rootDesc['rootUrl'], rootDesc.get('batchPath', 'batch'))
+      def new_batch_http_request(callback=None):
+        """Create a BatchHttpRequest object based on the discovery document.
+
+        Args:
+          callback: callable, A callback to be called for each response, of the
+            form callback(id, response, exception). The first parameter is the
+            request id, and the second is the deserialized response object. The
+            third is an apiclient.errors.HttpError exception object if an HTTP
+            error occurred while processing the request, or None if no error
+            occurred.
+
+        Returns:
+          A BatchHttpRequest object based on the discovery document.
+        """
+        return BatchHttpRequest(callback=callback, batch_uri=batch_uri)
+      self._set_dynamic_attr('new_batch_http_request', new_batch_http_request)
+
     # Add basic methods to Resource
     if 'methods' in resourceDesc:
       for methodName, methodDesc in resourceDesc['methods'].iteritems():
@@ -912,6 +965,12 @@ class Resource(object):
   def _add_nested_resources(self, resourceDesc, rootDesc, schema):
     # Add in nested resources
     if 'resources' in resourceDesc:
+      # Building a Resource creates all of its methods, about 1 ms for
+      # calendar's events(), so each nested Resource is built on first use
+      # and reused after that: service.events() is service.events(). It
+      # keeps the http, model and requestBuilder its parent had then. They
+      # are dropped with the other dynamic attributes on pickling.
+      self._set_dynamic_attr('_nested_resources', {})
 
       def createResourceMethod(methodName, methodDesc):
         """Create a method on the Resource to access a nested Resource.
@@ -924,11 +983,16 @@ class Resource(object):
         methodName = fix_method_name(methodName)
 
         def methodResource(self):
-          return Resource(http=self._http, baseUrl=self._baseUrl,
-                          model=self._model, developerKey=self._developerKey,
-                          requestBuilder=self._requestBuilder,
-                          resourceDesc=methodDesc, rootDesc=rootDesc,
-                          schema=schema)
+          resource = self._nested_resources.get(methodName)
+          if resource is None:
+            resource = Resource(http=self._http, baseUrl=self._baseUrl,
+                                model=self._model,
+                                developerKey=self._developerKey,
+                                requestBuilder=self._requestBuilder,
+                                resourceDesc=methodDesc, rootDesc=rootDesc,
+                                schema=schema)
+            self._nested_resources[methodName] = resource
+          return resource
 
         setattr(methodResource, '__doc__', 'A collection resource.')
         setattr(methodResource, '__is_resource__', True)
@@ -23,53 +23,76 @@ __author__ = 'jcgregorio@google.com (Joe Gregorio)'
 
 import StringIO
 import base64
+import collections
 import copy
-import gzip
+import cPickle
+import functools
 import httplib2
 import logging
 import mimeparse
-import mimetypes
+import mmap
 import os
 import random
 import sys
+import threading
 import time
 import urllib
 import urlparse
-import uuid
 
-from email.generator import Generator
-from email.mime.multipart import MIMEMultipart
-from email.mime.nonmultipart import MIMENonMultipart
-from email.parser import FeedParser
 from errors import BatchError
 from errors import HttpError
 from errors import InvalidChunkSizeError
 from errors import ResumableUploadError
 from errors import UnexpectedBodyError
 from errors import UnexpectedMethodError
+from model import ItemStream
 from model import JsonModel
 from oauth2client import util
 from oauth2client.anyjson import simplejson
 
+# The email, mimetypes and uuid modules are only needed for batches and file
+# uploads, and are imported where they are used to keep startup fast.
+
 
 DEFAULT_CHUNK_SIZE = 512*1024
 
+# Resumable upload chunks, other than the last one, must be a multiple of this.
+UPLOAD_CHUNK_MULTIPLE = 256*1024
+
+# How long an adaptively sized chunk should take to transfer, in seconds.
+ADAPTIVE_CHUNK_TARGET_SECONDS = 2.0
+
+# The largest chunk an adaptive chunk size will grow to.
+ADAPTIVE_CHUNK_MAX_SIZE = 64*1024*1024
+
 MAX_URI_LENGTH = 2048
 
+# Statuses worth retrying besides 5xx; 429 is Too Many Requests.
+RETRY_STATUSES = frozenset([429])
+
+# Error reasons that make a 403 worth retrying.
+RETRY_REASONS = frozenset(['rateLimitExceeded', 'userRateLimitExceeded'])
+
 
 class MediaUploadProgress(object):
   """Status of a resumable upload."""
 
-  def __init__(self, resumable_progress, total_size):
+  def __init__(self, resumable_progress, total_size, chunksize=None,
+               throughput=None):
     """Constructor.
 
     Args:
       resumable_progress: int, bytes sent so far.
       total_size: int, total bytes in complete upload, or None if the total
         upload size isn't known ahead of time.
+      chunksize: int, size of the next chunk to be sent, or None if unknown.
+      throughput: float, measured upload rate in bytes per second, or None if
+        it isn't being measured.
     """
     self.resumable_progress = resumable_progress
     self.total_size = total_size
+    self.chunksize = chunksize
+    self.throughput = throughput
 
   def progress(self):
     """Percent of upload completed, as a float.
@@ -87,15 +110,22 @@ class MediaUploadProgress(object):
 class MediaDownloadProgress(object):
   """Status of a resumable download."""
 
-  def __init__(self, resumable_progress, total_size):
+  def __init__(self, resumable_progress, total_size, chunksize=None,
+               throughput=None):
     """Constructor.
 
     Args:
       resumable_progress: int, bytes received so far.
       total_size: int, total bytes in complete download.
+      chunksize: int, size of the next chunk to be requested, or None if
+        unknown.
+      throughput: float, measured download rate in bytes per second, or None
+        if it isn't being measured.
     """
     self.resumable_progress = resumable_progress
     self.total_size = total_size
+    self.chunksize = chunksize
+    self.throughput = throughput
 
   def progress(self):
     """Percent of download completed, as a float.
@@ -110,6 +140,78 @@ class MediaDownloadProgress(object):
       return 0.0
 
 
+class AdaptiveChunkSize(object):
+  """Chooses chunk sizes for resumable transfers from measured throughput.
+
+  Pass an instance as the chunksize of a MediaIoBaseUpload, MediaFileUpload or
+  MediaIoBaseDownload. After each chunk the transfer rate is folded into a
+  running estimate and the next chunk is sized to take about target_seconds.
+  Each step grows or shrinks the size by at most a factor of two, and a failed
+  chunk halves it, so a retry on a bad link wastes less.
+
+    media = MediaFileUpload('cow.png', mimetype='image/png',
+      chunksize=AdaptiveChunkSize(), resumable=True)
+
+  Attributes:
+    throughput: float, estimated bytes per second, or None until a chunk has
+      been transferred.
+    last_seconds: float, how long the last chunk took, or None.
+  """
+
+  def __init__(self, initial=DEFAULT_CHUNK_SIZE, multiple=UPLOAD_CHUNK_MULTIPLE,
+               minimum=None, maximum=ADAPTIVE_CHUNK_MAX_SIZE,
+               target_seconds=ADAPTIVE_CHUNK_TARGET_SECONDS):
+    """Constructor.
+
+    Args:
+      initial: int, size of the first chunk.
+      multiple: int, chunk sizes are kept to multiples of this. The default is
+        what the server requires of resumable upload chunks.
+      minimum: int, smallest chunk size. Defaults to multiple.
+      maximum: int, largest chunk size.
+      target_seconds: float, how long each chunk should take to transfer.
+    """
+    if minimum is None:
+      minimum = multiple
+    self.multiple = multiple
+    self.minimum = minimum
+    self.maximum = maximum
+    self.target_seconds = target_seconds
+    self.throughput = None
+    self.last_seconds = None
+    self._size = self._clamp(initial)
+
+  def _clamp(self, size):
+    size = max(self.minimum, min(int(size), self.maximum))
+    return max(self.multiple, size - size % self.multiple)
+
+  def size(self):
+    """Size in bytes of the next chunk."""
+    return self._size
+
+  def record(self, nbytes, seconds):
+    """Record a completed chunk and pick the size of the next one.
+
+    Args:
+      nbytes: int, bytes transferred in the chunk.
+      seconds: float, how long the chunk took, including the round trip.
+    """
+    self.last_seconds = seconds
+    if nbytes <= 0:
+      return
+    rate = nbytes / max(seconds, 0.001)
+    if self.throughput is None:
+      self.throughput = rate
+    else:
+      self.throughput = (self.throughput + rate) / 2.0
+    wanted = self.throughput * self.target_seconds
+    self._size = self._clamp(max(self._size / 2, min(wanted, self._size * 2)))
+
+  def record_failure(self):
+    """Record a chunk that failed, shrinking the size of the next one."""
+    self._size = self._clamp(self._size / 2)
+
+
 class MediaUpload(object):
   """Describes a media object to upload.
 
@@ -145,6 +247,15 @@ class MediaUpload(object):
     """
     raise NotImplementedError()
 
+  def chunk_sizer(self):
+    """Adaptive chunk sizing for resumable uploads.
+
+    Returns:
+      The AdaptiveChunkSize choosing the chunk sizes, or None if the chunk size
+      is fixed.
+    """
+    return None
+
   def mimetype(self):
     """Mime type of the body.
 
@@ -289,15 +400,20 @@ class MediaIoBaseUpload(MediaUpload):
       mimetype: string, Mime-type of the file.
       chunksize: int, File will be uploaded in chunks of this many bytes. Only
         used if resumable=True. Pass in a value of -1 if the file is to be
-        uploaded as a single chunk. Note that Google App Engine has a 5MB limit
-        on request size, so you should never set your chunksize larger than 5MB,
-        or to -1.
+        uploaded as a single chunk, or an AdaptiveChunkSize to size the chunks
+        from the measured upload rate. Note that Google App Engine has a 5MB
+        limit on request size, so you should never set your chunksize larger
+        than 5MB, or to -1.
       resumable: bool, True if this is a resumable upload. False means upload
         in a single request.
     """
     super(MediaIoBaseUpload, self).__init__()
     self._fd = fd
     self._mimetype = mimetype
+    self._chunk_sizer = None
+    if isinstance(chunksize, AdaptiveChunkSize):
+      self._chunk_sizer = chunksize
+      chunksize = chunksize.size()
     if not (chunksize == -1 or chunksize > 0):
       raise InvalidChunkSizeError()
     self._chunksize = chunksize
@@ -312,8 +428,19 @@ class MediaIoBaseUpload(MediaUpload):
     Returns:
       Chunk size in bytes.
     """
+    if self._chunk_sizer is not None:
+      return self._chunk_sizer.size()
     return self._chunksize
 
+  def chunk_sizer(self):
+    """Adaptive chunk sizing for resumable uploads.
+
+    Returns:
+      The AdaptiveChunkSize choosing the chunk sizes, or None if the chunk size
+      is fixed.
+    """
+    return self._chunk_sizer
+
   def mimetype(self):
     """Mime type of the body.
 
@@ -412,15 +539,17 @@ class MediaFileUpload(MediaIoBaseUpload):
         guessed from the file extension.
       chunksize: int, File will be uploaded in chunks of this many bytes. Only
         used if resumable=True. Pass in a value of -1 if the file is to be
-        uploaded in a single chunk. Note that Google App Engine has a 5MB limit
-        on request size, so you should never set your chunksize larger than 5MB,
-        or to -1.
+        uploaded in a single chunk, or an AdaptiveChunkSize to size the chunks
+        from the measured upload rate. Note that Google App Engine has a 5MB
+        limit on request size, so you should never set your chunksize larger
+        than 5MB, or to -1.
       resumable: bool, True if this is a resumable upload. False means upload
         in a single request.
     """
     self._filename = filename
     fd = open(self._filename, 'rb')
     if mimetype is None:
+      import mimetypes
       (mimetype, encoding) = mimetypes.guess_type(filename)
     super(MediaFileUpload, self).__init__(fd, mimetype, chunksize=chunksize,
                                           resumable=resumable)
@@ -430,9 +559,10 @@ class MediaFileUpload(MediaIoBaseUpload):
 
     Returns:
        string, a JSON representation of this instance, suitable to pass to
-       from_json().
+       from_json(). An adaptive chunk size is recorded as its current size.
     """
-    return self._to_json(strip=['_fd'])
+    self._chunksize = self.chunksize()
+    return self._to_json(strip=['_fd', '_chunk_sizer'])
 
   @staticmethod
   def from_json(s):
@@ -470,6 +600,359 @@ class MediaInMemoryUpload(MediaIoBaseUpload):
                                               resumable=resumable)
 
 
+class _MediaViewUpload(MediaUpload):
+  """Base class for uploads whose chunks are views onto bytes in memory.
+
+  getbytes() returns a buffer or memoryview of the requested range instead of
+  a new string, and httplib hands that straight to the socket, so no per-chunk
+  copy of the media is made.
+  """
+
+  def __init__(self, size, mimetype, chunksize, resumable):
+    """Constructor.
+
+    Args:
+      size: int, size of the media in bytes.
+      mimetype: string, Mime-type of the media.
+      chunksize: int or AdaptiveChunkSize, see MediaIoBaseUpload.
+      resumable: bool, True if this is a resumable upload. False means upload
+        in a single request.
+    """
+    super(_MediaViewUpload, self).__init__()
+    self._size = size
+    self._mimetype = mimetype
+    self._chunk_sizer = None
+    if isinstance(chunksize, AdaptiveChunkSize):
+      self._chunk_sizer = chunksize
+      chunksize = chunksize.size()
+    if not (chunksize == -1 or chunksize > 0):
+      raise InvalidChunkSizeError()
+    self._chunksize = chunksize
+    self._resumable = resumable
+
+  def chunksize(self):
+    """Chunk size for resumable uploads.
+
+    Returns:
+      Chunk size in bytes.
+    """
+    if self._chunk_sizer is not None:
+      return self._chunk_sizer.size()
+    if self._chunksize == -1:
+      return self._size
+    return self._chunksize
+
+  def chunk_sizer(self):
+    """Adaptive chunk sizing for resumable uploads.
+
+    Returns:
+      The AdaptiveChunkSize choosing the chunk sizes, or None if the chunk size
+      is fixed.
+    """
+    return self._chunk_sizer
+
+  def mimetype(self):
+    """Mime type of the body.
+
+    Returns:
+      Mime type.
+    """
+    return self._mimetype
+
+  def size(self):
+    """Size of upload.
+
+    Returns:
+      Size of the body, or None of the size is unknown.
+    """
+    return self._size
+
+  def resumable(self):
+    """Whether this upload is resumable.
+
+    Returns:
+      True if resumable upload or False.
+    """
+    return self._resumable
+
+  def to_json(self):
+    """This upload type is not serializable."""
+    raise NotImplementedError('%s is not serializable.' % type(self).__name__)
+
+
+class MediaMemoryviewUpload(_MediaViewUpload):
+  """MediaUpload for bytes already in memory, without copying them.
+
+  Unlike MediaInMemoryUpload the body is not wrapped in a stream. Each chunk
+  is a memoryview slice of the body, so uploading it allocates no buffers.
+
+    media = MediaMemoryviewUpload(data, mimetype='image/png',
+      chunksize=1024*1024, resumable=True)
+    farm.animals().insert(
+        id='cow',
+        name='cow.png',
+        media_body=media).execute()
+  """
+
+  @util.positional(2)
+  def __init__(self, body, mimetype='application/octet-stream',
+               chunksize=DEFAULT_CHUNK_SIZE, resumable=False):
+    """Constructor.
+
+    Args:
+      body: string, bytearray or memoryview, Bytes of body content.
+      mimetype: string, Mime-type of the body or default of
+        'application/octet-stream'.
+      chunksize: int, Body will be uploaded in chunks of this many bytes, or
+        an AdaptiveChunkSize to size the chunks from the measured upload rate.
+        Only used if resumable=True. Pass in a value of -1 if the body is to
+        be uploaded in a single chunk.
+      resumable: bool, True if this is a resumable upload. False means upload
+        in a single request.
+    """
+    self._body = memoryview(body)
+    super(MediaMemoryviewUpload, self).__init__(
+        len(self._body), mimetype, chunksize, resumable)
+
+  def getbytes(self, begin, length):
+    """Get bytes from the media.
+
+    Args:
+      begin: int, offset from beginning of the body.
+      length: int, number of bytes to read, starting at begin.
+
+    Returns:
+      A memoryview of the bytes. May be shorter than length if the end of the
+      body was reached first.
+    """
+    return self._body[begin:begin + length]
+
+
+class MediaMmapUpload(_MediaViewUpload):
+  """MediaUpload for a file, memory-mapped instead of read.
+
+  The file is mapped read-only and each chunk is a buffer onto the mapping,
+  so the operating system pages the file in as it is sent and no chunk is
+  ever copied into a string. Use this in place of MediaFileUpload for large
+  files.
+
+    media = MediaMmapUpload('cow.png', mimetype='image/png',
+      chunksize=1024*1024, resumable=True)
+    farm.animals().insert(
+        id='cow',
+        name='cow.png',
+        media_body=media).execute()
+  """
+
+  @util.positional(2)
+  def __init__(self, filename, mimetype=None, chunksize=DEFAULT_CHUNK_SIZE,
+               resumable=False):
+    """Constructor.
+
+    Args:
+      filename: string, Name of the file.
+      mimetype: string, Mime-type of the file. If None then a mime-type will be
+        guessed from the file extension.
+      chunksize: int, File will be uploaded in chunks of this many bytes, or
+        an AdaptiveChunkSize to size the chunks from the measured upload rate.
+        Only used if resumable=True. Pass in a value of -1 if the file is to
+        be uploaded in a single chunk.
+      resumable: bool, True if this is a resumable upload. False means upload
+        in a single request.
+    """
+    self._filename = filename
+    if mimetype is None:
+      import mimetypes
+      (mimetype, encoding) = mimetypes.guess_type(filename)
+    fd = open(filename, 'rb')
+    try:
+      size = os.fstat(fd.fileno()).st_size
+      # An empty file can't be mapped.
+      self._mmap = None
+      if size > 0:
+        self._mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+      fd.close()
+    super(MediaMmapUpload, self).__init__(size, mimetype, chunksize, resumable)
+
+  def getbytes(self, begin, length):
+    """Get bytes from the media.
+
+    Args:
+      begin: int, offset from beginning of file.
+      length: int, number of bytes to read, starting at begin.
+
+    Returns:
+      A buffer onto the mapped bytes. May be shorter than length if EOF was
+      reached first.
+    """
+    if self._mmap is None:
+      return ''
+    return buffer(self._mmap, begin, length)
+
+  def to_json(self):
+    """Creating a JSON representation of an instance of MediaMmapUpload.
+
+    Returns:
+       string, a JSON representation of this instance, suitable to pass to
+       from_json(). An adaptive chunk size is recorded as its current size.
+    """
+    self._chunksize = self.chunksize()
+    return self._to_json(strip=['_mmap', '_chunk_sizer'])
+
+  @staticmethod
+  def from_json(s):
+    d = simplejson.loads(s)
+    return MediaMmapUpload(d['_filename'], mimetype=d['_mimetype'],
+                           chunksize=d['_chunksize'], resumable=d['_resumable'])
+
+
+class MediaStreamUpload(MediaUpload):
+  """A resumable MediaUpload read forward from a stream of unknown length.
+
+  MediaIoBaseUpload has to seek to find the size of its stream. This class
+  only ever reads forward, so the source can be a pipe, a socket's makefile(),
+  or a generator of strings. At most one chunk, plus one byte of look-ahead,
+  is held in memory. Chunks are sent with a '*' total length until the end of
+  the stream is reached, at which point the total is known and sent with the
+  final chunk.
+
+    media = MediaStreamUpload(sys.stdin, mimetype='text/plain')
+    farm.animals().insert(
+        id='cow',
+        name='cow.txt',
+        media_body=media).execute()
+
+  Uploads from a stream are always resumable.
+  """
+
+  @util.positional(3)
+  def __init__(self, source, mimetype, chunksize=DEFAULT_CHUNK_SIZE):
+    """Constructor.
+
+    Args:
+      source: file-like object with a read() method, or an iterable of
+        strings. Read from the current position until EOF.
+      mimetype: string, Mime-type of the stream.
+      chunksize: int, Stream will be uploaded in chunks of this many bytes, or
+        an AdaptiveChunkSize to size the chunks from the measured upload rate.
+        Every chunk but the last must be a multiple of 256 KiB.
+    """
+    super(MediaStreamUpload, self).__init__()
+    if hasattr(source, 'read'):
+      self._source = source
+      self._iterator = None
+    else:
+      self._source = None
+      self._iterator = iter(source)
+    self._mimetype = mimetype
+    self._chunk_sizer = None
+    if isinstance(chunksize, AdaptiveChunkSize):
+      self._chunk_sizer = chunksize
+      chunksize = chunksize.size()
+    if not chunksize > 0:
+      raise InvalidChunkSizeError()
+    self._chunksize = chunksize
+
+    # The bytes read from the source but not yet known to be uploaded, and the
+    # offset in the stream at which they begin.
+    self._buffer = ''
+    self._buffer_begin = 0
+    self._eof = False
+
+  def chunksize(self):
+    """Chunk size for resumable uploads.
+
+    Returns:
+      Chunk size in bytes.
+    """
+    if self._chunk_sizer is not None:
+      return self._chunk_sizer.size()
+    return self._chunksize
+
+  def chunk_sizer(self):
+    """Adaptive chunk sizing for resumable uploads.
+
+    Returns:
+      The AdaptiveChunkSize choosing the chunk sizes, or None if the chunk size
+      is fixed.
+    """
+    return self._chunk_sizer
+
+  def mimetype(self):
+    """Mime type of the body.
+
+    Returns:
+      Mime type.
+    """
+    return self._mimetype
+
+  def size(self):
+    """Size of upload.
+
+    Returns:
+      Size of the stream once its end has been read, otherwise None.
+    """
+    if self._eof:
+      return self._buffer_begin + len(self._buffer)
+    return None
+
+  def resumable(self):
+    """Whether this upload is resumable.
+
+    Returns:
+      True, uploads from a stream are always resumable.
+    """
+    return True
+
+  def _fill(self, n):
+    """Read from the source until the buffer holds n bytes or EOF is hit."""
+    pieces = [self._buffer]
+    have = len(self._buffer)
+    while have < n and not self._eof:
+      if self._iterator is not None:
+        data = next(self._iterator, '')
+      else:
+        data = self._source.read(n - have)
+      if not data:
+        self._eof = True
+      pieces.append(data)
+      have += len(data)
+    self._buffer = ''.join(pieces)
+
+  def getbytes(self, begin, length):
+    """Get bytes from the media.
+
+    Bytes before begin are dropped from the buffer, since the server has
+    acknowledged them, so begin must never move backwards.
+
+    Args:
+      begin: int, offset from beginning of the stream.
+      length: int, number of bytes to read, starting at begin.
+
+    Returns:
+      A string of bytes read. May be shorter than length if EOF was reached
+      first.
+
+    Raises:
+      ValueError if begin is before bytes that have already been discarded.
+    """
+    if begin < self._buffer_begin:
+      raise ValueError('Can not rewind a stream upload to %d, it is already at '
+                       '%d.' % (begin, self._buffer_begin))
+    self._fill(begin - self._buffer_begin)
+    skip = min(begin - self._buffer_begin, len(self._buffer))
+    self._buffer = self._buffer[skip:]
+    self._buffer_begin += skip
+    # Read one byte past the chunk so that EOF is seen with the last full chunk.
+    self._fill(length + 1)
+    return self._buffer[:length]
+
+  def to_json(self):
+    """This upload type is not serializable."""
+    raise NotImplementedError('MediaStreamUpload is not serializable.')
+
+
 class MediaIoBaseDownload(object):
   """"Download media resources.
 
@@ -499,11 +982,17 @@ class MediaIoBaseDownload(object):
         bytes.
       request: apiclient.http.HttpRequest, the media request to perform in
         chunks.
-      chunksize: int, File will be downloaded in chunks of this many bytes.
+      chunksize: int, File will be downloaded in chunks of this many bytes, or
+        an AdaptiveChunkSize to size the chunks from the measured download
+        rate.
     """
     self._fd = fd
     self._request = request
     self._uri = request.uri
+    self._chunk_sizer = None
+    if isinstance(chunksize, AdaptiveChunkSize):
+      self._chunk_sizer = chunksize
+      chunksize = chunksize.size()
     self._chunksize = chunksize
     self._progress = 0
     self._total_size = None
@@ -518,10 +1007,11 @@ class MediaIoBaseDownload(object):
     """Get the next chunk of the download.
 
     Args:
-      num_retries: Integer, number of times to retry 500's with randomized
-            exponential backoff. If all retries fail, the raised HttpError
-            represents the last request. If zero (default), we attempt the
-            request only once.
+      num_retries: Integer, number of times to retry 5xx, 429 and rate limit
+            403 responses with randomized exponential backoff. If all retries
+            fail, the raised HttpError represents the last request. If zero
+            (default), we attempt the request only once. Ignored if the
+            request has a retry_policy.
 
     Returns:
       (status, done): (MediaDownloadStatus, boolean)
@@ -532,22 +1022,35 @@ class MediaIoBaseDownload(object):
       apiclient.errors.HttpError if the response was not a 2xx.
       httplib2.HttpLib2Error if a transport error has occured.
     """
+    if self._chunk_sizer is not None:
+      self._chunksize = self._chunk_sizer.size()
     headers = {
         'range': 'bytes=%d-%d' % (
             self._progress, self._progress + self._chunksize)
         }
     http = self._request.http
+    policy = _retry_policy(self._request, num_retries)
+    limiter = self._request.limiter
 
-    for retry_num in xrange(num_retries + 1):
+    first_start = time.time()
+    for retry_num in xrange(policy.num_retries + 1):
       if retry_num > 0:
-        self._sleep(self._rand() * 2**retry_num)
+        with httplib2.phase('backoff', retry=retry_num):
+          self._sleep(delay)
         logging.warning(
             'Retry #%d for media download: GET %s, following status: %d'
             % (retry_num, self._uri, resp.status))
 
+      if limiter is not None:
+        limiter.acquire()
+      start = time.time()
       resp, content = http.request(self._uri, headers=headers)
-      if resp.status < 500:
+      delay = policy.next_delay(retry_num + 1, resp, content,
+                                time.time() - first_start, rand=self._rand)
+      if delay is None:
         break
+      if self._chunk_sizer is not None:
+        self._chunk_sizer.record_failure()
 
     if resp.status in [200, 206]:
       if 'content-location' in resp and resp['content-location'] != self._uri:
@@ -562,7 +1065,15 @@ class MediaIoBaseDownload(object):
 
       if self._progress == self._total_size:
         self._done = True
-      return MediaDownloadProgress(self._progress, self._total_size), self._done
+
+      throughput = None
+      if self._chunk_sizer is not None:
+        self._chunk_sizer.record(len(content), time.time() - start)
+        self._chunksize = self._chunk_sizer.size()
+        throughput = self._chunk_sizer.throughput
+      return MediaDownloadProgress(self._progress, self._total_size,
+                                   chunksize=self._chunksize,
+                                   throughput=throughput), self._done
     else:
       raise HttpError(resp, content, uri=self._uri)
 
@@ -607,6 +1118,324 @@ class _StreamSlice(object):
     return self._stream.read(n)
 
 
+class MediaUploadBody(object):
+  """A request body assembled from strings and MediaUpload objects.
+
+  Used as the body of non-resumable media uploads, both simple and
+  multipart/related. httplib reads the body in blocks as it sends it, and the
+  media bytes are fetched from the MediaUpload one block at a time, so the
+  media is never held in memory in its entirety. The total length is known
+  ahead of time, so len() of the body is the value of the Content-Length
+  header.
+
+  Example:
+    body = MediaUploadBody(['--boundary\\n', media, '\\n--boundary--\\n'])
+  """
+
+  def __init__(self, parts):
+    """Constructor.
+
+    Args:
+      parts: list, the pieces of the body in order. Each piece is either a
+        string or a MediaUpload whose size() is known.
+    """
+    self._parts = []
+    for part in parts:
+      if isinstance(part, basestring):
+        self._parts.append((part, len(part)))
+      else:
+        self._parts.append((part, part.size()))
+    self._size = sum([length for _, length in self._parts])
+    self._offset = 0
+
+  def __len__(self):
+    return self._size
+
+  def tell(self):
+    """Current position in the body."""
+    return self._offset
+
+  def seek(self, offset, whence=os.SEEK_SET):
+    """Move to a new position in the body.
+
+    Used to rewind the body when a request has to be sent again.
+
+    Args:
+      offset: int, the new position, relative to whence.
+      whence: int, one of os.SEEK_SET, os.SEEK_CUR or os.SEEK_END.
+    """
+    if whence == os.SEEK_CUR:
+      offset += self._offset
+    elif whence == os.SEEK_END:
+      offset += self._size
+    self._offset = max(0, min(offset, self._size))
+
+  def read(self, n=-1):
+    """Read n bytes.
+
+    Args:
+      n, int, the number of bytes to read.
+
+    Returns:
+      A string of length 'n', or less if the end of the body is reached.
+    """
+    if n < 0 or self._offset + n > self._size:
+      n = self._size - self._offset
+    chunks = []
+    begin = 0
+    for part, length in self._parts:
+      end = begin + length
+      if n <= 0:
+        break
+      if self._offset < end:
+        start = self._offset - begin
+        count = min(n, end - self._offset)
+        if isinstance(part, basestring):
+          data = part[start:start + count]
+        else:
+          data = part.getbytes(start, count)
+          if isinstance(data, memoryview):
+            data = data.tobytes()
+          elif not isinstance(data, basestring):
+            data = str(data)
+        chunks.append(data)
+        self._offset += len(data)
+        n -= len(data)
+        if len(data) < count:
+          # The media was shorter than its size() claimed.
+          break
+      begin = end
+    return ''.join(chunks)
+
+  def getvalue(self):
+    """The entire body as a string.
+
+    Only needed when the body has to be embedded in something else, such as a
+    batch request or a JSON representation of the request.
+    """
+    position = self._offset
+    self.seek(0)
+    value = self.read()
+    self.seek(position)
+    return value
+
+
+class ETagCache(object):
+  """Remembers the ETag and decoded body of GET responses.
+
+  An HttpRequest constructed with an ETagCache sends If-None-Match with the
+  ETag it last saw for the same URI. When the server answers 304 Not Modified,
+  or a caching httplib2.Http answers from its own cache with the same ETag,
+  execute() returns the stored decoded body without running postproc again,
+  or for a streamed request, a model.ItemStream over it.
+
+  Decoded bodies are shared between callers and must be treated as read-only.
+  The most recently used max_entries of them are kept in memory; older ones
+  are read back from the store, if there is one, when next needed.
+  """
+
+  def __init__(self, store=None, max_entries=100):
+    """Constructor.
+
+    Args:
+      store: object with the httplib2 cache interface (get, set and delete of
+        strings), such as httplib2.FileCache or httplib2.BoundedFileCache,
+        used to keep entries between processes. Entries are pickled, so the
+        store must not be writable by anyone else. None keeps entries in
+        memory only.
+      max_entries: int, the number of entries to keep in memory.
+    """
+    self._store = store
+    self._max_entries = max_entries
+    self._lock = threading.Lock()
+    # uri -> (etag, value), least recently used first.
+    self._entries = collections.OrderedDict()
+
+  def _key(self, uri):
+    # Keep clear of the keys httplib2 itself uses when sharing a store.
+    return 'etag:' + uri
+
+  def _remember(self, uri, entry):
+    with self._lock:
+      self._entries.pop(uri, None)
+      self._entries[uri] = entry
+      while len(self._entries) > self._max_entries:
+        self._entries.popitem(last=False)
+
+  def get(self, uri):
+    """Returns the (etag, value) tuple stored for uri, or (None, None)."""
+    with self._lock:
+      entry = self._entries.pop(uri, None)
+      if entry is not None:
+        self._entries[uri] = entry
+    if entry is None and self._store is not None:
+      data = self._store.get(self._key(uri))
+      if data:
+        try:
+          entry = cPickle.loads(data)
+        except Exception:
+          logging.warning('Discarding unreadable ETag cache entry for %s', uri)
+          self._store.delete(self._key(uri))
+        else:
+          self._remember(uri, entry)
+    return entry or (None, None)
+
+  def set(self, uri, etag, value):
+    """Stores the etag and decoded value of a response for uri."""
+    entry = (etag, value)
+    self._remember(uri, entry)
+    if self._store is not None:
+      self._store.set(self._key(uri),
+                      cPickle.dumps(entry, cPickle.HIGHEST_PROTOCOL))
+
+  def delete(self, uri):
+    """Forgets anything stored for uri."""
+    with self._lock:
+      self._entries.pop(uri, None)
+    if self._store is not None:
+      self._store.delete(self._key(uri))
+
+
+def _error_reason(content):
+  """The reason of the first error in a JSON error response, or None."""
+  try:
+    return simplejson.loads(content)['error']['errors'][0]['reason']
+  except (ValueError, KeyError, IndexError, TypeError):
+    return None
+
+
+def _retry_after(resp):
+  """Seconds the response asks to wait before retrying, or None."""
+  value = resp.get('retry-after')
+  if value is None:
+    return None
+  try:
+    return max(0, int(value))
+  except ValueError:
+    import email.utils
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+      return None
+    return max(0, email.utils.mktime_tz(date) - time.time())
+
+
+class RetryPolicy(object):
+  """Decides which failed requests are retried and how long to wait first.
+
+  A request is retried on any 5xx status, on a status in statuses, or on a
+  403 whose error reason is in reasons. Before retry n the wait is random up
+  to 2**n seconds, capped at max_delay, unless the response has a Retry-After
+  header, which is obeyed. No retry is started after deadline seconds from
+  the first attempt.
+
+  The same policy can be shared by any number of requests.
+  """
+
+  @util.positional(1)
+  def __init__(self, num_retries=0, statuses=RETRY_STATUSES,
+               reasons=RETRY_REASONS, max_delay=None, deadline=None):
+    """Constructor.
+
+    Args:
+      num_retries: int, the most times to retry a request.
+      statuses: collection of int, statuses to retry besides 5xx.
+      reasons: collection of string, error reasons to retry a 403 for.
+      max_delay: float, the longest backoff in seconds, or None for no limit.
+        Does not apply to Retry-After.
+      deadline: float, seconds after the first attempt past which no retry
+        is started, or None for no limit.
+    """
+    self.num_retries = num_retries
+    self.statuses = statuses
+    self.reasons = reasons
+    self.max_delay = max_delay
+    self.deadline = deadline
+
+  def retryable(self, resp, content):
+    """Whether the response is one worth retrying the request for."""
+    if resp.status >= 500 or resp.status in self.statuses:
+      return True
+    return resp.status == 403 and _error_reason(content) in self.reasons
+
+  def delay(self, retry_num, resp, rand=random.random):
+    """Seconds to wait before retry number retry_num, counting from 1."""
+    delay = _retry_after(resp)
+    if delay is None:
+      delay = rand() * 2**retry_num
+      if self.max_delay is not None:
+        delay = min(delay, self.max_delay)
+    return delay
+
+  def next_delay(self, retry_num, resp, content, elapsed, rand=random.random):
+    """Decides whether to make retry number retry_num.
+
+    Args:
+      retry_num: int, the number of the retry being considered, from 1.
+      resp: httplib2.Response, the response to the last attempt.
+      content: string, the body of the response to the last attempt.
+      elapsed: float, seconds since the first attempt was started.
+      rand: callable returning a random float in [0, 1).
+
+    Returns:
+      The seconds to wait before retrying, or None to give up.
+    """
+    if retry_num > self.num_retries or not self.retryable(resp, content):
+      return None
+    delay = self.delay(retry_num, resp, rand)
+    if self.deadline is not None and elapsed + delay > self.deadline:
+      return None
+    return delay
+
+
+def _retry_policy(request, num_retries):
+  """The request's retry policy, or the default one for num_retries."""
+  if request.retry_policy is not None:
+    return request.retry_policy
+  return RetryPolicy(num_retries=num_retries)
+
+
+class RateLimiter(object):
+  """Token bucket limiting the rate requests are made at.
+
+  Lets through rate requests per second on average, and up to burst at once
+  after a pause. Requests over the limit wait their turn in acquire(). Share
+  one limiter between everything that counts against the same quota, such as
+  a project's per-user queries per second; it is thread-safe.
+  """
+
+  def __init__(self, rate, burst=1):
+    """Constructor.
+
+    Args:
+      rate: float, requests allowed per second.
+      burst: int, requests allowed at once before rate limiting starts.
+    """
+    self.rate = float(rate)
+    self.burst = burst
+    self._tokens = float(burst)
+    self._last = None
+    self._lock = threading.Lock()
+
+    # Stubs for testing.
+    self._time = time.time
+    self._sleep = time.sleep
+
+  def acquire(self, tokens=1):
+    """Blocks until tokens more requests may be made."""
+    with self._lock:
+      now = self._time()
+      if self._last is not None:
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last) * self.rate)
+      self._last = now
+      # Take the tokens now, going into debt if need be, so that concurrent
+      # callers queue up behind each other rather than all waking at once.
+      self._tokens -= tokens
+      wait = -self._tokens / self.rate
+    if wait > 0:
+      self._sleep(wait)
+
+
 class HttpRequest(object):
   """Encapsulates a single HTTP request."""
 
@@ -616,7 +1445,10 @@ class HttpRequest(object):
                body=None,
                headers=None,
                methodId=None,
-               resumable=None):
+               resumable=None,
+               etag_cache=None,
+               retry_policy=None,
+               limiter=None):
     """Constructor for an HttpRequest.
 
     Args:
@@ -630,6 +1462,11 @@ class HttpRequest(object):
       headers: dict, the HTTP request headers
       methodId: string, a unique identifier for the API method being called.
       resumable: MediaUpload, None if this is not a resumbale request.
+      etag_cache: ETagCache, used to make GET requests conditional. None
+        disables conditional requests.
+      retry_policy: RetryPolicy, decides which failures are retried. None
+        retries 5xx, 429 and rate limit 403 responses num_retries times.
+      limiter: RateLimiter, acquired before every attempt, or None.
     """
     self.uri = uri
     self.method = method
@@ -639,6 +1476,9 @@ class HttpRequest(object):
     self.http = http
     self.postproc = postproc
     self.resumable = resumable
+    self.etag_cache = etag_cache
+    self.retry_policy = retry_policy
+    self.limiter = limiter
     self.response_callbacks = []
     self._in_error_state = False
 
@@ -660,16 +1500,23 @@ class HttpRequest(object):
     self._sleep = time.sleep
 
   @util.positional(1)
-  def execute(self, http=None, num_retries=0):
+  def execute(self, http=None, num_retries=0, stream=False):
     """Execute the request.
 
     Args:
       http: httplib2.Http, an http object to be used in place of the
             one the HttpRequest request object was constructed with.
-      num_retries: Integer, number of times to retry 500's with randomized
-            exponential backoff. If all retries fail, the raised HttpError
-            represents the last request. If zero (default), we attempt the
-            request only once.
+      num_retries: Integer, number of times to retry 5xx, 429 and rate limit
+            403 responses with randomized exponential backoff. If all retries
+            fail, the raised HttpError represents the last request. If zero
+            (default), we attempt the request only once. Ignored if the
+            request has a retry_policy.
+      stream: boolean, hand the response body to postproc as an
+            httplib2.StreamingBody, read from the connection as it is
+            decoded, rather than as a string. With JsonModel the result is
+            then a model.ItemStream, whose items are kept as they are read
+            if it is to be stored in the etag_cache, and which is replayed
+            from there on a 304 Not Modified.
 
     Returns:
       A deserialized object model of the response body as determined
@@ -679,6 +1526,10 @@ class HttpRequest(object):
       apiclient.errors.HttpError if the response was not a 2xx.
       httplib2.HttpLib2Error if a transport error has occured.
     """
+    with httplib2.phase('execute', methodId=self.methodId, uri=self.uri):
+      return self._execute(http, num_retries, stream)
+
+  def _execute(self, http, num_retries, stream=False):
     if http is None:
       http = self.http
 
@@ -705,23 +1556,67 @@ class HttpRequest(object):
       self.body = parsed.query
       self.headers['content-length'] = str(len(self.body))
 
-    # Handle retries for server-side errors.
-    for retry_num in xrange(num_retries + 1):
+    # Make the request conditional if a decoded response is already known.
+    # The header goes on a copy since list_next() shares self.headers between
+    # pages.
+    headers = self.headers
+    etag, cached = None, None
+    use_etag_cache = self.etag_cache is not None and self.method == 'GET'
+    if use_etag_cache:
+      etag, cached = self.etag_cache.get(self.uri)
+      if etag is not None:
+        headers = dict(headers)
+        headers['if-none-match'] = etag
+
+    # Handle retries for server-side errors and rate limiting.
+    policy = _retry_policy(self, num_retries)
+    start = time.time()
+    for retry_num in xrange(policy.num_retries + 1):
       if retry_num > 0:
-        self._sleep(self._rand() * 2**retry_num)
+        with httplib2.phase('backoff', retry=retry_num):
+          self._sleep(delay)
         logging.warning('Retry #%d for request: %s %s, following status: %d'
                         % (retry_num, self.method, self.uri, resp.status))
-
-      resp, content = http.request(str(self.uri), method=str(self.method),
-                                   body=self.body, headers=self.headers)
-      if resp.status < 500:
+        if isinstance(self.body, MediaUploadBody):
+          self.body.seek(0)
+
+      if self.limiter is not None:
+        self.limiter.acquire()
+      if stream:
+        resp, content = http.request(str(self.uri), method=str(self.method),
+                                     body=self.body, headers=headers,
+                                     stream=True)
+        # Errors are small, and read in full to be reported or retried.
+        if resp.status >= 300:
+          content = content.read()
+      else:
+        resp, content = http.request(str(self.uri), method=str(self.method),
+                                     body=self.body, headers=headers)
+      delay = policy.next_delay(retry_num + 1, resp, content,
+                                time.time() - start, rand=self._rand)
+      if delay is None:
         break
 
     for callback in self.response_callbacks:
       callback(resp)
+    if etag is not None and (resp.status == 304 or
+        (resp.status == 200 and resp.get('etag') == etag)):
+      if isinstance(content, httplib2.StreamingBody):
+        content.close()
+      if stream and isinstance(cached, dict):
+        return ItemStream.from_dict(cached)
+      return cached
     if resp.status >= 300:
       raise HttpError(resp, content, uri=self.uri)
-    return self.postproc(resp, content)
+    value = self.postproc(resp, content)
+    if use_etag_cache and resp.status == 200 and 'etag' in resp:
+      if isinstance(value, ItemStream):
+        # Stored once it has been read; the caller is still to read it.
+        value.keep(functools.partial(self.etag_cache.set, self.uri,
+                                     resp['etag']))
+      else:
+        self.etag_cache.set(self.uri, resp['etag'], value)
+    return value
 
   @util.positional(2)
   def add_response_callback(self, cb):
@@ -761,10 +1656,11 @@ class HttpRequest(object):
     Args:
       http: httplib2.Http, an http object to be used in place of the
             one the HttpRequest request object was constructed with.
-      num_retries: Integer, number of times to retry 500's with randomized
-            exponential backoff. If all retries fail, the raised HttpError
-            represents the last request. If zero (default), we attempt the
-            request only once.
+      num_retries: Integer, number of times to retry 5xx, 429 and rate limit
+            403 responses with randomized exponential backoff. If all retries
+            fail, the raised HttpError represents the last request. If zero
+            (default), we attempt the request only once. Ignored if the
+            request has a retry_policy.
 
     Returns:
       (status, body): (ResumableMediaStatus, object)
@@ -776,6 +1672,7 @@ class HttpRequest(object):
     """
     if http is None:
       http = self.http
+    policy = _retry_policy(self, num_retries)
 
     if self.resumable.size() is None:
       size = '*'
@@ -789,17 +1686,23 @@ class HttpRequest(object):
         start_headers['X-Upload-Content-Length'] = size
       start_headers['content-length'] = str(self.body_size)
 
-      for retry_num in xrange(num_retries + 1):
+      start = time.time()
+      for retry_num in xrange(policy.num_retries + 1):
         if retry_num > 0:
-          self._sleep(self._rand() * 2**retry_num)
+          with httplib2.phase('backoff', retry=retry_num):
+            self._sleep(delay)
           logging.warning(
               'Retry #%d for resumable URI request: %s %s, following status: %d'
               % (retry_num, self.method, self.uri, resp.status))
 
+        if self.limiter is not None:
+          self.limiter.acquire()
         resp, content = http.request(self.uri, method=self.method,
                                      body=self.body,
                                      headers=start_headers)
-        if resp.status < 500:
+        delay = policy.next_delay(retry_num + 1, resp, content,
+                                  time.time() - start, rand=self._rand)
+        if delay is None:
           break
 
       if resp.status == 200 and 'location' in resp:
@@ -814,6 +1717,8 @@ class HttpRequest(object):
           'Content-Range': 'bytes */%s' % size,
           'content-length': '0'
           }
+      if self.limiter is not None:
+        self.limiter.acquire()
       resp, content = http.request(self.resumable_uri, 'PUT',
                                    headers=headers)
       status, body = self._process_response(resp, content)
@@ -843,34 +1748,56 @@ class HttpRequest(object):
       # A short read implies that we are at EOF, so finish the upload.
       if len(data) < self.resumable.chunksize():
         size = str(self.resumable_progress + len(data))
+      elif size == '*' and self.resumable.size() is not None:
+        # A stream of unknown length found its end reading this chunk.
+        size = str(self.resumable.size())
 
       chunk_end = self.resumable_progress + len(data) - 1
 
+    if chunk_end < self.resumable_progress:
+      # Nothing left to send, this request only finalizes the length.
+      content_range = 'bytes */%s' % size
+    else:
+      content_range = 'bytes %d-%d/%s' % (
+          self.resumable_progress, chunk_end, size)
     headers = {
-        'Content-Range': 'bytes %d-%d/%s' % (
-            self.resumable_progress, chunk_end, size),
+        'Content-Range': content_range,
         # Must set the content-length header here because httplib can't
         # calculate the size when working with _StreamSlice.
         'Content-Length': str(chunk_end - self.resumable_progress + 1)
         }
 
-    for retry_num in xrange(num_retries + 1):
+    sizer = self.resumable.chunk_sizer()
+    first_start = time.time()
+    for retry_num in xrange(policy.num_retries + 1):
       if retry_num > 0:
-        self._sleep(self._rand() * 2**retry_num)
+        with httplib2.phase('backoff', retry=retry_num):
+          self._sleep(delay)
         logging.warning(
             'Retry #%d for media upload: %s %s, following status: %d'
             % (retry_num, self.method, self.uri, resp.status))
 
+      if self.limiter is not None:
+        self.limiter.acquire()
+      start = time.time()
       try:
         resp, content = http.request(self.resumable_uri, method='PUT',
                                      body=data,
                                      headers=headers)
       except:
         self._in_error_state = True
+        if sizer is not None:
+          sizer.record_failure()
         raise
-      if resp.status < 500:
+      delay = policy.next_delay(retry_num + 1, resp, content,
+                                time.time() - first_start, rand=self._rand)
+      if delay is None:
         break
+      if sizer is not None:
+        sizer.record_failure()
 
+    if sizer is not None and resp.status in [200, 201, 308]:
+      sizer.record(chunk_end - self.resumable_progress + 1, time.time() - start)
     return self._process_response(resp, content)
 
   def _process_response(self, resp, content):
@@ -900,7 +1827,12 @@ class HttpRequest(object):
       self._in_error_state = True
       raise HttpError(resp, content, uri=self.uri)
 
-    return (MediaUploadProgress(self.resumable_progress, self.resumable.size()),
+    throughput = None
+    if self.resumable.chunk_sizer() is not None:
+      throughput = self.resumable.chunk_sizer().throughput
+    return (MediaUploadProgress(self.resumable_progress, self.resumable.size(),
+                                chunksize=self.resumable.chunksize(),
+                                throughput=throughput),
             None)
 
   def to_json(self):
@@ -908,16 +1840,25 @@ class HttpRequest(object):
     d = copy.copy(self.__dict__)
     if d['resumable'] is not None:
       d['resumable'] = self.resumable.to_json()
+    if isinstance(d['body'], MediaUploadBody):
+      d['body'] = d['body'].getvalue()
     del d['http']
     del d['postproc']
+    del d['etag_cache']
+    del d['retry_policy']
+    del d['limiter']
     del d['_sleep']
     del d['_rand']
 
     return simplejson.dumps(d)
 
   @staticmethod
-  def from_json(s, http, postproc):
-    """Returns an HttpRequest populated with info from a JSON object."""
+  def from_json(s, http, postproc, retry_policy=None, limiter=None):
+    """Returns an HttpRequest populated with info from a JSON object.
+
+    The retry policy and limiter are not part of the JSON, and are given
+    here instead.
+    """
     d = simplejson.loads(s)
     if d['resumable'] is not None:
       d['resumable'] = MediaUpload.new_from_json(d['resumable'])
@@ -929,7 +1870,9 @@ class HttpRequest(object):
         body=d['body'],
         headers=d['headers'],
         methodId=d['methodId'],
-        resumable=d['resumable'])
+        resumable=d['resumable'],
+        retry_policy=retry_policy,
+        limiter=limiter)
 
 
 class BatchHttpRequest(object):
@@ -966,7 +1909,7 @@ class BatchHttpRequest(object):
   """
 
   @util.positional(1)
-  def __init__(self, callback=None, batch_uri=None):
+  def __init__(self, callback=None, batch_uri=None, retry_policy=None):
     """Constructor for a BatchHttpRequest.
 
     Args:
@@ -976,10 +1919,14 @@ class BatchHttpRequest(object):
         third is an apiclient.errors.HttpError exception object if an HTTP error
         occurred while processing the request, or None if no error occurred.
       batch_uri: string, URI to send batch requests to.
+      retry_policy: RetryPolicy, decides which failed requests are sent again,
+        in a batch of their own. None uses the retry_policy of each request,
+        if it has one.
     """
     if batch_uri is None:
       batch_uri = 'https://www.googleapis.com/batch'
     self._batch_uri = batch_uri
+    self.retry_policy = retry_policy
 
     # Global callback to be called for each individual response in the batch.
     self._callback = callback
@@ -1005,6 +1952,10 @@ class BatchHttpRequest(object):
     # A map of id(Credentials) that have been refreshed.
     self._refreshed_credentials = {}
 
+    # Stubs for testing.
+    self._sleep = time.sleep
+    self._rand = random.random
+
   def _refresh_and_apply_credentials(self, request, http):
     """Refresh the credentials and apply to the request.
 
@@ -1044,6 +1995,7 @@ class BatchHttpRequest(object):
       unique.
     """
     if self._base_id is None:
+      import uuid
       self._base_id = uuid.uuid4()
 
     return '<%s+%s>' % (self._base_id, urllib.quote(id_))
@@ -1080,6 +2032,9 @@ class BatchHttpRequest(object):
     Returns:
       The request as a string in application/http format.
     """
+    from email.generator import Generator
+    from email.mime.nonmultipart import MIMENonMultipart
+
     # Construct status line
     parsed = urlparse.urlparse(request.uri)
     request_line = urlparse.urlunparse(
@@ -1104,8 +2059,11 @@ class BatchHttpRequest(object):
     msg.set_unixfrom(None)
 
     if request.body is not None:
-      msg.set_payload(request.body)
-      msg['content-length'] = str(len(request.body))
+      body = request.body
+      if isinstance(body, MediaUploadBody):
+        body = body.getvalue()
+      msg.set_payload(body)
+      msg['content-length'] = str(len(body))
 
     # Serialize the mime message.
     fp = StringIO.StringIO()
@@ -1129,6 +2087,8 @@ class BatchHttpRequest(object):
     Returns:
       A pair (resp, content), such as would be returned from httplib2.request.
     """
+    from email.parser import FeedParser
+
     # Strip off the status line
     status_line, payload = payload.split('\n', 1)
     protocol, status, reason = status_line.split(' ', 2)
@@ -1213,6 +2173,10 @@ class BatchHttpRequest(object):
       httplib2.HttpLib2Error if a transport error has occured.
       apiclient.errors.BatchError if the response is the wrong format.
     """
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.nonmultipart import MIMENonMultipart
+    from email.parser import FeedParser
+
     message = MIMEMultipart('mixed')
     # Message should not write out it's own headers.
     setattr(message, '_write_headers', lambda self: None)
@@ -1235,6 +2199,12 @@ class BatchHttpRequest(object):
     headers['content-type'] = ('multipart/mixed; '
                                'boundary="%s"') % message.get_boundary()
 
+    # Each request in the batch counts against the quota on its own.
+    for request_id in order:
+      limiter = getattr(requests[request_id], 'limiter', None)
+      if limiter is not None:
+        limiter.acquire()
+
     resp, content = http.request(self._batch_uri, method='POST', body=body,
                                  headers=headers)
 
@@ -1261,10 +2231,52 @@ class BatchHttpRequest(object):
       response, content = self._deserialize_response(part.get_payload())
       self._responses[request_id] = (response, content)
 
+  def _retry(self, http, first_start):
+    """Sends the requests whose responses are worth retrying again.
+
+    They are retried together, in batches of their own, after the longest of
+    their backoffs, for as long as their retry policies allow.
+
+    Args:
+      http: httplib2.Http, an http object to be used to make the request with.
+      first_start: float, time.time() when the batch was first sent, from
+        which the retry policies' deadlines are measured.
+    """
+    retry_num = 0
+    while True:
+      retry_num += 1
+      # A request is only ever in a retry if it was in all of those before,
+      # so retry_num is also its own retry number.
+      delays = {}
+      for request_id in self._order:
+        policy = self.retry_policy or self._requests[request_id].retry_policy
+        if policy is None:
+          continue
+        resp, content = self._responses[request_id]
+        delay = policy.next_delay(retry_num, resp, content,
+                                  time.time() - first_start,
+                                  rand=self._rand)
+        if delay is not None:
+          delays[request_id] = delay
+      if not delays:
+        return
+      retry_order = [i for i in self._order if i in delays]
+      with httplib2.phase('backoff', retry=retry_num):
+        self._sleep(max(delays.values()))
+      logging.warning('Retry #%d for %d requests of batch: %s'
+                      % (retry_num, len(retry_order), self._batch_uri))
+      with httplib2.phase('batch', size=len(retry_order)):
+        self._execute(http, retry_order,
+                      dict((i, self._requests[i]) for i in retry_order))
+
   @util.positional(1)
   def execute(self, http=None):
     """Execute all the requests as a single batched HTTP request.
 
+    Requests whose responses are worth retrying under the batch's retry
+    policy, or failing that their own, such as 403 rateLimitExceeded, 429
+    and 5xx, are sent again in batches of their own.
+
     Args:
       http: httplib2.Http, an http object to be used in place of the one the
         HttpRequest request object was constructed with. If one isn't supplied
@@ -1289,7 +2301,9 @@ class BatchHttpRequest(object):
     if http is None:
       raise ValueError("Missing a valid http object.")
 
-    self._execute(http, self._order, self._requests)
+    first_start = time.time()
+    with httplib2.phase('batch', size=len(self._order)):
+      self._execute(http, self._order, self._requests)
 
     # Loop over all the requests and check for 401s. For each 401 request the
     # credentials should be refreshed and then sent again in a separate batch.
@@ -1305,7 +2319,10 @@ class BatchHttpRequest(object):
         redo_requests[request_id] = request
 
     if redo_requests:
-      self._execute(http, redo_order, redo_requests)
+      with httplib2.phase('batch', size=len(redo_order)):
+        self._execute(http, redo_order, redo_requests)
+
+    self._retry(http, first_start)
 
     # Now process all callbacks that are erroring, and raise an exception for
     # ones that return a non-2xx response? Or add extra parameter to callback
@@ -1355,13 +2372,16 @@ class HttpRequestMock(object):
     if 'reason' in self.resp:
       self.resp.reason = self.resp['reason']
 
-  def execute(self, http=None):
+  def execute(self, http=None, stream=False):
     """Execute the request.
 
     Same behavior as HttpRequest.execute(), but the response is
     mocked and not really from an HTTP request/response.
     """
-    return self.postproc(self.resp, self.content)
+    content = self.content
+    if stream and self.resp.status < 300:
+      content = httplib2.StreamingBody(StringIO.StringIO(content or ''))
+    return self.postproc(self.resp, content)
 
 
 class RequestMockBuilder(object):
@@ -1467,12 +2487,16 @@ class HttpMock(object):
               body=None,
               headers=None,
               redirections=1,
-              connection_type=None):
+              connection_type=None,
+              stream=False):
     self.uri = uri
     self.method = method
     self.body = body
     self.headers = headers
-    return httplib2.Response(self.response_headers), self.data
+    content = self.data
+    if stream:
+      content = httplib2.StreamingBody(StringIO.StringIO(content or ''))
+    return httplib2.Response(self.response_headers), content
 
 
 class HttpMockSequence(object):
@@ -1512,7 +2536,8 @@ class HttpMockSequence(object):
               body=None,
               headers=None,
               redirections=1,
-              connection_type=None):
+              connection_type=None,
+              stream=False):
     resp, content = self._iterable.pop(0)
     if content == 'echo_request_headers':
       content = headers
@@ -1525,6 +2550,8 @@ class HttpMockSequence(object):
         content = body
     elif content == 'echo_request_uri':
       content = uri
+    if stream:
+      content = httplib2.StreamingBody(StringIO.StringIO(content))
     return httplib2.Response(resp), content
 
 
@@ -1552,7 +2579,7 @@ def set_user_agent(http, user_agent):
   # The closure that will replace 'httplib2.Http.request'.
   def new_request(uri, method='GET', body=None, headers=None,
                   redirections=httplib2.DEFAULT_MAX_REDIRECTS,
-                  connection_type=None):
+                  connection_type=None, **kwargs):
     """Modify the request headers to add the user-agent."""
     if headers is None:
       headers = {}
@@ -1561,7 +2588,7 @@ def set_user_agent(http, user_agent):
     else:
       headers['user-agent'] = user_agent
     resp, content = request_orig(uri, method, body, headers,
-                        redirections, connection_type)
+                        redirections, connection_type, **kwargs)
     return resp, content
 
   http.request = new_request
@@ -1591,7 +2618,7 @@ def tunnel_patch(http):
   # The closure that will replace 'httplib2.Http.request'.
   def new_request(uri, method='GET', body=None, headers=None,
                   redirections=httplib2.DEFAULT_MAX_REDIRECTS,
-                  connection_type=None):
+                  connection_type=None, **kwargs):
     """Modify the request headers to add the user-agent."""
     if headers is None:
       headers = {}
@@ -1602,7 +2629,7 @@ def tunnel_patch(http):
       headers['x-http-method-override'] = "PATCH"
       method = 'POST'
     resp, content = request_orig(uri, method, body, headers,
-                        redirections, connection_type)
+                        redirections, connection_type, **kwargs)
     return resp, content
 
   http.request = new_request
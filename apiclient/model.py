@@ -24,7 +24,11 @@ object representation.
 
 __author__ = 'jcgregorio@google.com (Joe Gregorio)'
 
+import codecs
+import collections
+import httplib2
 import logging
+import re
 import urllib
 
 from apiclient import __version__
@@ -34,6 +38,10 @@ from oauth2client.anyjson import simplejson
 
 dump_request_response = False
 
+# What can follow a JSON value, as ItemStream decodes them.
+_WHITESPACE = re.compile(r'[ \t\r\n]*')
+_VALUE_END = frozenset(' \t\r\n,:]}')
+
 
 def _abstract():
   raise NotImplementedError('You need to override this function')
@@ -232,6 +240,235 @@ class BaseModel(Model):
     _abstract()
 
 
+class ItemStream(object):
+  """A JSON list response that is decoded as its items are read.
+
+  JsonModel returns one of these in place of a dict for a request executed
+  with stream=True. Iterating over it yields the elements of the response's
+  'items' one at a time, each decoded as its part of the body arrives from
+  the connection, so that only the item in hand is held in memory. The other
+  top-level fields, such as nextPageToken, can be read with [], get() and
+  'in' wherever they appear in the body. Reading one that comes after
+  'items' before the items have been iterated over keeps the items passed on
+  the way in memory until they are.
+
+  The items can only be iterated over once. The connection goes back to the
+  pool when the body has been read to the end; call close() to abandon it
+  part way through. A JsonModel with a data wrapper decodes streamed bodies
+  whole instead.
+
+  HttpRequest uses keep() to store a streamed response in its etag_cache,
+  and from_dict() to replay it when the server answers 304 Not Modified.
+  """
+
+  def __init__(self, body):
+    """Constructor.
+
+    Args:
+      body: httplib2.StreamingBody, or any file-like object with read(amt),
+        holding the UTF-8 encoded response body.
+    """
+    self._body = body
+    self._text = codecs.getincrementaldecoder('utf-8')()
+    self._decoder = simplejson.JSONDecoder()
+    self._buf = u''
+    self._pos = 0
+    self._eof = False
+    self._fields = {}
+    self._read_ahead = collections.deque()
+    self._iterated = False
+    self._has_items = False
+    # Where the parser is: 'start', 'fields', 'items' or 'done', and whether
+    # the next member or element is the first of its object or array.
+    self._state = 'start'
+    self._first = True
+    self._kept = None
+    self._on_done = None
+    self._deserializing = None
+    self._bytes = 0
+
+  @classmethod
+  def from_dict(cls, value):
+    """An ItemStream over a response that has already been decoded.
+
+    Args:
+      value: dict, the decoded response, such as keep() passes on.
+
+    Returns:
+      An ItemStream with the same fields and items as value, which it reads
+      from without copying them.
+    """
+    stream = cls(None)
+    stream._fields = dict((k, v) for k, v in value.iteritems() if k != 'items')
+    stream._has_items = 'items' in value
+    stream._read_ahead.extend(value.get('items', ()))
+    stream._state = 'done'
+    stream._eof = True
+    return stream
+
+  def keep(self, callback):
+    """Passes on the whole response once the body has been read to the end.
+
+    From then on the items are kept in memory as they are decoded, so must
+    be called before anything is read. Nothing is passed on for a body that
+    is closed part way through.
+
+    Args:
+      callback: callable, called with the decoded response as a dict.
+    """
+    self._kept = []
+    self._on_done = callback
+
+  def _fill(self):
+    """Reads the next block of the body; returns False at its end."""
+    if self._eof:
+      return False
+    if self._deserializing is None:
+      # Takes in the reading of the body, as the two are interleaved.
+      self._deserializing = httplib2.phase('deserialize', streamed=True)
+      self._deserializing.__enter__()
+    data = self._body.read(httplib2.STREAM_BLOCK_SIZE)
+    self._bytes += len(data)
+    self._eof = not data
+    self._buf = self._buf[self._pos:] + self._text.decode(data, self._eof)
+    self._pos = 0
+    return True
+
+  def _peek(self):
+    """Skips whitespace; returns the next character, or '' at the end."""
+    while True:
+      self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+      if self._pos < len(self._buf) or not self._fill():
+        return self._buf[self._pos:self._pos + 1]
+
+  def _expect(self, char):
+    """Consumes the next character, which must be char."""
+    c = self._peek()
+    if c != char:
+      raise ValueError('Expected %r in list response, got %r' %
+                       (char, c or 'end of body'))
+    self._pos += 1
+
+  def _value(self):
+    """Decodes the JSON value that starts at the next character."""
+    self._peek()
+    while True:
+      try:
+        value, end = self._decoder.raw_decode(self._buf, self._pos)
+      except ValueError:
+        # Most likely the rest of the value is still to be read.
+        if not self._fill():
+          raise
+        continue
+      # Values are followed by whitespace or punctuation; without it, a
+      # number at the end of the block may go on in the next one.
+      if (end < len(self._buf) and self._buf[end] in _VALUE_END or
+          not self._fill()):
+        self._pos = end
+        return value
+
+  def _next(self):
+    """Decodes up to the next item.
+
+    Returns:
+      (True, item), or (False, None) once there are no more items.
+    """
+    if self._state == 'start':
+      self._expect('{')
+      self._state = 'fields'
+    while self._state == 'items':
+      if self._peek() == ']':
+        self._pos += 1
+        self._state = 'fields'
+        self._first = False
+        break
+      if not self._first:
+        self._expect(',')
+      self._first = False
+      item = self._value()
+      if self._kept is not None:
+        self._kept.append(item)
+      return True, item
+    while self._state == 'fields':
+      if self._peek() == '}':
+        self._pos += 1
+        self._state = 'done'
+        # Read on to the end, so the connection is released.
+        while self._fill():
+          pass
+        self._end_phase()
+        if self._on_done is not None:
+          value = dict(self._fields)
+          if self._has_items:
+            value['items'] = self._kept
+          self._on_done(value)
+        break
+      if not self._first:
+        self._expect(',')
+      self._first = False
+      key = self._value()
+      self._expect(':')
+      if key == 'items' and self._peek() == '[':
+        self._pos += 1
+        self._state = 'items'
+        self._has_items = True
+        self._first = True
+        return self._next()
+      self._fields[key] = self._value()
+    return False, None
+
+  def _read_until(self, key):
+    """Decodes on until key has been seen or the body is done."""
+    while (key not in self._fields and self._state != 'done' and
+           not (key == 'items' and self._has_items)):
+      more, item = self._next()
+      if more:
+        self._read_ahead.append(item)
+
+  def __iter__(self):
+    if self._iterated:
+      raise ValueError('The items of an ItemStream can only be read once.')
+    self._iterated = True
+    while True:
+      # Items may be read ahead at any point, to get at a later field.
+      if self._read_ahead:
+        yield self._read_ahead.popleft()
+        continue
+      more, item = self._next()
+      if not more:
+        break
+      yield item
+
+  def __getitem__(self, key):
+    self._read_until(key)
+    if key == 'items' and self._has_items:
+      return list(self)
+    return self._fields[key]
+
+  def __contains__(self, key):
+    self._read_until(key)
+    return key in self._fields or (key == 'items' and self._has_items)
+
+  def get(self, key, default=None):
+    """Returns the top-level field key, or default if there is none."""
+    self._read_until(key)
+    return self._fields.get(key, default)
+
+  def close(self):
+    """Abandons the rest of the body."""
+    if self._state != 'done':
+      self._state = 'done'
+      self._body.close()
+      self._end_phase()
+
+  def _end_phase(self):
+    """Ends the 'deserialize' phase, if one was started."""
+    if self._deserializing is not None:
+      self._deserializing.set(bytes=self._bytes)
+      self._deserializing.__exit__(None, None, None)
+      self._deserializing = None
+
+
 class JsonModel(BaseModel):
   """Model class for JSON.
 
@@ -257,8 +494,13 @@ class JsonModel(BaseModel):
     return simplejson.dumps(body_value)
 
   def deserialize(self, content):
-    content = content.decode('utf-8')
-    body = simplejson.loads(content)
+    if isinstance(content, httplib2.StreamingBody):
+      if not self._data_wrapper:
+        return ItemStream(content)
+      content = content.read()
+    with httplib2.phase('deserialize', bytes=len(content)):
+      content = content.decode('utf-8')
+      body = simplejson.loads(content)
     if self._data_wrapper and isinstance(body, dict) and 'data' in body:
       body = body['data']
     return body
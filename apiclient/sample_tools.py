@@ -22,16 +22,64 @@ __all__ = ['init']
 
 
 import argparse
+import datetime
 import httplib2
 import os
+import sys
+import threading
 
 from apiclient import discovery
 from oauth2client import client
 from oauth2client import file
 from oauth2client import tools
 
+# Refresh the access token during a parallel init if it expires within this
+# long, rather than letting the first API call do it.
+REFRESH_MARGIN = datetime.timedelta(minutes=5)
 
-def init(argv, name, version, doc, filename, scope=None, parents=[]):
+
+def _run_concurrently(*tasks):
+  """Runs each of the callables in its own thread and waits for all of them.
+
+  Returns:
+    A list of the values returned by the callables, in the same order.
+
+  Raises:
+    The first exception, in task order, raised by any of the callables.
+  """
+  results = [None] * len(tasks)
+  errors = [None] * len(tasks)
+
+  def runner(i, task):
+    try:
+      results[i] = task()
+    except Exception:
+      errors[i] = sys.exc_info()
+
+  threads = [threading.Thread(target=runner, args=(i, task))
+             for i, task in enumerate(tasks)]
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+  for thread in threads:
+    thread.join()
+  for error in errors:
+    if error is not None:
+      raise error[0], error[1], error[2]
+  return results
+
+
+def _refresh_if_expiring(credentials):
+  """Refreshes credentials that have no access token or will expire soon."""
+  expiry = getattr(credentials, 'token_expiry', None)
+  if (getattr(credentials, 'access_token', True) is None or
+      (expiry and expiry - REFRESH_MARGIN <= datetime.datetime.utcnow())):
+    # A transport of its own, since the other tasks use theirs concurrently.
+    credentials.refresh(httplib2.Http())
+
+
+def init(argv, name, version, doc, filename, scope=None, parents=[],
+         requestBuilder=None, parallel=False, cache=None):
   """A common initialization routine for samples.
 
   Many of the sample applications do the same initialization, which has now
@@ -49,6 +97,16 @@ def init(argv, name, version, doc, filename, scope=None, parents=[]):
     file: string, filename of the application. Usually set to __file__.
     parents: list of argparse.ArgumentParser, additional command-line flags.
     scope: string, The OAuth scope used.
+    requestBuilder: class or callable that instantiates an
+      apiclient.HttpRequest, passed on to discovery.build(). None uses the
+      default.
+    parallel: bool, if True, opening the connection to the API host, fetching
+      the discovery document and refreshing an access token that is about to
+      expire all run at the same time, so startup takes as long as the
+      slowest of them rather than their sum.
+    cache: httplib2 cache object, such as httplib2.BoundedFileCache, used
+      for the discovery document so that it only needs revalidating. Only
+      used when parallel is True.
 
   Returns:
     A tuple of (service, flags), where service is the service object and flags
@@ -89,6 +147,23 @@ def init(argv, name, version, doc, filename, scope=None, parents=[]):
     credentials = tools.run_flow(flow, storage, flags)
   http = credentials.authorize(http = httplib2.Http())
 
-  # Construct a service object via the discovery service.
-  service = discovery.build(name, version, http=http)
+  build_args = {}
+  if requestBuilder is not None:
+    build_args['requestBuilder'] = requestBuilder
+
+  if not parallel:
+    # Construct a service object via the discovery service.
+    service = discovery.build(name, version, http=http, **build_args)
+    return (service, flags)
+
+  # Each task gets its own transport, httplib2.Http not being thread-safe;
+  # only the preconnect touches http, leaving a warm connection in its pool.
+  discovery_http = httplib2.Http(cache=cache)
+  document, _, _ = _run_concurrently(
+      lambda: discovery._retrieve_discovery_doc(
+          name, version, discovery_http, discovery.DISCOVERY_URI),
+      lambda: http.preconnect(discovery.DISCOVERY_URI),
+      lambda: _refresh_if_expiring(credentials))
+  service = discovery.build_from_document(
+      document, base=discovery.DISCOVERY_URI, http=http, **build_args)
   return (service, flags)
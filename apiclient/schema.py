@@ -16,7 +16,8 @@
 
 Schemas holds an APIs discovery schemas. It can return those schema as
 deserialized JSON objects, or pretty print them as prototype objects that
-conform to the schema.
+conform to the schema. It also checks partial response field masks, the
+values of the 'fields' parameter, against them.
 
 For example, given the schema:
 
@@ -62,10 +63,17 @@ The constructor takes a discovery document in which to look up named schema.
 __author__ = 'jcgregorio@google.com (Joe Gregorio)'
 
 import copy
+import re
 
 from oauth2client import util
 from oauth2client.anyjson import simplejson
 
+# The tokens of a partial response field mask: names and punctuation.
+_FIELDS_TOKEN = re.compile(r'\s*([^,/()\s]+|[,/()])\s*')
+
+# Types whose values have no fields.
+_SCALAR_TYPES = frozenset(['string', 'integer', 'number', 'boolean', 'null'])
+
 
 class Schemas(object):
   """Schemas for an API."""
@@ -163,6 +171,124 @@ class Schemas(object):
     """
     return self.schemas[name]
 
+  def unknownFields(self, schema, fields):
+    """Get the fields named by a partial response field mask that aren't in
+    a schema.
+
+    Args:
+      schema: object, Parsed JSON schema, such as a method's 'response'.
+      fields: string, Field mask in the syntax of the 'fields' parameter, for
+        example 'items(id,start/date),nextPageToken'.
+
+    Returns:
+      list of string, The paths of the fields not in the schema, for example
+        'items/nmae', or an empty list if there are none.
+
+    Raises:
+      ValueError if fields is not a well-formed field mask.
+    """
+    unknown = []
+    self._checkMask(schema, parseFields(fields), '', unknown)
+    return unknown
+
+  def _checkMask(self, schema, mask, prefix, unknown):
+    """Add the paths in mask that schema doesn't have to the list unknown."""
+    while '$ref' in schema or schema.get('type') == 'array':
+      if '$ref' in schema:
+        schema = self.schemas.get(schema['$ref'], {})
+      else:
+        schema = schema.get('items', {})
+    properties = schema.get('properties')
+    additional = schema.get('additionalProperties')
+    for name, submask in sorted(mask.iteritems()):
+      if name == '*':
+        continue
+      if properties is not None and name in properties:
+        field = properties[name]
+      elif additional is not None:
+        field = additional
+      elif properties is None and schema.get('type') not in _SCALAR_TYPES:
+        # Nothing is known about the fields of this object.
+        continue
+      else:
+        unknown.append(prefix + name)
+        continue
+      if submask is not None:
+        self._checkMask(field, submask, prefix + name + '/', unknown)
+
+
+def parseFields(fields):
+  """Parse a partial response field mask.
+
+  Args:
+    fields: string, Field mask in the syntax of the 'fields' parameter, for
+      example 'items(id,start/date),nextPageToken'.
+
+  Returns:
+    dict, Mapping each field selected at the top level to a dict of the same
+      form for the fields selected within it, or to None if all of it is.
+
+  Raises:
+    ValueError if fields is not a well-formed field mask.
+  """
+  pos = 0
+  tokens = []
+  while pos < len(fields):
+    match = _FIELDS_TOKEN.match(fields, pos)
+    if match is None:
+      raise ValueError('Malformed field mask "%s"' % fields)
+    tokens.append(match.group(1))
+    pos = match.end()
+  mask, i = _parseMask(tokens, 0, fields)
+  if i < len(tokens):
+    raise ValueError('Unexpected "%s" in field mask "%s"' % (tokens[i], fields))
+  return mask
+
+
+def _parseMask(tokens, i, fields):
+  """Parse the comma separated selections starting at tokens[i].
+
+  Returns:
+    (mask, index of the first token after them).
+  """
+  mask = {}
+  while True:
+    path = []
+    while True:
+      if i >= len(tokens) or tokens[i] in ',/()':
+        raise ValueError('Expected a field name in field mask "%s"' % fields)
+      path.append(tokens[i])
+      i += 1
+      if i < len(tokens) and tokens[i] == '/':
+        i += 1
+      else:
+        break
+    submask = None
+    if i < len(tokens) and tokens[i] == '(':
+      submask, i = _parseMask(tokens, i + 1, fields)
+      if i >= len(tokens) or tokens[i] != ')':
+        raise ValueError('Unbalanced "(" in field mask "%s"' % fields)
+      i += 1
+    for name in reversed(path[1:]):
+      submask = {name: submask}
+    _mergeMask(mask, path[0], submask)
+    if i < len(tokens) and tokens[i] == ',':
+      i += 1
+    else:
+      return mask, i
+
+
+def _mergeMask(mask, name, submask):
+  """Add the selection of submask within field name to mask."""
+  if name not in mask:
+    mask[name] = submask
+  elif mask[name] is None or submask is None:
+    # All of the field is selected.
+    mask[name] = None
+  else:
+    for subname, subsubmask in submask.iteritems():
+      _mergeMask(mask[name], subname, subsubmask)
+
 
 class _SchemaToStruct(object):
   """Convert schema to a prototype object."""
@@ -0,0 +1,128 @@
+"""Recording of request phase timings.
+
+The HTTP stack reports the phases each request goes through, such as the DNS
+lookup, TLS handshake, waiting for the first byte, token refresh, retry
+backoff and JSON decoding, to the hooks registered with
+httplib2.add_phase_hook(). PhaseRecorder is such a hook that writes them out.
+
+Example:
+
+  recorder = PhaseRecorder(open('trace.jsonl', 'w'))
+  recorder.install()
+  try:
+    service.events().list(calendarId='primary').execute()
+  finally:
+    recorder.uninstall()
+  recorder.write_summary(sys.stderr)
+"""
+
+__all__ = ['PhaseRecorder']
+
+import httplib2
+import math
+import threading
+
+from oauth2client.anyjson import simplejson
+
+# Percentiles reported by PhaseRecorder.summary().
+SUMMARY_PERCENTILES = (50, 90, 99)
+
+
+def _percentile(ordered, percent):
+  """Nearest-rank percentile of an already sorted, non-empty list."""
+  rank = int(math.ceil(percent / 100.0 * len(ordered))) - 1
+  return ordered[max(0, rank)]
+
+
+class PhaseRecorder(object):
+  """Records the phases reported to httplib2's phase hooks.
+
+  Phases that start while another is running on the same thread are nested
+  inside it. When an outermost phase ends, such as the 'execute' of an API
+  call, it is written to fd as one line of JSON holding its nested phases,
+  each with its offset from the start of its parent and its duration in
+  milliseconds. Durations are also kept per phase name for summary().
+
+  The body of a response executed with stream=True is read after its
+  'execute' has ended, so its 'deserialize', with the 'body' inside it, is
+  written on a line of its own once the body has been read or closed.
+  """
+
+  def __init__(self, fd=None):
+    """Constructor.
+
+    Args:
+      fd: file-like object, where to write a JSON line per outermost phase,
+        or None to only keep the durations.
+    """
+    self._fd = fd
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    self._durations = {}
+
+  def install(self):
+    """Starts recording."""
+    httplib2.add_phase_hook(self)
+
+  def uninstall(self):
+    """Stops recording."""
+    httplib2.remove_phase_hook(self)
+
+  def __call__(self, event, name, when, info):
+    stack = getattr(self._local, 'stack', None)
+    if stack is None:
+      stack = self._local.stack = []
+    if event == 'start':
+      stack.append({'phase': name, 'start': when, 'phases': []})
+      return
+
+    # Unwind to the phase that ended, in case an inner one never reported.
+    while stack:
+      entry = stack.pop()
+      if entry['phase'] == name:
+        break
+    else:
+      return
+    ms = (when - entry['start']) * 1000
+    entry['ms'] = round(ms, 3)
+    if info:
+      entry['info'] = dict((k, v if isinstance(v, (int, long, float, bool))
+                            else unicode(v))
+                           for k, v in info.iteritems() if v is not None)
+    if not entry['phases']:
+      del entry['phases']
+
+    with self._lock:
+      self._durations.setdefault(name, []).append(ms)
+      if stack:
+        parent = stack[-1]
+        entry['offset_ms'] = round((entry['start'] - parent['start']) * 1000, 3)
+        del entry['start']
+        parent['phases'].append(entry)
+      elif self._fd is not None:
+        self._fd.write(simplejson.dumps(entry, sort_keys=True) + '\n')
+
+  def summary(self):
+    """Summarizes the durations recorded for each phase.
+
+    Returns:
+      A list of (name, count, percentiles, max) tuples sorted by name, where
+      percentiles is a list of the SUMMARY_PERCENTILES of the durations, and
+      all durations are in milliseconds.
+    """
+    with self._lock:
+      durations = dict((k, sorted(v)) for k, v in self._durations.iteritems())
+    return [(name, len(ordered),
+             [_percentile(ordered, p) for p in SUMMARY_PERCENTILES],
+             ordered[-1])
+            for name, ordered in sorted(durations.iteritems())]
+
+  def write_summary(self, fd):
+    """Writes summary() to fd as a table."""
+    fd.write('%-12s %6s %s %9s\n' % (
+        'phase', 'count',
+        ' '.join('%9s' % ('p%d ms' % p) for p in SUMMARY_PERCENTILES),
+        'max ms'))
+    for name, count, percentiles, longest in self.summary():
+      fd.write('%-12s %6d %s %9.1f\n' % (
+          name, count, ' '.join('%9.1f' % ms for ms in percentiles), longest))
@@ -0,0 +1,959 @@
+#!/usr/bin/python -B
+# -*- coding: utf-8 -*-
+
+"""
+Local stand-in for the Google Calendar v3 API
+
+Serves the routes triage.py uses, from an in-memory calendar, so that it can
+be measured without touching the real one:
+
+  GET    /discovery/v1/apis/calendar/v3/rest    discovery document
+  GET    /calendar/v3/calendars/CALID/events    list (q, timeMin, timeMax,
+                                                maxResults, pageToken,
+                                                syncToken, showDeleted)
+  POST   /calendar/v3/calendars/CALID/events    insert
+  GET    /calendar/v3/calendars/CALID/events/ID get
+  PATCH  /calendar/v3/calendars/CALID/events/ID patch
+  PUT    /calendar/v3/calendars/CALID/events/ID update, which also restores a
+                                                deleted event
+  DELETE /calendar/v3/calendars/CALID/events/ID delete
+  POST   /calendar/v3/calendars/CALID/events/watch
+                                                open a webhook channel
+  POST   /calendar/v3/channels/stop             stop one
+  POST   /batch                                 batch of any of the above
+
+Each response is delayed by --latency (plus up to --jitter) milliseconds,
+and a --error-rate fraction of requests get a 503 and a --throttle-rate
+fraction a 403 rateLimitExceeded.  List pages carry an ETag and honour
+If-None-Match.  Webhook channels get a "sync" notification when opened and
+an "exists" one after each change to their calendar, a --duplicate-rate
+fraction of them twice, as the real service may.  Every route honours a
+partial response "fields" mask.  Recurring all-day events (daily or weekly
+RRULEs) are expanded into their instances when listed with singleEvents,
+and patching or deleting an instance makes it an exception to its series.
+Exceptions are dropped along with their series, or when a change to its
+recurrence leaves them out.  Lists may be filtered on private extended
+properties with privateExtendedProperty=NAME=VALUE, each of which must match.
+Two extra routes control a running server:
+
+  POST   /_reset?events=N&calendarId=CALID      replace the data set
+  GET    /_stats                                request counts since reset,
+                                                notifications queued, sent
+                                                and sent twice, and open
+                                                channels
+
+Usage:
+  $ bench/calendar_server.py --port 8080 --events 1000
+
+To build a service object against it:
+
+  service = discovery.build('calendar', 'v3', http=httplib2.Http(),
+      discoveryServiceUrl=server.url + DISCOVERY_PATH)
+"""
+
+import sys
+import argparse
+import BaseHTTPServer
+import SocketServer
+import datetime
+import hashlib
+import itertools
+import json
+import os.path
+import random
+import re
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+import uuid
+from Queue import Queue
+from collections import OrderedDict
+from email.parser import FeedParser
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOP_DIR)
+
+from apiclient.schema import parseFields
+
+DISCOVERY_PATH = "/discovery/v1/apis/{api}/{apiVersion}/rest"
+SERVICE_PATH = "calendar/v3/"
+BATCH_PATH = "/batch"
+
+DEFAULT_CALENDAR_ID = "bench@group.calendar.google.com"
+
+# the data set starts here, with up to this many weeks of events
+DATASET_START = datetime.date(2000, 1, 3)  # a Monday
+DATASET_WEEKS = 1500
+
+DEFAULT_PAGE_SIZE = 250
+MAX_PAGE_SIZE = 2500
+
+# lifetime of webhook channels, by default and at most, in milliseconds
+WATCH_TTL_MS = 7 * 24 * 3600 * 1000
+MAX_WATCH_TTL_MS = 30 * 24 * 3600 * 1000
+
+# occurrences a recurring event with no COUNT or UNTIL is expanded to
+MAX_INSTANCES = 730
+
+# who the stand-in's events were created by
+BENCH_USER = "bench@example.com"
+
+NAMES = ["Alice", "Bob", "Carol", "Dave", "Erin", "Frank", "Grace", "Heidi"]
+
+def object_schema(schema_id, **properties):
+    return {"id": schema_id, "type": "object", "properties": properties}
+
+STRING = {"type": "string"}
+PERSON = {"type": "object", "properties": {
+    "email": STRING, "displayName": STRING, "self": {"type": "boolean"}}}
+EVENT_DATE_TIME_SCHEMA = object_schema("EventDateTime",
+    date=STRING, dateTime=STRING, timeZone=STRING)
+EVENT_SCHEMA = object_schema("Event",
+    kind=STRING, etag=STRING, id=STRING, status=STRING, htmlLink=STRING,
+    created=STRING, updated=STRING, summary=STRING, description=STRING,
+    location=STRING, creator=PERSON, organizer=PERSON,
+    start={"$ref": "EventDateTime"}, end={"$ref": "EventDateTime"},
+    transparency=STRING, iCalUID=STRING, sequence={"type": "integer"},
+    recurrence={"type": "array", "items": STRING}, recurringEventId=STRING,
+    originalStartTime={"$ref": "EventDateTime"},
+    extendedProperties={"type": "object", "properties": {
+        "private": {"type": "object", "additionalProperties": STRING},
+        "shared": {"type": "object", "additionalProperties": STRING}}},
+    attendees={"type": "array", "items": PERSON},
+    reminders={"type": "object", "properties": {
+        "useDefault": {"type": "boolean"}}})
+CHANNEL_SCHEMA = object_schema("Channel",
+    kind=STRING, id=STRING, resourceId=STRING, resourceUri=STRING,
+    token=STRING, expiration=STRING, type=STRING, address=STRING)
+EVENTS_SCHEMA = object_schema("Events",
+    kind=STRING, etag=STRING, summary=STRING, updated=STRING,
+    items={"type": "array", "items": {"$ref": "Event"}},
+    nextPageToken=STRING, nextSyncToken=STRING)
+
+def event_methods():
+    calendar_id = {"type": "string", "required": True, "location": "path"}
+    event_id = {"type": "string", "required": True, "location": "path"}
+    query = lambda kind, **extra: dict(type=kind, location="query", **extra)
+    path = "calendars/{calendarId}/events"
+    return {
+        "list": {
+            "id": "calendar.events.list", "path": path, "httpMethod": "GET",
+            "parameters": {
+                "calendarId": calendar_id,
+                "q": query("string"),
+                "timeMin": query("string"),
+                "timeMax": query("string"),
+                "maxResults": query("integer"),
+                "pageToken": query("string"),
+                "syncToken": query("string"),
+                "showDeleted": query("boolean"),
+                "singleEvents": query("boolean"),
+                "orderBy": query("string"),
+                "privateExtendedProperty": query("string", repeated=True),
+            },
+            "parameterOrder": ["calendarId"],
+            "response": {"$ref": "Events"},
+        },
+        "insert": {
+            "id": "calendar.events.insert", "path": path,
+            "httpMethod": "POST",
+            "parameters": {"calendarId": calendar_id},
+            "parameterOrder": ["calendarId"],
+            "request": {"$ref": "Event"},
+            "response": {"$ref": "Event"},
+        },
+        "get": {
+            "id": "calendar.events.get", "path": path + "/{eventId}",
+            "httpMethod": "GET",
+            "parameters": {"calendarId": calendar_id, "eventId": event_id},
+            "parameterOrder": ["calendarId", "eventId"],
+            "response": {"$ref": "Event"},
+        },
+        "patch": {
+            "id": "calendar.events.patch", "path": path + "/{eventId}",
+            "httpMethod": "PATCH",
+            "parameters": {"calendarId": calendar_id, "eventId": event_id},
+            "parameterOrder": ["calendarId", "eventId"],
+            "request": {"$ref": "Event"},
+            "response": {"$ref": "Event"},
+        },
+        "update": {
+            "id": "calendar.events.update", "path": path + "/{eventId}",
+            "httpMethod": "PUT",
+            "parameters": {"calendarId": calendar_id, "eventId": event_id},
+            "parameterOrder": ["calendarId", "eventId"],
+            "request": {"$ref": "Event"},
+            "response": {"$ref": "Event"},
+        },
+        "delete": {
+            "id": "calendar.events.delete", "path": path + "/{eventId}",
+            "httpMethod": "DELETE",
+            "parameters": {"calendarId": calendar_id, "eventId": event_id},
+            "parameterOrder": ["calendarId", "eventId"],
+        },
+        "watch": {
+            "id": "calendar.events.watch", "path": path + "/watch",
+            "httpMethod": "POST",
+            "parameters": {"calendarId": calendar_id},
+            "parameterOrder": ["calendarId"],
+            "request": {"$ref": "Channel"},
+            "response": {"$ref": "Channel"},
+        },
+    }
+
+def channel_methods():
+    return {
+        "stop": {
+            "id": "calendar.channels.stop", "path": "channels/stop",
+            "httpMethod": "POST",
+            "request": {"$ref": "Channel"},
+        },
+    }
+
+def discovery_document(root_url):
+    """
+    enough of the Calendar v3 discovery document for the routes served here
+    """
+    string_query = {"type": "string", "location": "query"}
+    return {
+        "kind": "discovery#restDescription",
+        "discoveryVersion": "v1",
+        "id": "calendar:v3",
+        "name": "calendar",
+        "version": "v3",
+        "rootUrl": root_url,
+        "servicePath": SERVICE_PATH,
+        "batchPath": BATCH_PATH.lstrip("/"),
+        "parameters": {
+            "alt": dict(string_query, default="json"),
+            "fields": string_query,
+            "key": string_query,
+            "quotaUser": string_query,
+            "userIp": string_query,
+            "prettyPrint": {"type": "boolean", "location": "query"},
+        },
+        "schemas": {"Event": EVENT_SCHEMA, "Events": EVENTS_SCHEMA,
+                    "EventDateTime": EVENT_DATE_TIME_SCHEMA,
+                    "Channel": CHANNEL_SCHEMA},
+        "resources": {"events": {"methods": event_methods()},
+                      "channels": {"methods": channel_methods()}},
+    }
+
+def d2s(d):
+    return "%04d-%02d-%02d" % (d.year, d.month, d.day)
+
+def now_rfc3339():
+    return datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+def event_start(event):
+    start = event.get("start", {})
+    return start.get("date") or start.get("dateTime") or ""
+
+def s2date(s):
+    return datetime.datetime.strptime(s[:10], "%Y-%m-%d").date()
+
+def occurrences(event):
+    """
+    start dates of a recurring all-day event, from its daily or weekly
+    RRULE, or [] if it isn't one
+    """
+    rules = [rule[len("RRULE:"):] for rule in event.get("recurrence", [])
+             if rule.startswith("RRULE:")]
+    if not rules or "date" not in event.get("start", {}):
+        return []
+    parts = dict(part.split("=", 1) for part in rules[0].split(";")
+                 if "=" in part)
+    step = {"DAILY": 1, "WEEKLY": 7}.get(parts.get("FREQ"))
+    if step is None:
+        return []
+    step = datetime.timedelta(step * int(parts.get("INTERVAL", 1)))
+    count = min(int(parts.get("COUNT", MAX_INSTANCES)), MAX_INSTANCES)
+    until = parts.get("UNTIL", "")[:8]
+    date = s2date(event["start"]["date"])
+    dates = []
+    while len(dates) < count and not (until and
+                                      date.strftime("%Y%m%d") > until):
+        dates.append(date)
+        date += step
+    return dates
+
+def instance_id(event_id, date):
+    return "%s_%s" % (event_id, date.strftime("%Y%m%d"))
+
+def event_end(event):
+    end = event.get("end", {})
+    return end.get("date") or end.get("dateTime") or ""
+
+def select_fields(value, mask):
+    """
+    the parts of a response body that a parsed field mask selects
+    """
+    if isinstance(value, list):
+        return [select_fields(x, mask) for x in value]
+    if not isinstance(value, dict):
+        return value
+    result = {}
+    for key in value if "*" in mask else mask:
+        if key in value:
+            submask = mask.get(key, mask.get("*"))
+            result[key] = (value[key] if submask is None
+                           else select_fields(value[key], submask))
+    return result
+
+def error_body(status, reason, message):
+    return {"error": {"errors": [{"domain": "global", "reason": reason,
+                                  "message": message}],
+                      "code": status, "message": message}}
+
+
+class CalendarStore(object):
+    """
+    the events of every stand-in calendar, with a change sequence number
+    that sync tokens and list ETags are made from
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self, events=0, calendar_id=DEFAULT_CALENDAR_ID):
+        with self.lock:
+            self.calendars = {}
+            self.seq = 0
+            self.ids = itertools.count(1)
+            self._listing = (None, None)
+            calendar = self.calendar(calendar_id)
+            per_week = max(1, -(-events // DATASET_WEEKS))
+            for i in range(events):
+                monday = DATASET_START + datetime.timedelta(7 * (i // per_week))
+                name = NAMES[i % len(NAMES)]
+                self.add(calendar, {
+                    "summary": "Triage: %s" % name,
+                    "start": {"date": d2s(monday)},
+                    "end": {"date": d2s(monday + datetime.timedelta(5))},
+                    "transparency": "transparent",
+                    "extendedProperties": {"private": {"triage": "osg",
+                                                       "assignee": name}},
+                })
+
+    def calendar(self, calendar_id):
+        return self.calendars.setdefault(calendar_id, OrderedDict())
+
+    def add(self, calendar, body, event_id=None):
+        self.seq += 1
+        event_id = event_id or "ev%08d" % next(self.ids)
+        event = dict(body)
+        event.update({
+            "kind": "calendar#event",
+            "id": event_id,
+            "status": "confirmed",
+            "htmlLink": "https://calendar.example/event?eid=" + event_id,
+            "created": now_rfc3339(),
+            "updated": now_rfc3339(),
+            "sequence": 0,
+            "etag": '"%d"' % self.seq,
+            "_seq": self.seq,
+        })
+        # what the real service adds to every event
+        event.setdefault("iCalUID", event_id + "@google.com")
+        event.setdefault("creator", {"email": BENCH_USER})
+        event.setdefault("organizer", {"email": DEFAULT_CALENDAR_ID,
+                                       "displayName": "OSG Triage",
+                                       "self": True})
+        event.setdefault("reminders", {"useDefault": True})
+        calendar[event_id] = event
+        return event
+
+    def instance(self, event, date):
+        """
+        the occurrence on date of recurring event, as an event of its own
+        """
+        length = s2date(event_end(event)) - s2date(event_start(event))
+        instance = dict((k, v) for k, v in event.iteritems()
+                        if k != "recurrence")
+        instance.update({
+            "id": instance_id(event["id"], date),
+            "recurringEventId": event["id"],
+            "originalStartTime": {"date": d2s(date)},
+            "start": {"date": d2s(date)},
+            "end": {"date": d2s(date + length)},
+        })
+        return instance
+
+    def lookup(self, calendar, event_id):
+        """
+        the event event_id, which may be an instance of a recurring one
+        that hasn't been made an exception, or None
+        """
+        event = calendar.get(event_id)
+        m = re.match(r"^(.+)_(\d{8})$", event_id)
+        if event is None and m is not None and m.group(1) in calendar:
+            recurring = calendar[m.group(1)]
+            date = datetime.datetime.strptime(m.group(2), "%Y%m%d").date()
+            if date in occurrences(recurring):
+                event = self.instance(recurring, date)
+        return event
+
+    def make_exception(self, calendar, instance):
+        """
+        store an instance, so that it can differ from its series
+        """
+        body = dict((k, v) for k, v in instance.iteritems()
+                    if k not in ("id", "etag", "_seq"))
+        return self.add(calendar, body, instance["id"])
+
+    def touch(self, event):
+        self.seq += 1
+        event["updated"] = now_rfc3339()
+        event["etag"] = '"%d"' % self.seq
+        event["_seq"] = self.seq
+
+    def matching(self, calendar_id, params):
+        """
+        ids of the events a list request selects, in order; the last one
+        is cached, since paging repeats it for every page
+        """
+        key = (calendar_id, self.seq, tuple(sorted(params.items())))
+        if self._listing[0] == key:
+            return self._listing[1]
+
+        calendar = self.calendar(calendar_id)
+        sync = params.get("syncToken")
+        q = params.get("q", "").lower()
+        private = [tuple(p.split("=", 1)) for p in
+                   params.get("privateExtendedProperty", ()) if "=" in p]
+        time_min = params.get("timeMin")
+        time_max = params.get("timeMax")
+        show_deleted = params.get("showDeleted") == "true" or sync
+        single = params.get("singleEvents") == "true" and not sync
+
+        def selected(event):
+            if q and q not in event.get("summary", "").lower():
+                return False
+            properties = event.get("extendedProperties", {}).get("private", {})
+            if any(properties.get(k) != v for k, v in private):
+                return False
+            if time_min and event_end(event)[:len(time_min)] <= \
+                    time_min[:len(event_end(event))]:
+                return False
+            if time_max and event_start(event)[:len(time_max)] >= \
+                    time_max[:len(event_start(event))]:
+                return False
+            return True
+
+        ids = []
+        for event_id, event in calendar.iteritems():
+            if sync is not None:
+                if event["_seq"] <= int(sync):
+                    continue
+            elif event["status"] == "cancelled" and not show_deleted:
+                continue
+            series = calendar.get(event.get("recurringEventId"))
+            if series is not None and not show_deleted and (
+                    series["status"] == "cancelled" or
+                    s2date(event["originalStartTime"]["date"])
+                    not in occurrences(series)):
+                # of a deleted series, or one changed to leave it out
+                continue
+            if single and event.get("recurrence"):
+                # exceptions are listed on their own
+                ids.extend(i for i in (instance_id(event_id, date)
+                                       for date in occurrences(event))
+                           if i not in calendar
+                           and selected(self.lookup(calendar, i)))
+            elif selected(event):
+                ids.append(event_id)
+        self._listing = (key, ids)
+        return ids
+
+
+class NotificationSender(object):
+    """
+    the webhook channels opened on the stand-in calendars, and a background
+    thread that posts their notifications, in order
+    """
+
+    def __init__(self, root_url, duplicate_rate=0, random=random):
+        self.root_url = root_url
+        self.duplicate_rate = duplicate_rate
+        self.random = random
+        self.lock = threading.Lock()
+        self.channels = {}
+        self.queued = 0
+        self.sent = 0
+        self.duplicates = 0
+        self.queue = Queue()
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def watch(self, calendar_id, body):
+        """
+        open the channel described by body; returns its description
+        """
+        now_ms = int(time.time() * 1000)
+        expiration = int(body.get("expiration") or now_ms + WATCH_TTL_MS)
+        channel = {
+            "kind": "api#channel",
+            "id": body["id"],
+            "token": body.get("token"),
+            "address": body["address"],
+            "resourceId": uuid.uuid4().hex,
+            "resourceUri": "%s%scalendars/%s/events?alt=json" % (
+                self.root_url, SERVICE_PATH, urllib.quote(calendar_id)),
+            "expiration": str(min(expiration, now_ms + MAX_WATCH_TTL_MS)),
+            "_calendar": calendar_id,
+            "_number": 0,
+        }
+        with self.lock:
+            self.channels[channel["id"]] = channel
+            self.notify(channel, "sync")
+        return dict((k, v) for k, v in channel.items()
+                    if not k.startswith("_") and k != "address"
+                    and v is not None)
+
+    def stop(self, body):
+        with self.lock:
+            channel = self.channels.get(body.get("id"))
+            if channel is None or \
+                    channel["resourceId"] != body.get("resourceId"):
+                return False
+            del self.channels[channel["id"]]
+            return True
+
+    def changed(self, calendar_id):
+        now_ms = int(time.time() * 1000)
+        with self.lock:
+            for channel in self.channels.values():
+                if int(channel["expiration"]) <= now_ms:
+                    del self.channels[channel["id"]]
+                elif channel["_calendar"] == calendar_id:
+                    self.notify(channel, "exists")
+
+    def notify(self, channel, state):
+        channel["_number"] += 1
+        headers = {
+            "X-Goog-Channel-ID": channel["id"],
+            "X-Goog-Message-Number": str(channel["_number"]),
+            "X-Goog-Resource-State": state,
+            "X-Goog-Resource-ID": channel["resourceId"],
+            "X-Goog-Resource-URI": channel["resourceUri"],
+            "X-Goog-Channel-Expiration": time.strftime(
+                "%a, %d %b %Y %H:%M:%S GMT",
+                time.gmtime(int(channel["expiration"]) / 1000)),
+        }
+        if channel["token"]:
+            headers["X-Goog-Channel-Token"] = channel["token"]
+        self.queue.put((channel["address"], headers))
+        self.queued += 1
+        if self.random.random() < self.duplicate_rate:
+            self.queue.put((channel["address"], headers))
+            self.queued += 1
+            self.duplicates += 1
+
+    def run(self):
+        while True:
+            address, headers = self.queue.get()
+            try:
+                urllib2.urlopen(urllib2.Request(address, "", headers),
+                                timeout=10).read()
+            except (urllib2.URLError, IOError):
+                pass  # the real service retries, but gives up eventually
+            with self.lock:
+                self.sent += 1
+            self.queue.task_done()
+
+
+class StandIn(object):
+    """
+    the stand-in API: routes requests to the store, with the configured
+    latency and errors
+    """
+
+    def __init__(self, root_url, latency=0, jitter=0, error_rate=0,
+                 throttle_rate=0, duplicate_rate=0, seed=None):
+        self.root_url = root_url
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.store = CalendarStore()
+        self.sender = NotificationSender(root_url, duplicate_rate,
+                                         random.Random(seed))
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats = {"requests": 0, "http_requests": 0, "batches": 0,
+                          "not_modified": 0, "errors": 0, "throttled": 0}
+
+    def count(self, name, n=1):
+        with self.stats_lock:
+            self.stats[name] += n
+
+    def delay(self):
+        ms = self.latency + self.random.random() * self.jitter
+        if ms > 0:
+            time.sleep(ms / 1000.0)
+
+    def handle(self, method, path, headers, body):
+        """
+        answer one HTTP request; returns (status, headers, body string)
+        """
+        self.count("http_requests")
+        self.delay()
+        parsed = urlparse.urlparse(path)
+        if parsed.path == BATCH_PATH and method == "POST":
+            self.count("batches")
+            return self.batch(headers, body)
+        return self.dispatch(method, path, headers, body)
+
+    def dispatch(self, method, path, headers, body):
+        parsed = urlparse.urlparse(path)
+        pairs = urlparse.parse_qsl(parsed.query)
+        params = dict(pairs)
+        if "privateExtendedProperty" in params:
+            # repeated, and each must match
+            params["privateExtendedProperty"] = tuple(sorted(
+                v for k, v in pairs if k == "privateExtendedProperty"))
+        route = parsed.path
+
+        if route == "/_stats":
+            with self.stats_lock, self.sender.lock:
+                return self.json(200, dict(self.stats,
+                    notifications_queued=self.sender.queued,
+                    notifications=self.sender.sent,
+                    duplicates=self.sender.duplicates,
+                    channels=len(self.sender.channels)))
+        if route == "/_reset" and method == "POST":
+            self.store.reset(int(params.get("events", 0)),
+                             params.get("calendarId", DEFAULT_CALENDAR_ID))
+            self.reset_stats()
+            return self.json(200, {})
+        if route == DISCOVERY_PATH.format(api="calendar", apiVersion="v3"):
+            return self.json(200, discovery_document(self.root_url))
+
+        self.count("requests")
+        roll = self.random.random()
+        if roll < self.error_rate:
+            self.count("errors")
+            return self.json(503, error_body(503, "backendError",
+                                             "Backend Error"))
+        if roll < self.error_rate + self.throttle_rate:
+            self.count("throttled")
+            return self.json(403, error_body(403, "rateLimitExceeded",
+                                             "Rate Limit Exceeded"))
+
+        try:
+            mask = parseFields(params["fields"]) if "fields" in params \
+                else None
+        except ValueError:
+            return self.json(400, error_body(400, "invalidParameter",
+                                             "Invalid field selection"))
+
+        if route == "/%schannels/stop" % SERVICE_PATH and method == "POST":
+            if self.sender.stop(json.loads(body or "{}")):
+                return (204, {}, "")
+            return self.json(404, error_body(404, "notFound",
+                             "Channel not found"))
+
+        m = re.match(r"^/%scalendars/([^/]+)/events(?:/([^/]+))?$"
+                     % SERVICE_PATH, route)
+        if m is None:
+            return self.json(404, error_body(404, "notFound", "Not Found"))
+        calendar_id = urllib.unquote(m.group(1))
+        event_id = m.group(2) and urllib.unquote(m.group(2))
+
+        if event_id == "watch" and method == "POST":
+            return self.json(200, self.sender.watch(calendar_id,
+                                                    json.loads(body or "{}")),
+                             mask=mask)
+        with self.store.lock:
+            if event_id is None and method == "GET":
+                return self.list(calendar_id, params, headers, mask)
+            if event_id is None and method == "POST":
+                result = self.insert(calendar_id, body, mask)
+            elif event_id is not None and method in ("PATCH", "PUT",
+                                                     "DELETE"):
+                result = self.event(method, calendar_id, event_id, body, mask)
+            elif event_id is not None and method == "GET":
+                return self.event(method, calendar_id, event_id, body, mask)
+            else:
+                return self.json(405, error_body(405, "methodNotAllowed",
+                                                 "Method Not Allowed"))
+        if result[0] < 300:
+            self.sender.changed(calendar_id)
+        return result
+
+    def list(self, calendar_id, params, headers, mask=None):
+        if "syncToken" in params and ("q" in params or "timeMin" in params
+                                      or "timeMax" in params
+                                      or "privateExtendedProperty" in params):
+            return self.json(400, error_body(400, "invalid",
+                             "syncToken can't be combined with q, timeMin, "
+                             "timeMax or privateExtendedProperty"))
+        page_size = min(int(params.get("maxResults", DEFAULT_PAGE_SIZE)),
+                        MAX_PAGE_SIZE)
+        offset = int(params.get("pageToken", "p0")[1:])
+        selection = dict((k, v) for k, v in params.items()
+                         if k in ("q", "timeMin", "timeMax", "syncToken",
+                                  "showDeleted", "singleEvents",
+                                  "privateExtendedProperty"))
+
+        store = self.store
+        etag = 'W/"%s"' % hashlib.md5("%d %d %d %r" % (
+            store.seq, offset, page_size,
+            sorted(selection.items()))).hexdigest()
+        if headers.get("if-none-match") == etag:
+            self.count("not_modified")
+            return (304, {"etag": etag}, "")
+
+        ids = store.matching(calendar_id, selection)
+        calendar = store.calendar(calendar_id)
+        page = ids[offset:offset + page_size]
+        result = {
+            "kind": "calendar#events",
+            "etag": etag,
+            "summary": calendar_id,
+            "updated": now_rfc3339(),
+            "items": [self.public(store.lookup(calendar, i)) for i in page],
+        }
+        if offset + page_size < len(ids):
+            result["nextPageToken"] = "p%d" % (offset + page_size)
+        else:
+            result["nextSyncToken"] = str(store.seq)
+        return self.json(200, result, {"etag": etag}, mask)
+
+    def insert(self, calendar_id, body, mask=None):
+        try:
+            event = json.loads(body or "{}")
+        except ValueError:
+            return self.json(400, error_body(400, "parseError",
+                                             "Parse Error"))
+        calendar = self.store.calendar(calendar_id)
+        event_id = event.pop("id", None)
+        if event_id is not None and event_id in calendar:
+            return self.json(409, error_body(409, "duplicate",
+                             "The requested identifier already exists."))
+        event = self.store.add(calendar, event, event_id)
+        return self.json(200, self.public(event), mask=mask)
+
+    def event(self, method, calendar_id, event_id, body, mask=None):
+        calendar = self.store.calendar(calendar_id)
+        event = self.store.lookup(calendar, event_id)
+        if event is None:
+            return self.json(404, error_body(404, "notFound", "Not Found"))
+        if event["status"] == "cancelled" and method not in ("GET", "PUT"):
+            return self.json(410, error_body(410, "deleted",
+                                             "Resource has been deleted"))
+        if event_id not in calendar and method != "GET":
+            event = self.store.make_exception(calendar, event)
+        if method == "GET":
+            return self.json(200, self.public(event), mask=mask)
+        if method == "DELETE":
+            event["status"] = "cancelled"
+            self.store.touch(event)
+            return (204, {}, "")
+        try:
+            changes = json.loads(body or "{}")
+        except ValueError:
+            return self.json(400, error_body(400, "parseError",
+                                             "Parse Error"))
+        server_fields = ("id", "kind", "etag", "created", "updated",
+                         "htmlLink", "iCalUID", "creator", "organizer",
+                         "sequence", "recurringEventId", "originalStartTime")
+        if method == "PUT":
+            for key in event.keys():
+                if key not in server_fields and not key.startswith("_"):
+                    del event[key]
+            event.setdefault("status", "confirmed")
+        for key, value in changes.items():
+            if key not in server_fields:
+                event[key] = value
+        event["sequence"] += 1
+        self.store.touch(event)
+        return self.json(200, self.public(event), mask=mask)
+
+    def public(self, event):
+        return dict((k, v) for k, v in event.iteritems()
+                    if not k.startswith("_"))
+
+    def json(self, status, body, headers=None, mask=None):
+        if mask is not None and status < 300:
+            body = select_fields(body, mask)
+        headers = dict(headers or {})
+        headers["content-type"] = "application/json; charset=UTF-8"
+        return (status, headers, json.dumps(body))
+
+    def batch(self, headers, body):
+        """
+        answer a multipart/mixed batch, one application/http part per
+        request, the way the real batch endpoint does
+        """
+        parser = FeedParser()
+        parser.feed("content-type: %s\r\n\r\n" % headers.get("content-type"))
+        parser.feed(body)
+        message = parser.close()
+        if not message.is_multipart():
+            return self.json(400, error_body(400, "badRequest",
+                                             "Not a multipart batch"))
+
+        boundary = "batch_%s" % hashlib.md5(str(time.time())).hexdigest()
+        parts = []
+        for part in message.get_payload():
+            content_id = part["content-id"] or ""
+            if content_id.startswith("<"):
+                content_id = "<response-" + content_id[1:]
+            method, path, part_headers, part_body = self.parse_http(
+                part.get_payload())
+            status, resp_headers, resp_body = self.dispatch(
+                method, path, part_headers, part_body)
+            lines = ["HTTP/1.1 %d %s" % (
+                status, BaseHTTPServer.BaseHTTPRequestHandler.responses.get(
+                    status, ("",))[0])]
+            for key, value in resp_headers.items():
+                lines.append("%s: %s" % (key, value))
+            lines.append("content-length: %d" % len(resp_body))
+            parts.append("--%s\r\ncontent-type: application/http\r\n"
+                         "content-id: %s\r\n\r\n%s\r\n\r\n%s\r\n" % (
+                             boundary, content_id, "\r\n".join(lines),
+                             resp_body))
+        content = "".join(parts) + "--%s--\r\n" % boundary
+        return (200, {"content-type": "multipart/mixed; boundary=%s"
+                      % boundary}, content)
+
+    def parse_http(self, payload):
+        """
+        split an application/http request into (method, path, headers,
+        body)
+        """
+        split = re.split(r"\r?\n\r?\n", payload, 1)
+        head, body = split[0], (split[1] if len(split) > 1 else "")
+        lines = re.split(r"\r?\n", head)
+        method, path = lines[0].split(" ")[:2]
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                key, value = line.split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+        return method, path, headers, body
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # send each response in one write, rather than a packet per header
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def handle_any(self):
+        length = int(self.headers.get("content-length") or 0)
+        body = self.rfile.read(length) if length else ""
+        headers = dict((k.lower(), v) for k, v in self.headers.items())
+        status, resp_headers, content = self.server.standin.handle(
+            self.command, self.path, headers, body)
+        self.send_response(status)
+        for key, value in resp_headers.items():
+            self.send_header(key, value)
+        self.send_header("content-length", str(len(content)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_any
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                self, format, *args)
+
+
+class ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class CalendarServer(object):
+    """
+    a stand-in server running on a background thread
+
+      server = CalendarServer(events=1000, latency=20)
+      server.start()
+      ...
+      server.stop()
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, events=0,
+                 calendar_id=DEFAULT_CALENDAR_ID, verbose=False, **options):
+        self.httpd = ThreadingServer((host, port), Handler)
+        self.httpd.verbose = verbose
+        self.url = "http://%s:%d" % self.httpd.server_address[:2]
+        self.httpd.standin = StandIn(self.url + "/", **options)
+        self.httpd.standin.store.reset(events, calendar_id)
+        self.thread = None
+
+    @property
+    def standin(self):
+        return self.httpd.standin
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def argparse_setup():
+    ap = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    ap.add_argument('--host', default="127.0.0.1",
+        help="address to listen on (default: %(default)s)")
+    ap.add_argument('--port', type=int, default=8080,
+        help="port to listen on (default: %(default)s)")
+    ap.add_argument('--events', type=int, default=0, metavar='N',
+        help="number of triage events to start with")
+    ap.add_argument('--calendarId', default=DEFAULT_CALENDAR_ID,
+        metavar='CALID', help="calendar to put them in (default: "
+                              "%(default)s)")
+    ap.add_argument('--latency', type=float, default=0, metavar='MS',
+        help="delay every response by MS milliseconds")
+    ap.add_argument('--jitter', type=float, default=0, metavar='MS',
+        help="delay every response by up to MS more milliseconds")
+    ap.add_argument('--error-rate', type=float, default=0, metavar='F',
+        help="answer a fraction F of requests with 503")
+    ap.add_argument('--throttle-rate', type=float, default=0, metavar='F',
+        help="answer a fraction F of requests with 403 rateLimitExceeded")
+    ap.add_argument('--duplicate-rate', type=float, default=0, metavar='F',
+        help="send a fraction F of channel notifications twice")
+    ap.add_argument('--seed', type=int, default=None,
+        help="seed for latency jitter and errors")
+    ap.add_argument('--verbose', action='store_true', default=False,
+        help="log every request")
+
+    return ap
+
+def main(argv):
+    flags = argparse_setup().parse_args(argv[1:])
+    server = CalendarServer(flags.host, flags.port, flags.events,
+                            flags.calendarId, flags.verbose,
+                            latency=flags.latency, jitter=flags.jitter,
+                            error_rate=flags.error_rate,
+                            throttle_rate=flags.throttle_rate,
+                            duplicate_rate=flags.duplicate_rate,
+                            seed=flags.seed)
+    print "serving %d events on %s" % (flags.events, server.url)
+    sys.stdout.flush()
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main(sys.argv)
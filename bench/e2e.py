@@ -0,0 +1,356 @@
+#!/usr/bin/python -B
+# -*- coding: utf-8 -*-
+
+"""
+End-to-end benchmarks for triage.py
+
+Runs the triage.py actions against the local Calendar stand-in in
+bench/calendar_server.py, for calendars holding each of the given numbers of
+events, and reports the wall time, requests/sec and peak RSS of each.  The
+scenarios are:
+
+  list                  --list
+  load                  --load of a year of weekly assignments
+  load fanOut           the same --load, with --fanOut to 19 more calendars
+  loadRotation          --loadRotation of the same year
+  delete ALL            --delete ALL over a year of assignments
+  generateNextRotation  --generateNextRotation
+  watch                 serve --watch: --list twice, the second answered
+                        from the event cache, then a change made elsewhere;
+                        and a channel with a short ttl, renewed and stopped
+
+Requests are made as triage.py makes them, with its ETag cache, retry policy
+and quota limiter, so the inserts of the load scenarios go out at no more
+than triage.QUOTA_QPS: "load fanOut" makes 1040 of them and takes at least
+1040 / 5 = 208 seconds, however fast the stand-in answers.
+
+The server and each scenario run in processes of their own, so that the peak
+RSS of each scenario is its own, and each scenario starts from a freshly
+reset calendar.  The watch scenario fails unless the event cache is dropped
+on the "exists" notification of the change, each notification is acted on
+once however often it is delivered, the short-lived channel is replaced
+before it expires, and channels are stopped when the watch is.
+
+Usage:
+  $ bench/e2e.py                            # 10, 1000 and 100000 events
+  $ bench/e2e.py --sizes 10 1000 --latency 20 --scenario list
+  $ bench/e2e.py --sizes 10 --duplicate-rate 0.5 --scenario watch
+"""
+
+import sys
+import argparse
+import datetime
+import json
+import os
+import os.path
+import resource
+import socket
+import subprocess
+import time
+import urllib2
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+TOP_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, TOP_DIR)
+
+import calendar_server
+
+SCENARIOS = ["list", "load", "load fanOut", "loadRotation", "delete ALL",
+             "generateNextRotation", "watch"]
+DEFAULT_SIZES = [10, 1000, 100000]
+
+# number of weekly assignments loaded or deleted
+WEEKS = 52
+
+# calendars written to by "load fanOut", counting the first
+FAN_OUT = 20
+
+# lifetime and renewal margin of the short-lived channel of "watch"
+WATCH_TTL = datetime.timedelta(seconds=3)
+WATCH_RENEW_MARGIN = datetime.timedelta(seconds=2)
+
+# changes "watch" makes behind triage.py's back, each notified
+WATCH_CHANGES = 10
+
+# how long "watch" waits for a notification to arrive, in seconds
+WATCH_TIMEOUT = 10
+
+def argparse_setup():
+    ap = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    ap.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+        metavar='N', help="calendar sizes, in events (default: %s)"
+                          % " ".join(map(str, DEFAULT_SIZES)))
+    ap.add_argument('--scenario', action='append', choices=SCENARIOS,
+        help="run only this scenario (may be repeated)")
+    ap.add_argument('--latency', type=float, default=0, metavar='MS',
+        help="delay every response by MS milliseconds")
+    ap.add_argument('--jitter', type=float, default=0, metavar='MS',
+        help="delay every response by up to MS more milliseconds")
+    ap.add_argument('--error-rate', type=float, default=0, metavar='F',
+        help="answer a fraction F of requests with 503")
+    ap.add_argument('--throttle-rate', type=float, default=0, metavar='F',
+        help="answer a fraction F of requests with 403 rateLimitExceeded")
+    ap.add_argument('--duplicate-rate', type=float, default=0, metavar='F',
+        help="send a fraction F of channel notifications twice")
+    ap.add_argument('--json', action='store_true', default=False,
+        help="print results as JSON lines")
+
+    # internal: run one scenario against a server, in a worker process
+    ap.add_argument('--worker', nargs=2, metavar=('URL', 'SCENARIO'),
+        help=argparse.SUPPRESS)
+
+    return ap
+
+def build_service(url):
+    import httplib2
+    import osgtriage as triage
+    from apiclient import discovery
+    from apiclient.http import ETagCache
+
+    # as triage.py's own, but with the ETag cache in memory
+    return discovery.build('calendar', 'v3', http=httplib2.Http(),
+        discoveryServiceUrl=url + calendar_server.DISCOVERY_PATH,
+        requestBuilder=triage.request_builder(ETagCache()))
+
+def assignment_lines(start, weeks):
+    one_week = datetime.timedelta(7)
+    return ["%s: Bench %d\n" % (calendar_server.d2s(start + one_week * i), i)
+            for i in range(weeks)]
+
+def rotation_names():
+    import osgtriage as triage
+    return [line.strip() for line in open(triage.ROTATION_FILE)
+            if line.strip() and not line.startswith("#")]
+
+def run_scenario(service, url, scenario):
+    """
+    do what triage.py does for scenario, with the service already built
+    """
+    import osgtriage as triage
+
+    calId = calendar_server.DEFAULT_CALENDAR_ID
+    start = calendar_server.DATASET_START
+    end = start + datetime.timedelta(7 * (WEEKS - 1))
+
+    if scenario == "list":
+        triage.list_triage_assignments(service, calId)
+    elif scenario == "load":
+        triage.load_triage_assignments(service, calId,
+                                       assignment_lines(start, WEEKS))
+    elif scenario == "load fanOut":
+        fanOut = ["bench%02d@group.calendar.google.com" % i
+                  for i in range(1, FAN_OUT)]
+        triage.load_triage_assignments(service, calId,
+                                       assignment_lines(start, WEEKS), fanOut)
+    elif scenario == "loadRotation":
+        triage.load_rotation(service, calId, rotation_names(),
+                             calendar_server.d2s(start),
+                             calendar_server.d2s(end))
+    elif scenario == "delete ALL":
+        triage.delete_triage_assignments(service, calId,
+                                         calendar_server.d2s(start),
+                                         calendar_server.d2s(end))
+    elif scenario == "generateNextRotation":
+        names = rotation_names()
+        all_triages = triage.get_triage_assignments(service, calId)
+        lastdate = triage.s2d(all_triages[-1]['start'])
+        minDate = lastdate + datetime.timedelta(7)
+        maxDate = minDate + datetime.timedelta(7) * (len(names) - 1)
+        triage.generate_triage_assignments(names, triage.d2s(minDate),
+                                           triage.d2s(maxDate))
+    elif scenario == "watch":
+        watch_cached_list(service, url, calId)
+        watch_renewal(service, url, calId)
+
+def check(ok, what):
+    if not ok:
+        raise AssertionError(what)
+
+def wait_for(condition, what, timeout=WATCH_TIMEOUT):
+    deadline = time.time() + timeout
+    while not condition():
+        check(time.time() < deadline, "timed out waiting for " + what)
+        time.sleep(0.01)
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def start_watch(service, calId, **options):
+    import osgtriage as triage
+
+    port = free_port()
+    # without its "watching" line in the table
+    stderr = sys.stderr
+    sys.stderr = open(os.devnull, 'w')
+    try:
+        return triage.start_watch(service, calId,
+                                  "http://127.0.0.1:%d/" % port, port,
+                                  **options)
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+
+def watch_cached_list(service, url, calId):
+    """
+    list twice while watching, then change the calendar behind triage.py's
+    back; every notification must reach the event cache exactly once
+    """
+    import osgtriage as triage
+
+    before = server_call(url, "/_stats")
+    watch = start_watch(service, calId)
+    cache = triage.event_cache
+    try:
+        wait_for(lambda: cache.generation == 1, '"sync" notification')
+        triage.list_triage_assignments(service, calId)
+        listed = server_call(url, "/_stats")["requests"]
+        triage.list_triage_assignments(service, calId)
+        check(server_call(url, "/_stats")["requests"] == listed,
+              "second list not answered from the event cache")
+
+        # as another operator would, so triage.py doesn't drop it itself
+        for i in range(1, WATCH_CHANGES + 1):
+            start = calendar_server.DATASET_START - datetime.timedelta(7 * i)
+            triage.insert_triage_assignment(service, calId, "Elsewhere",
+                calendar_server.d2s(start),
+                calendar_server.d2s(start + datetime.timedelta(5))).execute()
+        wait_for(lambda: cache.get(calId)[0] is None,
+                 '"exists" notification to drop the event cache')
+        check(len([x for x in triage.list_events(service, calId)
+                   if x['summary'] == "Triage: Elsewhere"]) == WATCH_CHANGES,
+              "changes made elsewhere not listed")
+
+        # duplicates are delivered after the notification they repeat
+        wait_for(lambda: (lambda stats: stats["notifications"] ==
+                                        stats["notifications_queued"])(
+                     server_call(url, "/_stats")),
+                 "all notifications to be delivered")
+        after = server_call(url, "/_stats")
+        distinct = ((after["notifications_queued"] - after["duplicates"]) -
+                    (before["notifications_queued"] - before["duplicates"]))
+        check(cache.generation == distinct,
+              "%d notifications acted on %d times" % (distinct,
+                                                      cache.generation))
+    finally:
+        triage.stop_watch(watch)
+    check(server_call(url, "/_stats")["channels"] == before["channels"],
+          "channel not stopped with the watch")
+
+def watch_renewal(service, url, calId):
+    """
+    watch with a channel that expires in WATCH_TTL, which must be replaced
+    WATCH_RENEW_MARGIN before it does, and the old one stopped
+    """
+    import osgtriage as triage
+
+    before = server_call(url, "/_stats")
+    watch = start_watch(service, calId, ttl=WATCH_TTL,
+                        renew_margin=WATCH_RENEW_MARGIN)
+    channel_watch, _ = watch
+    try:
+        first = channel_watch.channel
+        expiration = int(first.expiration) / 1000.0
+        wait_for(lambda: channel_watch.channel is not first, "renewal",
+                 timeout=expiration - time.time())
+        check(time.time() < expiration, "channel renewed after it expired")
+        # stopped just after its replacement takes over
+        wait_for(lambda: server_call(url, "/_stats")["channels"] ==
+                         before["channels"] + 1, "replaced channel to stop")
+    finally:
+        triage.stop_watch(watch)
+    check(server_call(url, "/_stats")["channels"] == before["channels"],
+          "channel not stopped with the watch")
+
+def worker(url, scenario):
+    """
+    time one scenario in this process; reports a JSON line on the real
+    stdout, with the scenario's own output discarded
+    """
+    service = build_service(url)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        t = time.time()
+        run_scenario(service, url, scenario)
+        wall = time.time() - t
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print json.dumps({"wall": wall, "maxrss_kb": maxrss})
+    return 0
+
+def start_server(flags):
+    """
+    run calendar_server.py on a free port; returns (process, url)
+    """
+    p = subprocess.Popen([sys.executable, "-B",
+                          os.path.join(BENCH_DIR, "calendar_server.py"),
+                          "--port", "0", "--seed", "0",
+                          "--latency", str(flags.latency),
+                          "--jitter", str(flags.jitter),
+                          "--error-rate", str(flags.error_rate),
+                          "--throttle-rate", str(flags.throttle_rate),
+                          "--duplicate-rate", str(flags.duplicate_rate)],
+                         stdout=subprocess.PIPE)
+    url = p.stdout.readline().split()[-1]
+    return p, url
+
+def server_call(url, path, data=None):
+    return json.load(urllib2.urlopen(url + path, data))
+
+def measure(url, size, scenario):
+    server_call(url, "/_reset?events=%d" % size, "")
+    p = subprocess.Popen([sys.executable, "-B", os.path.abspath(__file__),
+                          "--worker", url, scenario],
+                         stdout=subprocess.PIPE, cwd=TOP_DIR)
+    out, _ = p.communicate()
+    if p.returncode != 0:
+        return None
+    result = json.loads(out.strip().split("\n")[-1])
+    stats = server_call(url, "/_stats")
+    result.update(scenario=scenario, events=size,
+                  requests=stats["requests"],
+                  http_requests=stats["http_requests"],
+                  rps=stats["http_requests"] / result["wall"])
+    return result
+
+def main(argv):
+    flags = argparse_setup().parse_args(argv[1:])
+    if flags.worker:
+        return worker(*flags.worker)
+
+    server, url = start_server(flags)
+
+    failed = False
+    if not flags.json:
+        print "%-22s %7s %9s %9s %8s %10s" % (
+            "scenario", "events", "requests", "wall s", "req/s", "peak RSS")
+    try:
+        for scenario in flags.scenario or SCENARIOS:
+            for size in flags.sizes:
+                result = measure(url, size, scenario)
+                if result is None:
+                    print "FAIL: %s at %d events" % (scenario, size)
+                    failed = True
+                elif flags.json:
+                    print json.dumps(result, sort_keys=True)
+                else:
+                    print "%-22s %7d %9d %9.2f %8.1f %7.1f MB" % (
+                        scenario, size, result["requests"], result["wall"],
+                        result["rps"], result["maxrss_kb"] / 1024.0)
+                sys.stdout.flush()
+    finally:
+        server.terminate()
+        server.wait()
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,142 @@
+#!/usr/bin/python -B
+# -*- coding: utf-8 -*-
+
+"""
+Startup budget check for triage.py
+
+Times "triage.py --help", less the time the interpreter takes to start on
+its own, and fails if it has regressed past the recorded baseline.  It also
+fails if any of the modules that are only imported on first use have been
+imported by then.  The modules are compiled first, as the first run of
+triage.py leaves them, so that it is loading them that is timed rather than
+compiling them.  The baseline depends on the machine, so record a new one
+when moving to a different one.
+
+Usage:
+  $ bench/startup.py            # check against startup_baseline.json
+  $ bench/startup.py --record   # record a new baseline
+"""
+
+import sys
+import argparse
+import compileall
+import json
+import os.path
+import subprocess
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+TOP_DIR = os.path.dirname(BENCH_DIR)
+TRIAGE = os.path.join(TOP_DIR, "triage.py")
+BASELINE_FILE = os.path.join(BENCH_DIR, "startup_baseline.json")
+
+# allowed slowdown over the baseline, as a fraction of it
+DEFAULT_TOLERANCE = 0.25
+
+# runs timed for a check, and for recording a baseline, which is taken
+# with more of them so that it's close to the best the machine can do
+CHECK_RUNS = 20
+RECORD_RUNS = 100
+
+# modules that a --help run must not import
+DEFERRED_MODULES = [
+    "email.generator", "email.mime.multipart", "email.mime.nonmultipart",
+    "apiclient.trace", "email.parser", "gzip", "httplib2.socks", "inspect",
+    "mimetypes", "oauth2client.crypt", "uuid", "webbrowser",
+]
+
+# run triage.py --help and report the modules it imported on stderr
+MODULES_SCRIPT = """
+import sys, runpy
+sys.argv = [%r, '--help']
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+except SystemExit:
+    pass
+sys.stderr.write('\\n'.join(sorted(sys.modules)))
+"""
+
+def argparse_setup():
+    ap = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    ap.add_argument('--runs', type=int, default=None, metavar='N',
+        help="time the best of N runs (default: %d, or %d with --record)"
+             % (CHECK_RUNS, RECORD_RUNS))
+
+    ap.add_argument('--record', action='store_true', default=False,
+        help="write the measured time to %s" % BASELINE_FILE)
+
+    return ap
+
+def best_times(commands, runs):
+    """
+    shortest wall time, in seconds, of running each of commands with output
+    discarded; the runs of each take turns, so that they all see the same
+    load on the machine
+    """
+    devnull = open(os.devnull, 'w')
+    times = [[] for args in commands]
+    for i in range(runs):
+        for args, t_args in zip(commands, times):
+            t = time.time()
+            subprocess.call(args, stdout=devnull, stderr=devnull, cwd=TOP_DIR)
+            t_args.append(time.time() - t)
+    devnull.close()
+    return [min(t_args) for t_args in times]
+
+def startup_ms(runs):
+    triage, bare = best_times([[sys.executable, TRIAGE, "--help"],
+                               [sys.executable, "-c", "pass"]], runs)
+    return (triage - bare) * 1000
+
+def imported_modules():
+    p = subprocess.Popen([sys.executable, "-B", "-c", MODULES_SCRIPT % TRIAGE],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         cwd=TOP_DIR)
+    out, err = p.communicate()
+    return set(err.split('\n'))
+
+def load_baseline():
+    if not os.path.exists(BASELINE_FILE):
+        return None
+    return json.load(open(BASELINE_FILE))
+
+def main(argv):
+    flags = argparse_setup().parse_args(argv[1:])
+
+    failed = False
+    early = sorted(set(DEFERRED_MODULES) & imported_modules())
+    if early:
+        print "FAIL: imported by --help: %s" % ", ".join(early)
+        failed = True
+
+    compileall.compile_dir(TOP_DIR, quiet=True)
+    runs = flags.runs or (RECORD_RUNS if flags.record else CHECK_RUNS)
+    ms = startup_ms(runs)
+    if flags.record:
+        baseline = load_baseline() or {"tolerance": DEFAULT_TOLERANCE}
+        baseline["triage_help_ms"] = round(ms, 1)
+        f = open(BASELINE_FILE, "w")
+        json.dump(baseline, f, indent=2, sort_keys=True,
+                  separators=(',', ': '))
+        f.write("\n")
+        f.close()
+        print "recorded %.1f ms" % ms
+        return 1 if failed else 0
+
+    baseline = load_baseline()
+    if baseline is None:
+        print "no baseline in %s; run with --record" % BASELINE_FILE
+        return 1
+    budget = baseline["triage_help_ms"] * (1 + baseline["tolerance"])
+    print "triage.py --help: %.1f ms (baseline %.1f ms, budget %.1f ms)" % (
+        ms, baseline["triage_help_ms"], budget)
+    if ms > budget:
+        print "FAIL: startup is over budget"
+        failed = True
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
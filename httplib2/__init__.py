@@ -30,9 +30,7 @@ import sys
 import email
 import email.Utils
 import email.Message
-import email.FeedParser
 import StringIO
-import gzip
 import zlib
 import httplib
 import urlparse
@@ -44,6 +42,9 @@ import calendar
 import time
 import random
 import errno
+import tempfile
+import threading
+from collections import OrderedDict
 try:
     from hashlib import sha1 as _sha, md5 as _md5
 except ImportError:
@@ -56,13 +57,27 @@ import hmac
 from gettext import gettext as _
 import socket
 
-try:
-    from httplib2 import socks
-except ImportError:
-    try:
-        import socks
-    except (ImportError, AttributeError):
-        socks = None
+# The socks module is only needed for proxied connections, so it is not
+# imported until one is made; see _load_socks().
+socks = None
+_socks_loaded = False
+
+def _load_socks():
+    """Imports the socks module on first use and returns it, or None."""
+    global socks, _socks_loaded
+    if not _socks_loaded:
+        try:
+            # Not "from httplib2 import socks", which would find the
+            # placeholder above instead of the submodule.
+            import importlib
+            socks = importlib.import_module('httplib2.socks')
+        except ImportError:
+            try:
+                import socks
+            except (ImportError, AttributeError):
+                socks = None
+        _socks_loaded = True
+    return socks
 
 # Build the appropriate socket wrapper for ssl
 ssl = None
@@ -131,7 +146,8 @@ __all__ = [
     'RedirectLimit', 'FailedToDecompressContent',
     'UnimplementedDigestAuthOptionError',
     'UnimplementedHmacDigestAuthOptionError',
-    'debuglevel', 'ProxiesUnavailableError']
+    'debuglevel', 'ProxiesUnavailableError', 'StreamingBody',
+    'add_phase_hook', 'remove_phase_hook', 'phase']
 
 
 # The httplib debug level, set to a non-zero value to get debug output
@@ -140,6 +156,9 @@ debuglevel = 0
 # A request will be tried 'RETRIES' times if it fails at the socket/connection level.
 RETRIES = 2
 
+# How many bytes a StreamingBody reads from the connection at a time.
+STREAM_BLOCK_SIZE = 64 * 1024
+
 # Python 2.3 support
 if sys.version_info < (2,4):
     def sorted(seq):
@@ -225,6 +244,86 @@ except ImportError:
 HOP_BY_HOP = ['connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailers', 'transfer-encoding', 'upgrade']
 
 
+# Callables notified as requests go through their phases; see add_phase_hook().
+_phase_hooks = []
+
+def add_phase_hook(hook):
+    """Registers hook(event, name, when, info) to time request phases.
+
+    'event' is "start" or "end", 'name' is the phase, such as "dns",
+    "connect", "tls", "send", "first_byte" or "body", 'when' is time.time()
+    at the event and 'info' is a dict describing it. An "end" whose phase
+    failed has the exception under info['error']. Hooks are called on the
+    thread doing the work and must not raise. The "body" of a streamed
+    response is read by the caller after request() has returned, and ends
+    once it has been read to the end or closed.
+    """
+    if hook not in _phase_hooks:
+        _phase_hooks.append(hook)
+
+def remove_phase_hook(hook):
+    if hook in _phase_hooks:
+        _phase_hooks.remove(hook)
+
+class _Phase(object):
+    """Context manager reporting one phase to the phase hooks."""
+
+    def __init__(self, name, info):
+        self.name = name
+        self.info = info
+
+    def set(self, **info):
+        """Adds to the info reported when the phase ends."""
+        self.info.update(info)
+
+    def _notify(self, event):
+        when = time.time()
+        for hook in list(_phase_hooks):
+            hook(event, self.name, when, self.info)
+
+    def __enter__(self):
+        self._notify("start")
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.info = dict(self.info, error=exc_type.__name__)
+        self._notify("end")
+        return False
+
+class _NullPhase(object):
+    def set(self, **info):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+def phase(name, **info):
+    """Returns a context manager timing phase 'name' for the phase hooks.
+
+    Costs next to nothing while no hooks are registered.
+    """
+    if not _phase_hooks:
+        return _NULL_PHASE
+    return _Phase(name, info)
+
+
+def _body_position(body):
+    """Where a seekable request body starts, to rewind it to before it is
+    sent again; None for a string or unseekable body."""
+    if hasattr(body, 'seek') and hasattr(body, 'tell'):
+        return body.tell()
+    return None
+
+def _rewind(body, position):
+    if position is not None:
+        body.seek(position)
+
 def _get_end2end_headers(response):
     hopbyhop = list(HOP_BY_HOP)
     hopbyhop.extend([x.strip() for x in response.get('connection', '').split(',')])
@@ -434,6 +533,7 @@ def _decompressContent(response, new_content):
         encoding = response.get('content-encoding', None)
         if encoding in ['gzip', 'deflate']:
             if encoding == 'gzip':
+                import gzip
                 content = gzip.GzipFile(fileobj=StringIO.StringIO(new_content)).read()
             if encoding == 'deflate':
                 content = zlib.decompress(content, -zlib.MAX_WBITS)
@@ -447,6 +547,118 @@ def _decompressContent(response, new_content):
     return content
 
 
+class StreamingBody(object):
+    """A response body that is read from the connection as it is consumed.
+
+    Returned in place of the content string by Http.request(..., stream=True).
+    A gzip or deflate encoded body is decompressed a block at a time, so
+    neither the compressed nor the decompressed body is ever held in memory
+    in full. Use read() like a file, or iterate to get blocks of up to
+    STREAM_BLOCK_SIZE bytes.
+
+    Once the body has been read to the end its connection goes back to the
+    Http object's pool. Call close() to abandon a body part way through; the
+    connection is then closed instead.
+    """
+
+    def __init__(self, source, response=None, release=None, host=None):
+        """source is an httplib.HTTPResponse or anything else with a
+        read(amt) method. If response is given and says the body is
+        compressed, the body is decompressed and the response headers are
+        rewritten the same way _decompressContent() does it. release is
+        called once, with True if the body was read to the end and False
+        if it was closed early. If host is given, reading the body from it
+        is reported as a "body" phase, from the first read until then."""
+        self._source = source
+        self._response = response
+        self._release = release
+        self._host = host
+        self._reading = None
+        self._bytes = 0
+        self._checked_out = False
+        self._pending = ""
+        self._eof = False
+        self._decompressor = None
+        encoding = response and response.get('content-encoding', None)
+        if encoding in ['gzip', 'deflate']:
+            if encoding == 'gzip':
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            # The decompressed length isn't known until the end.
+            if 'content-length' in response:
+                del response['content-length']
+            response['-content-encoding'] = response['content-encoding']
+            del response['content-encoding']
+
+    closed = property(lambda self: self._eof, doc="True once the body is finished with.")
+
+    def _read_block(self, amt):
+        if self._reading is None and self._host is not None:
+            self._reading = phase("body", host=self._host)
+            self._reading.__enter__()
+        if self._decompressor is None:
+            data = self._source.read(amt)
+            self._bytes += len(data)
+            if not data:
+                self._finish(True)
+            return data
+        try:
+            raw = self._source.read(STREAM_BLOCK_SIZE)
+            self._bytes += len(raw)
+            if raw:
+                return self._decompressor.decompress(raw)
+            data = self._decompressor.flush()
+        except zlib.error:
+            self.close()
+            raise FailedToDecompressContent(_("Content purported to be compressed with %s but failed to decompress.") % self._response.get('-content-encoding'), self._response, "")
+        self._finish(True)
+        return data
+
+    def read(self, amt=None):
+        """Read up to amt bytes of the body, or the rest of it if amt is
+        None. Returns an empty string at the end of the body."""
+        chunks = [self._pending]
+        have = len(self._pending)
+        while not self._eof and (amt is None or have < amt):
+            if amt is None:
+                data = self._read_block(STREAM_BLOCK_SIZE)
+            else:
+                data = self._read_block(amt - have)
+            chunks.append(data)
+            have += len(data)
+        data = "".join(chunks)
+        if amt is None:
+            self._pending = ""
+            return data
+        self._pending = data[amt:]
+        return data[:amt]
+
+    def __iter__(self):
+        while True:
+            data = self.read(STREAM_BLOCK_SIZE)
+            if not data:
+                break
+            yield data
+
+    def _finish(self, complete):
+        if not self._eof:
+            self._eof = True
+            if self._release is not None:
+                self._release(complete)
+            if self._reading is not None:
+                self._reading.set(bytes=self._bytes, complete=complete)
+                self._reading.__exit__(None, None, None)
+
+    def close(self):
+        """Give up on the rest of the body."""
+        self._pending = ""
+        if not self._eof:
+            if hasattr(self._source, 'close'):
+                self._source.close()
+            self._finish(False)
+
+
 def _updateCache(request_headers, response_headers, content, cache, cachekey):
     if cachekey:
         cc = _parse_cache_control(request_headers)
@@ -454,7 +666,7 @@ def _updateCache(request_headers, response_headers, content, cache, cachekey):
         if 'no-store' in cc or 'no-store' in cc_response:
             cache.delete(cachekey)
         else:
-            info = email.Message.Message()
+            info = {}
             for key, value in response_headers.iteritems():
                 if key not in ['status','content-encoding','transfer-encoding']:
                     info[key] = value
@@ -477,7 +689,9 @@ def _updateCache(request_headers, response_headers, content, cache, cachekey):
 
             status_header = 'status: %d\r\n' % status
 
-            header_str = info.as_string()
+            # Written directly rather than through email.Message, which is
+            # costly on every store. The cache is read back with FeedParser.
+            header_str = "".join(["%s: %s\n" % (key, value) for key, value in info.iteritems()]) + "\n"
 
             header_str = re.sub("\r(?!\n)|(?<!\r)\n", "\r\n", header_str)
             text = "".join([status_header, header_str, content])
@@ -729,7 +943,7 @@ AUTH_SCHEME_ORDER = ["hmacdigest", "googlelogin", "digest", "wsse", "basic"]
 class FileCache(object):
     """Uses a local directory as a store for cached files.
     Not really safe to use if multiple threads or processes are going to
-    be running on the same cache.
+    be running on the same cache. Use BoundedFileCache for that.
     """
     def __init__(self, cache, safe=safename):  # use safe=lambda x: md5.new(x).hexdigest() for the old behavior
         self.cache = cache
@@ -760,6 +974,170 @@ class FileCache(object):
             os.remove(cacheFullPath)
 
 
+class BoundedFileCache(object):
+    """A size-bounded cache in memory in front of a local directory.
+
+    Unlike FileCache this is safe to share between threads and between
+    processes:
+
+    - Entries are written to a temporary file and renamed into place, so a
+      reader never sees a partly written entry.
+    - An index of the directory is kept in memory, so a miss doesn't touch
+      the disk beyond one stat() of the directory. The index is rebuilt
+      when the directory changes under another process.
+    - The most recently used entries, up to max_memory_bytes, are also kept
+      in memory. An entry another process has rewritten or removed is
+      dropped from memory when the index is rebuilt.
+    - The directory is held to max_disk_bytes by removing the least
+      recently used entries.
+
+    Entry filenames are the MD5 of the key, rather than safename(), which
+    is slow to compute on every lookup.
+    """
+    def __init__(self, cache, max_disk_bytes=100 * 1024 * 1024,
+                 max_memory_bytes=10 * 1024 * 1024, safe=None):
+        self.cache = cache
+        self.safe = safe or (lambda key: _md5(key).hexdigest())
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_bytes = max_memory_bytes
+        if not os.path.exists(cache):
+            try:
+                os.makedirs(self.cache)
+            except OSError:
+                # Created by another process in the meantime.
+                if not os.path.isdir(cache):
+                    raise
+        self._lock = threading.RLock()
+        # filename -> (size, mtime), least recently used first.
+        self._index = OrderedDict()
+        self._disk_bytes = 0
+        # filename -> (value, mtime), least recently used first.
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._dir_mtime = None
+
+    def _sync(self):
+        """Rebuild the index if the directory has changed since it was
+        last read."""
+        dir_mtime = os.stat(self.cache).st_mtime
+        if dir_mtime == self._dir_mtime:
+            return
+        entries = []
+        for name in os.listdir(self.cache):
+            if name.startswith('.'):
+                continue  # a temporary file being written
+            try:
+                st = os.stat(os.path.join(self.cache, name))
+            except OSError:
+                continue  # removed in the meantime
+            entries.append((st.st_mtime, name, st.st_size))
+        entries.sort()
+        self._index = OrderedDict()
+        self._disk_bytes = 0
+        for mtime, name, size in entries:
+            self._index[name] = (size, mtime)
+            self._disk_bytes += size
+        for name, (value, mtime) in self._memory.items():
+            if self._index.get(name, (None, None))[1] != mtime:
+                self._forget_memory(name)
+        self._dir_mtime = dir_mtime
+
+    def _touch_dir_mtime(self):
+        # Our own changes to the directory don't need a rescan.
+        self._dir_mtime = os.stat(self.cache).st_mtime
+
+    def _forget_memory(self, name):
+        if name in self._memory:
+            value, mtime = self._memory.pop(name)
+            self._memory_bytes -= len(value)
+
+    def _remember(self, name, value, mtime):
+        self._forget_memory(name)
+        if len(value) > self.max_memory_bytes:
+            return
+        self._memory[name] = (value, mtime)
+        self._memory_bytes += len(value)
+        while self._memory_bytes > self.max_memory_bytes:
+            oldest = next(iter(self._memory))
+            self._forget_memory(oldest)
+
+    def _forget_disk(self, name):
+        if name in self._index:
+            size, mtime = self._index.pop(name)
+            self._disk_bytes -= size
+
+    def _remove(self, name):
+        self._forget_memory(name)
+        self._forget_disk(name)
+        try:
+            os.remove(os.path.join(self.cache, name))
+        except OSError:
+            pass  # already removed by another process
+
+    def get(self, key):
+        name = self.safe(key)
+        with self._lock:
+            self._sync()
+            if name not in self._index:
+                return None
+            entry = self._index.pop(name)
+            self._index[name] = entry
+            if name in self._memory:
+                value, mtime = self._memory.pop(name)
+                self._memory[name] = (value, mtime)
+                return value
+            try:
+                f = open(os.path.join(self.cache, name), "rb")
+                try:
+                    value = f.read()
+                finally:
+                    f.close()
+            except IOError:
+                self._forget_disk(name)
+                return None
+            self._remember(name, value, entry[1])
+            return value
+
+    def set(self, key, value):
+        name = self.safe(key)
+        cacheFullPath = os.path.join(self.cache, name)
+        with self._lock:
+            self._sync()
+            fd, tmp = tempfile.mkstemp(dir=self.cache, prefix='.tmp')
+            try:
+                f = os.fdopen(fd, "wb")
+                try:
+                    f.write(value)
+                finally:
+                    f.close()
+                try:
+                    os.rename(tmp, cacheFullPath)
+                except OSError:
+                    # Windows won't rename over an existing file.
+                    if os.path.exists(cacheFullPath):
+                        os.remove(cacheFullPath)
+                    os.rename(tmp, cacheFullPath)
+            except:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+            mtime = os.stat(cacheFullPath).st_mtime
+            self._forget_disk(name)
+            self._index[name] = (len(value), mtime)
+            self._disk_bytes += len(value)
+            self._remember(name, value, mtime)
+            while self._disk_bytes > self.max_disk_bytes and len(self._index) > 1:
+                self._remove(next(iter(self._index)))
+            self._touch_dir_mtime()
+
+    def delete(self, key):
+        name = self.safe(key)
+        with self._lock:
+            self._sync()
+            self._remove(name)
+            self._touch_dir_mtime()
+
+
 class Credentials(object):
     def __init__(self):
         self.credentials = []
@@ -929,7 +1307,7 @@ class HTTPConnectionWithTimeout(httplib.HTTPConnection):
     def connect(self):
         """Connect to the host and port specified in __init__."""
         # Mostly verbatim from httplib.py.
-        if self.proxy_info and socks is None:
+        if self.proxy_info and _load_socks() is None:
             raise ProxiesUnavailableError(
                 'Proxy support missing but proxy use was requested!')
         msg = "getaddrinfo returns an empty list"
@@ -945,7 +1323,9 @@ class HTTPConnectionWithTimeout(httplib.HTTPConnection):
             host = self.host
             port = self.port
 
-        for res in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+        with phase("dns", host=host):
+            address_info = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        for res in address_info:
             af, socktype, proto, canonname, sa = res
             try:
                 if use_proxy:
@@ -962,10 +1342,11 @@ class HTTPConnectionWithTimeout(httplib.HTTPConnection):
                     print("connect: (%s, %s) ************" % (self.host, self.port))
                     if use_proxy:
                         print("proxy: %s ************" % str((proxy_host, proxy_port, proxy_rdns, proxy_user, proxy_pass, proxy_headers)))
-                if use_proxy:
-                    self.sock.connect((self.host, self.port) + sa[2:])
-                else:
-                    self.sock.connect(sa)
+                with phase("connect", host=self.host):
+                    if use_proxy:
+                        self.sock.connect((self.host, self.port) + sa[2:])
+                    else:
+                        self.sock.connect(sa)
             except socket.error as msg:
                 if self.debuglevel > 0:
                     print("connect fail: (%s, %s)" % (self.host, self.port))
@@ -1059,6 +1440,9 @@ class HTTPSConnectionWithTimeout(httplib.HTTPSConnection):
     def connect(self):
         "Connect to a host on a given (SSL) port."
 
+        if self.proxy_info and _load_socks() is None:
+            raise ProxiesUnavailableError(
+                'Proxy support missing but proxy use was requested!')
         msg = "getaddrinfo returns an empty list"
         if self.proxy_info and self.proxy_info.isgood():
             use_proxy = True
@@ -1072,7 +1456,8 @@ class HTTPSConnectionWithTimeout(httplib.HTTPSConnection):
             host = self.host
             port = self.port
 
-        address_info = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        with phase("dns", host=host):
+            address_info = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
         for family, socktype, proto, canonname, sockaddr in address_info:
             try:
                 if use_proxy:
@@ -1086,14 +1471,16 @@ class HTTPSConnectionWithTimeout(httplib.HTTPSConnection):
                 if has_timeout(self.timeout):
                     sock.settimeout(self.timeout)
 
-                if use_proxy:
-                    sock.connect((self.host, self.port) + sockaddr[:2])
-                else:
-                    sock.connect(sockaddr)
-                self.sock =_ssl_wrap_socket(
-                    sock, self.key_file, self.cert_file,
-                    self.disable_ssl_certificate_validation, self.ca_certs,
-                    self.ssl_version, self.host)
+                with phase("connect", host=self.host):
+                    if use_proxy:
+                        sock.connect((self.host, self.port) + sockaddr[:2])
+                    else:
+                        sock.connect(sockaddr)
+                with phase("tls", host=self.host):
+                    self.sock =_ssl_wrap_socket(
+                        sock, self.key_file, self.cert_file,
+                        self.disable_ssl_certificate_validation, self.ca_certs,
+                        self.ssl_version, self.host)
                 if self.debuglevel > 0:
                     print("connect: (%s, %s)" % (self.host, self.port))
                     if use_proxy:
@@ -1336,15 +1723,19 @@ class Http(object):
         self.credentials.clear()
         self.authorizations = []
 
-    def _conn_request(self, conn, request_uri, method, body, headers):
+    def _conn_request(self, conn, request_uri, method, body, headers, stream=False):
         i = 0
         seen_bad_status_line = False
+        body_start = _body_position(body)
         while i < RETRIES:
             i += 1
+            # A retry sends the whole body again.
+            _rewind(body, body_start)
             try:
                 if hasattr(conn, 'sock') and conn.sock is None:
                     conn.connect()
-                conn.request(method, request_uri, body, headers)
+                with phase("send", method=method, host=conn.host):
+                    conn.request(method, request_uri, body, headers)
             except socket.timeout:
                 raise
             except socket.gaierror:
@@ -1379,7 +1770,9 @@ class Http(object):
                     conn.connect()
                     continue
             try:
-                response = conn.getresponse()
+                with phase("first_byte", host=conn.host) as waiting:
+                    response = conn.getresponse()
+                    waiting.set(status=response.status)
             except httplib.BadStatusLine:
                 # If we get a BadStatusLine on the first try then that means
                 # the connection just went stale, so retry regardless of the
@@ -1405,16 +1798,28 @@ class Http(object):
                 content = ""
                 if method == "HEAD":
                     conn.close()
+                    response = Response(response)
+                elif stream and 200 <= response.status < 300:
+                    # Leave the body on the connection for the caller to read.
+                    # Anything else is small enough to read here, and may be
+                    # needed to follow a redirect or retry authorization.
+                    http_response = response
+                    response = Response(http_response)
+                    content = StreamingBody(
+                        http_response, response,
+                        release=lambda complete: complete or conn.close(),
+                        host=conn.host)
                 else:
-                    content = response.read()
-                response = Response(response)
-                if method != "HEAD":
+                    with phase("body", host=conn.host) as reading:
+                        content = response.read()
+                        reading.set(bytes=len(content))
+                    response = Response(response)
                     content = _decompressContent(response, content)
             break
         return (response, content)
 
 
-    def _request(self, conn, host, absolute_uri, request_uri, method, body, headers, redirections, cachekey):
+    def _request(self, conn, host, absolute_uri, request_uri, method, body, headers, redirections, cachekey, stream=False):
         """Do the actual request using the connection object
         and also follow one level of redirects if necessary"""
 
@@ -1423,18 +1828,23 @@ class Http(object):
         if auth:
             auth.request(method, request_uri, headers, body)
 
-        (response, content) = self._conn_request(conn, request_uri, method, body, headers)
+        body_start = _body_position(body)
+        (response, content) = self._conn_request(conn, request_uri, method, body, headers, stream)
 
         if auth:
             if auth.response(response, body):
+                if isinstance(content, StreamingBody):
+                    content.close()
                 auth.request(method, request_uri, headers, body)
-                (response, content) = self._conn_request(conn, request_uri, method, body, headers )
+                _rewind(body, body_start)
+                (response, content) = self._conn_request(conn, request_uri, method, body, headers, stream)
                 response._stale_digest = 1
 
         if response.status == 401:
             for authorization in self._auth_from_challenge(host, request_uri, headers, response, content):
                 authorization.request(method, request_uri, headers, body)
-                (response, content) = self._conn_request(conn, request_uri, method, body, headers, )
+                _rewind(body, body_start)
+                (response, content) = self._conn_request(conn, request_uri, method, body, headers, stream)
                 if response.status != 401:
                     self.authorizations.append(authorization)
                     authorization.response(response, body)
@@ -1470,17 +1880,18 @@ class Http(object):
                         if 'content-location' not in old_response:
                             old_response['content-location'] = absolute_uri
                         redirect_method = method
+                        _rewind(body, body_start)
                         if response.status in [302, 303]:
                             redirect_method = "GET"
                             body = None
                         (response, content) = self.request(
                             location, method=redirect_method,
                             body=body, headers=headers,
-                            redirections=redirections - 1)
+                            redirections=redirections - 1, stream=stream)
                         response.previous = old_response
                 else:
                     raise RedirectLimit("Redirected more times than rediection_limit allows.", response, content)
-            elif response.status in [200, 203] and method in ["GET", "HEAD"]:
+            elif response.status in [200, 203] and method in ["GET", "HEAD"] and not isinstance(content, StreamingBody):
                 # Don't cache 206's since we aren't going to handle byte range requests
                 if 'content-location' not in response:
                     response['content-location'] = absolute_uri
@@ -1496,7 +1907,7 @@ class Http(object):
 # including all socket.* and httplib.* exceptions.
 
 
-    def request(self, uri, method="GET", body=None, headers=None, redirections=DEFAULT_MAX_REDIRECTS, connection_type=None):
+    def request(self, uri, method="GET", body=None, headers=None, redirections=DEFAULT_MAX_REDIRECTS, connection_type=None, stream=False):
         """ Performs a single HTTP request.
 
         The 'uri' is the URI of the HTTP resource and can begin with either
@@ -1517,7 +1928,22 @@ class Http(object):
         The return value is a tuple of (response, content), the first
         being and instance of the 'Response' class, the second being
         a string that contains the response entity body.
+
+        If 'stream' is True then content is instead a StreamingBody that
+        reads the entity body from the connection as it is consumed. A
+        streamed body is not stored in the cache. The connection is out
+        of the pool until the body has been read to the end or closed.
         """
+        with phase("request", method=method, uri=uri) as requesting:
+            response, content = self._request_with_cache(
+                uri, method, body, headers, redirections, connection_type,
+                stream)
+            requesting.set(status=response.status,
+                           fromcache=response.fromcache)
+            return (response, content)
+
+    def _request_with_cache(self, uri, method, body, headers, redirections,
+                            connection_type, stream):
         try:
             if headers is None:
                 headers = {}
@@ -1535,38 +1961,8 @@ class Http(object):
                 scheme = 'https'
                 authority = domain_port[0]
 
-            proxy_info = self._get_proxy_info(scheme, authority)
-
             conn_key = scheme+":"+authority
-            if conn_key in self.connections:
-                conn = self.connections[conn_key]
-            else:
-                if not connection_type:
-                    connection_type = SCHEME_TO_CONNECTION[scheme]
-                certs = list(self.certificates.iter(authority))
-                if scheme == 'https':
-                    if certs:
-                        conn = self.connections[conn_key] = connection_type(
-                                authority, key_file=certs[0][0],
-                                cert_file=certs[0][1], timeout=self.timeout,
-                                proxy_info=proxy_info,
-                                ca_certs=self.ca_certs,
-                                disable_ssl_certificate_validation=
-                                        self.disable_ssl_certificate_validation,
-                                        ssl_version=self.ssl_version)
-                    else:
-                        conn = self.connections[conn_key] = connection_type(
-                                authority, timeout=self.timeout,
-                                proxy_info=proxy_info,
-                                ca_certs=self.ca_certs,
-                                disable_ssl_certificate_validation=
-                                        self.disable_ssl_certificate_validation,
-                                ssl_version=self.ssl_version)
-                else:
-                    conn = self.connections[conn_key] = connection_type(
-                            authority, timeout=self.timeout,
-                            proxy_info=proxy_info)
-                conn.set_debuglevel(debuglevel)
+            conn = self._get_connection(scheme, authority, connection_type)
 
             if 'range' not in headers and 'accept-encoding' not in headers:
                 headers['accept-encoding'] = 'gzip, deflate'
@@ -1584,7 +1980,8 @@ class Http(object):
                     # bug report: http://mail.python.org/pipermail/python-bugs-list/2005-September/030289.html
                     try:
                         info, content = cached_value.split('\r\n\r\n', 1)
-                        feedparser = email.FeedParser.FeedParser()
+                        from email.FeedParser import FeedParser
+                        feedparser = FeedParser()
                         feedparser.feed(info)
                         info = feedparser.close()
                         feedparser._parse = None
@@ -1622,7 +2019,8 @@ class Http(object):
                         raise RedirectLimit("Redirected more times than rediection_limit allows.", {}, "")
                     (response, new_content) = self.request(
                         info['-x-permanent-redirect-url'], method='GET',
-                        headers=headers, redirections=redirections - 1)
+                        headers=headers, redirections=redirections - 1,
+                        stream=stream)
                     response.previous = Response(info)
                     response.previous.fromcache = True
                 else:
@@ -1643,6 +2041,8 @@ class Http(object):
                         response = Response(info)
                         if cached_value:
                             response.fromcache = True
+                        if stream:
+                            content = StreamingBody(StringIO.StringIO(content))
                         return (response, content)
 
                     if entry_disposition == "STALE":
@@ -1653,7 +2053,7 @@ class Http(object):
                     elif entry_disposition == "TRANSPARENT":
                         pass
 
-                    (response, new_content) = self._request(conn, authority, uri, request_uri, method, body, headers, redirections, cachekey)
+                    (response, new_content) = self._request(conn, authority, uri, request_uri, method, body, headers, redirections, cachekey, stream)
 
                 if response.status == 304 and method == "GET":
                     # Rewrite the cache entry with the new end-to-end headers
@@ -1683,7 +2083,7 @@ class Http(object):
                     response = Response(info)
                     content = ""
                 else:
-                    (response, content) = self._request(conn, authority, uri, request_uri, method, body, headers, redirections, cachekey)
+                    (response, content) = self._request(conn, authority, uri, request_uri, method, body, headers, redirections, cachekey, stream)
         except Exception as e:
             if self.force_exception_to_status_code:
                 if isinstance(e, HttpLib2ErrorWithResponse):
@@ -1710,9 +2110,85 @@ class Http(object):
             else:
                 raise
 
-
+        if stream:
+            if isinstance(content, StreamingBody):
+                self._checkout_connection(conn_key, conn, content)
+            else:
+                content = StreamingBody(StringIO.StringIO(content))
         return (response, content)
 
+    def _get_connection(self, scheme, authority, connection_type=None):
+        """Returns the pooled connection for scheme and authority, creating
+        it, unconnected, if there is none yet."""
+        conn_key = scheme+":"+authority
+        if conn_key in self.connections:
+            return self.connections[conn_key]
+        proxy_info = self._get_proxy_info(scheme, authority)
+        if not connection_type:
+            connection_type = SCHEME_TO_CONNECTION[scheme]
+        certs = list(self.certificates.iter(authority))
+        if scheme == 'https':
+            if certs:
+                conn = self.connections[conn_key] = connection_type(
+                        authority, key_file=certs[0][0],
+                        cert_file=certs[0][1], timeout=self.timeout,
+                        proxy_info=proxy_info,
+                        ca_certs=self.ca_certs,
+                        disable_ssl_certificate_validation=
+                                self.disable_ssl_certificate_validation,
+                                ssl_version=self.ssl_version)
+            else:
+                conn = self.connections[conn_key] = connection_type(
+                        authority, timeout=self.timeout,
+                        proxy_info=proxy_info,
+                        ca_certs=self.ca_certs,
+                        disable_ssl_certificate_validation=
+                                self.disable_ssl_certificate_validation,
+                        ssl_version=self.ssl_version)
+        else:
+            conn = self.connections[conn_key] = connection_type(
+                    authority, timeout=self.timeout,
+                    proxy_info=proxy_info)
+        conn.set_debuglevel(debuglevel)
+        return conn
+
+    def preconnect(self, uri):
+        """Opens the connection a request to 'uri' would use.
+
+        The DNS lookup and the TCP and TLS handshakes are done now, so the
+        next request to the same scheme and authority can be sent straight
+        away. Errors are not raised here; the request that follows will
+        retry the connection and report them.
+        """
+        (scheme, authority, request_uri, defrag_uri) = urlnorm(iri2uri(uri))
+        domain_port = authority.split(":")[0:2]
+        if len(domain_port) == 2 and domain_port[1] == '443' and scheme == 'http':
+            scheme = 'https'
+            authority = domain_port[0]
+        conn = self._get_connection(scheme, authority)
+        if getattr(conn, 'sock', None) is not None:
+            return
+        try:
+            conn.connect()
+        except (socket.error, ssl_SSLError, HttpLib2Error):
+            conn.close()
+
+    def _checkout_connection(self, conn_key, conn, content):
+        """Take conn out of the pool until the streamed content is done."""
+        if content._checked_out or self.connections.get(conn_key) is not conn:
+            # Streamed from another connection after a redirect, which has
+            # checked out its own connection.
+            return
+        content._checked_out = True
+        del self.connections[conn_key]
+
+        def release(complete):
+            if complete and conn_key not in self.connections:
+                self.connections[conn_key] = conn
+            else:
+                conn.close()
+        content._release = release
+
     def _get_proxy_info(self, scheme, authority):
         """Return a ProxyInfo instance (or None) based on the scheme
         and authority.
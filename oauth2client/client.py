@@ -26,7 +26,9 @@ import datetime
 import httplib2
 import logging
 import os
+import re
 import sys
+import threading
 import time
 import urllib
 import urlparse
@@ -37,15 +39,42 @@ from oauth2client import GOOGLE_TOKEN_URI
 from oauth2client import util
 from oauth2client.anyjson import simplejson
 
-HAS_OPENSSL = False
-HAS_CRYPTO = False
-try:
-  from oauth2client import crypt
-  HAS_CRYPTO = True
-  if crypt.OpenSSLVerifier is not None:
-    HAS_OPENSSL = True
-except ImportError:
-  pass
+
+class _CryptoFlag(object):
+  """Whether oauth2client.crypt, or one of its backends, can be imported.
+
+  Importing PyOpenSSL or PyCrypto is slow, so oauth2client.crypt is only
+  imported when one of these flags is first tested, or by the code that
+  signs or verifies.
+  """
+
+  def __init__(self, backend=None):
+    """Constructor.
+
+    Args:
+      backend: string, name of the crypt attribute that is None without the
+        backend, or None for any backend.
+    """
+    self._backend = backend
+    self._value = None
+
+  def __nonzero__(self):
+    if self._value is None:
+      try:
+        from oauth2client import crypt
+      except ImportError:
+        self._value = False
+      else:
+        self._value = (self._backend is None or
+                       getattr(crypt, self._backend) is not None)
+    return self._value
+
+  def __repr__(self):
+    return repr(bool(self))
+
+
+HAS_OPENSSL = _CryptoFlag('OpenSSLVerifier')
+HAS_CRYPTO = _CryptoFlag()
 
 try:
   from urlparse import parse_qsl
@@ -99,6 +128,10 @@ class NonAsciiHeaderError(Error):
   """Header names and values must be ASCII strings."""
 
 
+class CryptoUnavailableError(Error, NotImplementedError):
+  """Neither PyOpenSSL nor PyCrypto is available to sign or verify with."""
+
+
 def _abstract():
   raise NotImplementedError('You need to override this function')
 
@@ -469,7 +502,7 @@ class OAuth2Credentials(Credentials):
     @util.positional(1)
     def new_request(uri, method='GET', body=None, headers=None,
                     redirections=httplib2.DEFAULT_MAX_REDIRECTS,
-                    connection_type=None):
+                    connection_type=None, **kwargs):
       if not self.access_token:
         logger.info('Attempting refresh to obtain initial access_token')
         self._refresh(request_orig)
@@ -486,15 +519,24 @@ class OAuth2Credentials(Credentials):
         else:
           headers['user-agent'] = self.user_agent
 
+      # A streamed body is consumed by sending it, so remember where it
+      # started in case it has to be sent again after a refresh.
+      body_stream_position = None
+      if all(getattr(body, stream_prop, None) for stream_prop in
+             ('read', 'seek', 'tell')):
+        body_stream_position = body.tell()
+
       resp, content = request_orig(uri, method, body, clean_headers(headers),
-                                   redirections, connection_type)
+                                   redirections, connection_type, **kwargs)
 
       if resp.status in REFRESH_STATUS_CODES:
         logger.info('Refreshing due to a %s' % str(resp.status))
         self._refresh(request_orig)
         self.apply(headers)
+        if body_stream_position is not None:
+          body.seek(body_stream_position)
         return request_orig(uri, method, body, clean_headers(headers),
-                            redirections, connection_type)
+                            redirections, connection_type, **kwargs)
       else:
         return (resp, content)
 
@@ -649,20 +691,21 @@ class OAuth2Credentials(Credentials):
     Raises:
       AccessTokenRefreshError: When the refresh fails.
     """
-    if not self.store:
-      self._do_refresh_request(http_request)
-    else:
-      self.store.acquire_lock()
-      try:
-        new_cred = self.store.locked_get()
-        if (new_cred and not new_cred.invalid and
-            new_cred.access_token != self.access_token):
-          logger.info('Updated access_token read from Storage')
-          self._updateFromCredential(new_cred)
-        else:
-          self._do_refresh_request(http_request)
-      finally:
-        self.store.release_lock()
+    with httplib2.phase('refresh'):
+      if not self.store:
+        self._do_refresh_request(http_request)
+      else:
+        self.store.acquire_lock()
+        try:
+          new_cred = self.store.locked_get()
+          if (new_cred and not new_cred.invalid and
+              new_cred.access_token != self.access_token):
+            logger.info('Updated access_token read from Storage')
+            self._updateFromCredential(new_cred)
+          else:
+            self._do_refresh_request(http_request)
+        finally:
+          self.store.release_lock()
 
   def _do_refresh_request(self, http_request):
     """Refresh the access_token using the refresh_token.
@@ -883,135 +926,348 @@ class AssertionCredentials(OAuth2Credentials):
     self._do_revoke(http_request, self.access_token)
 
 
-if HAS_CRYPTO:
-  # PyOpenSSL and PyCrypto are not prerequisites for oauth2client, so if it is
-  # missing then don't create the SignedJwtAssertionCredentials or the
-  # verify_id_token() method.
+# PyOpenSSL and PyCrypto are not prerequisites for oauth2client, so if both
+# are missing, SignedJwtAssertionCredentials and verify_id_token() raise
+# CryptoUnavailableError when used.
+def _require_crypto():
+  if not HAS_CRYPTO:
+    raise CryptoUnavailableError('No crypto library available')
+
 
-  class SignedJwtAssertionCredentials(AssertionCredentials):
-    """Credentials object used for OAuth 2.0 Signed JWT assertion grants.
+class SignedJwtAssertionCredentials(AssertionCredentials):
+  """Credentials object used for OAuth 2.0 Signed JWT assertion grants.
 
-    This credential does not require a flow to instantiate because it represents
-    a two legged flow, and therefore has all of the required information to
-    generate and refresh its own access tokens.
+  This credential does not require a flow to instantiate because it represents
+  a two legged flow, and therefore has all of the required information to
+  generate and refresh its own access tokens.
 
-    SignedJwtAssertionCredentials requires either PyOpenSSL, or PyCrypto 2.6 or
-    later. For App Engine you may also consider using AppAssertionCredentials.
+  SignedJwtAssertionCredentials requires either PyOpenSSL, or PyCrypto 2.6 or
+  later. For App Engine you may also consider using AppAssertionCredentials.
+  """
+
+  MAX_TOKEN_LIFETIME_SECS = 3600 # 1 hour in seconds
+  PRESIGN_LEAD_SECS = 300 # mint the next assertion 5 minutes ahead
+  MIN_PRESIGNED_LIFETIME_SECS = 60 # don't send one that's about to expire
+
+  # The parsed private key and pre-signed assertion are never stored.
+  NON_SERIALIZED_MEMBERS = Credentials.NON_SERIALIZED_MEMBERS + [
+      '_signer', '_presigned']
+
+  @util.positional(4)
+  def __init__(self,
+      service_account_name,
+      private_key,
+      scope,
+      private_key_password='notasecret',
+      user_agent=None,
+      token_uri=GOOGLE_TOKEN_URI,
+      revoke_uri=GOOGLE_REVOKE_URI,
+      presign=False,
+      **kwargs):
+    """Constructor for SignedJwtAssertionCredentials.
+
+    Args:
+      service_account_name: string, id for account, usually an email address.
+      private_key: string, private key in PKCS12 or PEM format.
+      scope: string or iterable of strings, scope(s) of the credentials being
+        requested.
+      private_key_password: string, password for private_key, unused if
+        private_key is in PEM format.
+      user_agent: string, HTTP User-Agent to provide for this application.
+      token_uri: string, URI for token endpoint. For convenience
+        defaults to Google's endpoints but any OAuth 2.0 provider can be used.
+      revoke_uri: string, URI for revoke endpoint.
+      presign: boolean, whether to sign the assertion for each refresh ahead
+        of time, on the first request made in the PRESIGN_LEAD_SECS before
+        the access token expires, so that the refresh is just the token
+        request.
+      kwargs: kwargs, Additional parameters to add to the JWT token, for
+        example sub=joe@xample.org.
+
+    Raises:
+      CryptoUnavailableError if neither PyOpenSSL nor PyCrypto is available.
     """
+    _require_crypto()
 
-    MAX_TOKEN_LIFETIME_SECS = 3600 # 1 hour in seconds
-
-    @util.positional(4)
-    def __init__(self,
-        service_account_name,
-        private_key,
-        scope,
-        private_key_password='notasecret',
-        user_agent=None,
-        token_uri=GOOGLE_TOKEN_URI,
-        revoke_uri=GOOGLE_REVOKE_URI,
-        **kwargs):
-      """Constructor for SignedJwtAssertionCredentials.
-
-      Args:
-        service_account_name: string, id for account, usually an email address.
-        private_key: string, private key in PKCS12 or PEM format.
-        scope: string or iterable of strings, scope(s) of the credentials being
-          requested.
-        private_key_password: string, password for private_key, unused if
-          private_key is in PEM format.
-        user_agent: string, HTTP User-Agent to provide for this application.
-        token_uri: string, URI for token endpoint. For convenience
-          defaults to Google's endpoints but any OAuth 2.0 provider can be used.
-        revoke_uri: string, URI for revoke endpoint.
-        kwargs: kwargs, Additional parameters to add to the JWT token, for
-          example sub=joe@xample.org."""
-
-      super(SignedJwtAssertionCredentials, self).__init__(
-          None,
-          user_agent=user_agent,
-          token_uri=token_uri,
-          revoke_uri=revoke_uri,
-          )
-
-      self.scope = util.scopes_to_string(scope)
-
-      # Keep base64 encoded so it can be stored in JSON.
-      self.private_key = base64.b64encode(private_key)
-
-      self.private_key_password = private_key_password
-      self.service_account_name = service_account_name
-      self.kwargs = kwargs
-
-    @classmethod
-    def from_json(cls, s):
-      data = simplejson.loads(s)
-      retval = SignedJwtAssertionCredentials(
-          data['service_account_name'],
-          base64.b64decode(data['private_key']),
-          data['scope'],
-          private_key_password=data['private_key_password'],
-          user_agent=data['user_agent'],
-          token_uri=data['token_uri'],
-          **data['kwargs']
-          )
-      retval.invalid = data['invalid']
-      retval.access_token = data['access_token']
-      return retval
-
-    def _generate_assertion(self):
-      """Generate the assertion that will be used in the request."""
-      now = long(time.time())
-      payload = {
-          'aud': self.token_uri,
-          'scope': self.scope,
-          'iat': now,
-          'exp': now + SignedJwtAssertionCredentials.MAX_TOKEN_LIFETIME_SECS,
-          'iss': self.service_account_name
-      }
-      payload.update(self.kwargs)
-      logger.debug(str(payload))
+    super(SignedJwtAssertionCredentials, self).__init__(
+        None,
+        user_agent=user_agent,
+        token_uri=token_uri,
+        revoke_uri=revoke_uri,
+        )
 
-      private_key = base64.b64decode(self.private_key)
-      return crypt.make_signed_jwt(crypt.Signer.from_string(
-          private_key, self.private_key_password), payload)
+    self.scope = util.scopes_to_string(scope)
 
-  # Only used in verify_id_token(), which is always calling to the same URI
-  # for the certs.
-  _cached_http = httplib2.Http(MemoryCache())
+    # Keep base64 encoded so it can be stored in JSON.
+    self.private_key = base64.b64encode(private_key)
 
-  @util.positional(2)
-  def verify_id_token(id_token, audience, http=None,
-      cert_uri=ID_TOKEN_VERIFICATON_CERTS):
-    """Verifies a signed JWT id_token.
+    self.private_key_password = private_key_password
+    self.service_account_name = service_account_name
+    self.presign = presign
+    self.kwargs = kwargs
+    self._signer = None
+    self._presigned = None
+
+  @classmethod
+  def from_json(cls, s):
+    data = simplejson.loads(s)
+    retval = SignedJwtAssertionCredentials(
+        data['service_account_name'],
+        base64.b64decode(data['private_key']),
+        data['scope'],
+        private_key_password=data['private_key_password'],
+        user_agent=data['user_agent'],
+        token_uri=data['token_uri'],
+        presign=data.get('presign', False),
+        **data['kwargs']
+        )
+    retval.invalid = data['invalid']
+    retval.access_token = data['access_token']
+    return retval
+
+  def to_json(self):
+    return self._to_json(self.NON_SERIALIZED_MEMBERS)
+
+  def __getstate__(self):
+    """Trim the state down to something that can be pickled."""
+    d = super(SignedJwtAssertionCredentials, self).__getstate__()
+    for member in self.NON_SERIALIZED_MEMBERS:
+      d.pop(member, None)
+    return d
+
+  def __setstate__(self, state):
+    """Reconstitute the state of the object from being pickled."""
+    super(SignedJwtAssertionCredentials, self).__setstate__(state)
+    self._signer = None
+    self._presigned = None
+
+  def _get_signer(self):
+    """The crypt.Signer for the private key, parsed on first use."""
+    signer = getattr(self, '_signer', None)
+    if signer is None:
+      from oauth2client import crypt
+      signer = self._signer = crypt.Signer.from_string(
+          base64.b64decode(self.private_key), self.private_key_password)
+    return signer
+
+  def _claims(self):
+    """The claims of the assertion other than its times."""
+    claims = {
+        'aud': self.token_uri,
+        'scope': self.scope,
+        'iss': self.service_account_name
+    }
+    claims.update(self.kwargs)
+    return claims
+
+  def _sign_assertion(self):
+    """Signs a new assertion; returns it with its claims and expiry."""
+    now = long(time.time())
+    claims = self._claims()
+    payload = {
+        'iat': now,
+        'exp': now + SignedJwtAssertionCredentials.MAX_TOKEN_LIFETIME_SECS,
+    }
+    payload.update(claims)
+    logger.debug(str(payload))
 
-    This function requires PyOpenSSL and because of that it does not work on
-    App Engine.
+    from oauth2client import crypt
+    return (crypt.make_signed_jwt(self._get_signer(), payload), claims,
+            payload['exp'])
+
+  def _generate_assertion(self):
+    """Generate the assertion that will be used in the request."""
+    presigned = getattr(self, '_presigned', None)
+    self._presigned = None
+    if presigned is not None:
+      assertion, claims, exp = presigned
+      if (claims == self._claims() and exp - long(time.time()) >=
+          SignedJwtAssertionCredentials.MIN_PRESIGNED_LIFETIME_SECS):
+        return assertion
+    return self._sign_assertion()[0]
+
+  def presign_assertion(self):
+    """Signs the assertion for the next refresh now.
+
+    The refresh then only has to make the token request, as long as it
+    happens while the assertion is still valid.
+    """
+    self._presigned = self._sign_assertion()
+
+  def apply(self, headers):
+    """Add the authorization to the headers.
+
+    In presign mode, also signs the next assertion if the access token
+    expires within PRESIGN_LEAD_SECS.
+
+    Args:
+      headers: dict, the headers to add the Authorization header to.
+    """
+    super(SignedJwtAssertionCredentials, self).apply(headers)
+    if (self.presign and getattr(self, '_presigned', None) is None and
+        self.token_expiry is not None and
+        self.token_expiry - datetime.datetime.utcnow() <=
+        datetime.timedelta(
+            seconds=SignedJwtAssertionCredentials.PRESIGN_LEAD_SECS)):
+      try:
+        self.presign_assertion()
+      except Exception, e:
+        logger.warning('Failed to pre-sign assertion: %s', e)
+
+
+# Only used in verify_id_token(), which is always calling to the same URI
+# for the certs.
+_cached_http = httplib2.Http(MemoryCache())
+
+
+# Shortest time certs are kept for, even if they were served uncacheable,
+# so that tokens naming unknown keys can't cause a fetch each.
+MIN_CERT_LIFETIME_SECS = 60
+
+
+def _cert_lifetime(resp):
+  """Seconds the certs in a response may be used for, from Cache-Control."""
+  m = re.search(r'max-age=(\d+)', resp.get('cache-control', ''))
+  if m is None:
+    return 0
+  age = resp.get('age', '0')
+  return max(0, int(m.group(1)) - (int(age) if age.isdigit() else 0))
+
+
+class IdTokenVerifier(object):
+  """Verifies signed JWT id_tokens against an issuer's published certs.
+
+  The certs are fetched when first needed, and again once the max-age in
+  the Cache-Control header they were served with has passed, or when a
+  token is signed with a key they don't include. Each token is checked
+  with the key named in its header only.
+
+  IdTokenVerifier requires PyOpenSSL and because of that it does not work
+  on App Engine.
+  """
+
+  @util.positional(1)
+  def __init__(self, http=None, cert_uri=ID_TOKEN_VERIFICATON_CERTS):
+    """Constructor.
+
+    Args:
+      http: httplib2.Http, instance to use to fetch the certs.
+      cert_uri: string, URI of the certificates in JSON format to
+        verify the JWTs against.
+
+    Raises:
+      CryptoUnavailableError if neither PyOpenSSL nor PyCrypto is available.
+    """
+    _require_crypto()
+    self._http = http or httplib2.Http()
+    self._cert_uri = cert_uri
+    self._lock = threading.Lock()
+    self._keyset = None
+    self._fetched = 0
+    self._expires = 0
+
+  def keyset(self, kid=None):
+    """Returns the current crypt.KeySet, fetching new certs if needed.
+
+    Args:
+      kid: string, The key id a token is signed with, or None.
+
+    Raises:
+      VerifyJwtTokenError if the certs can't be fetched.
+    """
+    from oauth2client import crypt
+    with self._lock:
+      now = time.time()
+      if (self._keyset is None or now >= self._expires or
+          (kid is not None and kid not in self._keyset and
+           now >= self._fetched + MIN_CERT_LIFETIME_SECS)):
+        resp, content = self._http.request(self._cert_uri)
+        if resp.status != 200:
+          raise VerifyJwtTokenError('Status code: %d' % resp.status)
+        self._keyset = crypt.KeySet(simplejson.loads(content))
+        self._fetched = now
+        self._expires = now + max(_cert_lifetime(resp),
+                                  MIN_CERT_LIFETIME_SECS)
+      return self._keyset
+
+  def verify(self, id_token, audience):
+    """Verifies a signed JWT id_token.
 
     Args:
       id_token: string, A Signed JWT.
       audience: string, The audience 'aud' that the token should be for.
-      http: httplib2.Http, instance to use to make the HTTP request. Callers
-        should supply an instance that has caching enabled.
-      cert_uri: string, URI of the certificates in JSON format to
-        verify the JWT against.
 
     Returns:
       The deserialized JSON in the JWT.
 
     Raises:
       oauth2client.crypt.AppIdentityError if the JWT fails to verify.
+      VerifyJwtTokenError if the certs can't be fetched.
     """
-    if http is None:
-      http = _cached_http
+    from oauth2client import crypt
+    keyset = self.keyset(crypt._key_id(id_token))
+    return crypt.verify_signed_jwt_with_certs(id_token, keyset, audience)
 
-    resp, content = http.request(cert_uri)
+  def verify_many(self, id_tokens, audience):
+    """Verifies many signed JWT id_tokens against the same certs.
 
-    if resp.status == 200:
-      certs = simplejson.loads(content)
-      return crypt.verify_signed_jwt_with_certs(id_token, certs, audience)
-    else:
-      raise VerifyJwtTokenError('Status code: %d' % resp.status)
+    Args:
+      id_tokens: list of strings, The Signed JWTs.
+      audience: string, The audience 'aud' that the tokens should be for.
+
+    Returns:
+      A list with, for each token in turn, the deserialized JSON in the
+      JWT if it verified, and otherwise the
+      oauth2client.crypt.AppIdentityError it failed with.
+
+    Raises:
+      VerifyJwtTokenError if the certs can't be fetched.
+    """
+    from oauth2client import crypt
+    keyset = self.keyset()
+    unknown = [kid for kid in map(crypt._key_id, id_tokens)
+               if kid is not None and kid not in keyset]
+    if unknown:
+      keyset = self.keyset(unknown[0])
+    return crypt.verify_signed_jwts_with_certs(id_tokens, keyset, audience)
+
+
+# The IdTokenVerifier used by verify_id_token() for each cert_uri.
+_id_token_verifiers = {}
+
+
+@util.positional(2)
+def verify_id_token(id_token, audience, http=None,
+    cert_uri=ID_TOKEN_VERIFICATON_CERTS):
+  """Verifies a signed JWT id_token.
+
+  This function requires PyOpenSSL and because of that it does not work on
+  App Engine.
+
+  Args:
+    id_token: string, A Signed JWT.
+    audience: string, The audience 'aud' that the token should be for.
+    http: httplib2.Http, instance to use to make the HTTP request. Callers
+      should supply an instance that has caching enabled. If None, the
+      certs are kept between calls until their Cache-Control max-age.
+    cert_uri: string, URI of the certificates in JSON format to
+      verify the JWT against.
+
+  Returns:
+    The deserialized JSON in the JWT.
+
+  Raises:
+    oauth2client.crypt.AppIdentityError if the JWT fails to verify.
+    CryptoUnavailableError if neither PyOpenSSL nor PyCrypto is available.
+  """
+  if http is None:
+    verifier = _id_token_verifiers.get(cert_uri)
+    if verifier is None:
+      verifier = _id_token_verifiers.setdefault(
+          cert_uri, IdTokenVerifier(http=_cached_http, cert_uri=cert_uri))
+  else:
+    verifier = IdTokenVerifier(http=http, cert_uri=cert_uri)
+  return verifier.verify(id_token, audience)
 
 
 def _urlsafe_b64decode(b64string):
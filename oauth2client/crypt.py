@@ -16,8 +16,10 @@
 # limitations under the License.
 
 import base64
+import collections
 import hashlib
 import logging
+import threading
 import time
 
 from anyjson import simplejson
@@ -26,6 +28,7 @@ from anyjson import simplejson
 CLOCK_SKEW_SECS = 300  # 5 minutes in seconds
 AUTH_TOKEN_LIFETIME_SECS = 300  # 5 minutes in seconds
 MAX_TOKEN_LIFETIME_SECS = 86400  # 1 day in seconds
+MAX_CACHED_VERIFIERS = 64  # parsed certs kept, for a few rotations of keys
 
 
 logger = logging.getLogger(__name__)
@@ -248,9 +251,12 @@ except ImportError:
 if OpenSSLSigner:
   Signer = OpenSSLSigner
   Verifier = OpenSSLVerifier
+  # What Verifier.from_string() raises for a cert it can't parse.
+  _CERT_PARSE_ERRORS = (crypto.Error, ValueError)
 elif PyCryptoSigner:
   Signer = PyCryptoSigner
   Verifier = PyCryptoVerifier
+  _CERT_PARSE_ERRORS = (ValueError,)
 else:
   raise ImportError('No encryption library found. Please install either '
                     'PyOpenSSL, or PyCrypto 2.6 or later')
@@ -299,6 +305,88 @@ def make_signed_jwt(signer, payload):
   return '.'.join(segments)
 
 
+# Verifiers for the certs seen so far, keyed by fingerprint, least recently
+# used first.
+_verifiers = collections.OrderedDict()
+_verifiers_lock = threading.Lock()
+
+
+def _verifier_for_cert(pem):
+  """Returns a Verifier for an X509 cert in PEM format, parsing it only once.
+
+  Args:
+    pem: string, The X509 cert in PEM format.
+
+  Returns:
+    Verifier instance.
+  """
+  if isinstance(pem, unicode):
+    pem = pem.encode('ascii')
+  fingerprint = hashlib.sha256(pem).digest()
+  with _verifiers_lock:
+    verifier = _verifiers.pop(fingerprint, None)
+    if verifier is not None:
+      _verifiers[fingerprint] = verifier
+      return verifier
+
+  verifier = Verifier.from_string(pem, True)
+  with _verifiers_lock:
+    _verifiers[fingerprint] = verifier
+    while len(_verifiers) > MAX_CACHED_VERIFIERS:
+      _verifiers.popitem(last=False)
+  return verifier
+
+
+class KeySet(object):
+  """Public keys to verify JWTs with, by key id.
+
+  Built from certs such as those Google publishes for id_tokens, a dictionary
+  of key ids to X509 certs in PEM format. Each cert is only parsed once,
+  however many KeySets it is part of. A cert that can't be parsed is left
+  out, with a warning, so that JWTs signed with the others still verify.
+  """
+
+  def __init__(self, certs):
+    """Constructor.
+
+    Args:
+      certs: dict, Dictionary of key ids to public keys in PEM format.
+    """
+    self._verifiers = {}
+    for kid, pem in certs.iteritems():
+      try:
+        self._verifiers[kid] = _verifier_for_cert(pem)
+      except _CERT_PARSE_ERRORS, e:
+        logger.warning('Skipping cert %s, which can\'t be parsed: %s', kid, e)
+
+  def __contains__(self, kid):
+    return kid in self._verifiers
+
+  def verifiers(self, kid):
+    """Returns the verifiers to try for a JWT signed with the key kid.
+
+    Args:
+      kid: string, The key id from the JWT's header, or None.
+
+    Returns:
+      A list of Verifiers: the one for kid if it is known, otherwise all of
+      them.
+    """
+    verifier = self._verifiers.get(kid)
+    if verifier is not None:
+      return [verifier]
+    return self._verifiers.values()
+
+
+def _key_id(jwt):
+  """Returns the key id, 'kid', in the header of a JWT, or None."""
+  try:
+    header = simplejson.loads(_urlsafe_b64decode(jwt.split('.', 1)[0]))
+    return header.get('kid')
+  except Exception:
+    return None
+
+
 def verify_signed_jwt_with_certs(jwt, certs, audience):
   """Verify a JWT against public certs.
 
@@ -306,7 +394,8 @@ def verify_signed_jwt_with_certs(jwt, certs, audience):
 
   Args:
     jwt: string, A JWT.
-    certs: dict, Dictionary where values of public keys in PEM format.
+    certs: dict, Dictionary where values of public keys in PEM format, or a
+      KeySet.
     audience: string, The audience, 'aud', that this JWT should contain. If
       None then the JWT's 'aud' parameter is not verified.
 
@@ -316,6 +405,39 @@ def verify_signed_jwt_with_certs(jwt, certs, audience):
   Raises:
     AppIdentityError if any checks are failed.
   """
+  if not isinstance(certs, KeySet):
+    certs = KeySet(certs)
+  return _verify_signed_jwt(jwt, certs, audience, long(time.time()))
+
+
+def verify_signed_jwts_with_certs(jwts, certs, audience):
+  """Verify many JWTs against the same public certs.
+
+  Args:
+    jwts: iterable of strings, The JWTs.
+    certs: dict, Dictionary where values of public keys in PEM format, or a
+      KeySet.
+    audience: string, The audience, 'aud', that the JWTs should contain. If
+      None then the JWTs' 'aud' parameters are not verified.
+
+  Returns:
+    A list with, for each JWT in turn, the deserialized JSON payload as a
+    dict if it verified, and otherwise the AppIdentityError it failed with.
+  """
+  if not isinstance(certs, KeySet):
+    certs = KeySet(certs)
+  now = long(time.time())
+  results = []
+  for jwt in jwts:
+    try:
+      results.append(_verify_signed_jwt(jwt, certs, audience, now))
+    except AppIdentityError, e:
+      results.append(e)
+  return results
+
+
+def _verify_signed_jwt(jwt, keyset, audience, now):
+  """Verify a JWT against a KeySet at the time now, in seconds."""
   segments = jwt.split('.')
 
   if (len(segments) != 3):
@@ -332,10 +454,9 @@ def verify_signed_jwt_with_certs(jwt, certs, audience):
   except:
     raise AppIdentityError('Can\'t parse token: %s' % json_body)
 
-  # Check signature.
+  # Check signature, with the key named in the header if there is one.
   verified = False
-  for (keyname, pem) in certs.items():
-    verifier = Verifier.from_string(pem, True)
+  for verifier in keyset.verifiers(_key_id(jwt)):
     if (verifier.verify(signed, signature)):
       verified = True
       break
@@ -349,7 +470,6 @@ def verify_signed_jwt_with_certs(jwt, certs, audience):
   earliest = iat - CLOCK_SKEW_SECS
 
   # Check expiration timestamp.
-  now = long(time.time())
   exp = parsed.get('exp')
   if exp is None:
     raise AppIdentityError('No exp field in token: %s' % json_body)
@@ -19,7 +19,6 @@ tools.run_flow() function should be used in its place."""
 import logging
 import socket
 import sys
-import webbrowser
 
 import gflags
 
@@ -119,6 +118,7 @@ def run(flow, storage, http=None):
   authorize_url = flow.step1_get_authorize_url()
 
   if FLAGS.auth_local_webserver:
+    import webbrowser
     webbrowser.open(authorize_url, new=1, autoraise=True)
     print 'Your browser has been opened to visit:'
     print
@@ -30,7 +30,6 @@ import logging
 import os
 import socket
 import sys
-import webbrowser
 
 from oauth2client import client
 from oauth2client import file
@@ -186,6 +185,7 @@ def run_flow(flow, storage, flags, http=None):
   authorize_url = flow.step1_get_authorize_url()
 
   if not flags.noauth_local_webserver:
+    import webbrowser
     webbrowser.open(authorize_url, new=1, autoraise=True)
     print 'Your browser has been opened to visit:'
     print
@@ -27,7 +27,6 @@ __all__ = [
   'POSITIONAL_IGNORE',
 ]
 
-import inspect
 import logging
 import types
 import urllib
@@ -135,6 +134,7 @@ def positional(max_positional_args):
   if isinstance(max_positional_args, (int, long)):
     return positional_decorator
   else:
+    import inspect
     args, _, _, defaults = inspect.getargspec(max_positional_args)
     return positional(len(args) - len(defaults))(max_positional_args)
 
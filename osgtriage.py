@@ -0,0 +1,1362 @@
+# -*- coding: utf-8 -*-
+
+"""
+OSG-Software Google Calendar Triage assignment tool
+
+Usage:
+  $ ./triage.py [ACTION] [OPTIONS]
+
+  Where ACTION can be one of: list, assign, delete, load, loadRotation,
+  generate, generateFrom, generateRotation, generateNextRotation,
+  tagEvents, exportIcs (or export-ics), resume, or serve.
+
+  An ACTION may also be specified with a leading "--" (eg, --list)
+
+Typical Use:
+  $ ./triage.py list | tail
+  $ ./triage.py generateNextRotation > list.txt
+  $ ./triage.py load list.txt
+
+Other Examples:
+  $ ./triage.py list --calendarId primary  # use personal google calendar
+  $ ./triage.py list --minDate 2014-03-01 --maxDate 2014-04-20
+  $ ./triage.py list --assignee "James Kirk"
+  $ ./triage.py assign 2014-07-28 "James Kirk"
+  $ ./triage.py delete 2014-07-28
+  $ ./triage.py delete ALL --minDate 2014-07-01 --maxDate 2014-08-01
+  $ ./triage.py generateNextRotation | ./triage load -
+  $ ./triage.py load list.txt --fanOut primary team@example.com
+  $ ./triage.py loadRotation --extend --cycles 13  # a recurring event each
+  $ ./triage.py resume  # finish an interrupted load, delete, etc
+  $ ./triage.py export-ics /var/www/html/triage.ics  # eg, from cron
+
+Running as a daemon:
+  $ ./triage.py serve &  # keep credentials, service and caches warm
+  $ ./triage.py list     # actions now run in the daemon, if it's up
+
+  $ ./triage.py serve --watch https://example.com/triage-hook &
+                         # also keep the listed events until they change
+
+"""
+
+import sys
+import argparse
+import collections
+import datetime
+import itertools
+import re
+import os
+import os.path
+import functools
+import hashlib
+import json
+import signal
+import socket
+import StringIO
+import threading
+import traceback
+import httplib2
+
+from apiclient           import sample_tools
+from apiclient.errors    import HttpError
+from apiclient.http      import HttpRequest, ETagCache
+from apiclient.http      import RetryPolicy, RateLimiter
+from oauth2client         import tools
+from oauth2client.client import AccessTokenRefreshError
+
+OSG_CAL_ID = "h5t4mns6omp49db1e4qtqrrf4g@group.calendar.google.com"
+ROTATION_FILE = os.path.join(os.path.dirname(__file__), "rotation.txt")
+CACHE_DIR = os.path.join(os.path.dirname(__file__), ".cache")
+SOCKET_PATH = os.path.join(os.path.dirname(__file__), ".triage.sock")
+JOURNAL_FILE = os.path.join(os.path.dirname(__file__), ".journal")
+ICS_FILE = os.path.join(os.path.dirname(__file__), "triage.ics")
+WATCH_PORT = 8090
+
+# private extended properties that triage events are tagged and listed by:
+# TAG_PROPERTY=TAG_VALUE on all of them, and ASSIGNEE_PROPERTY=NAME
+TAG_PROPERTY = "triage"
+TAG_VALUE = "osg"
+ASSIGNEE_PROPERTY = "assignee"
+
+# the parts of the responses used here; the rest isn't sent
+LIST_FIELDS = "items(id,summary,start,recurringEventId),nextPageToken"
+UNTAGGED_FIELDS = "items(id,summary,start,extendedProperties),nextPageToken"
+INSERT_FIELDS = "htmlLink"
+WATCH_FIELDS = "id,resourceId,expiration"
+
+# per-user queries per second allowed by the project's Calendar API quota
+QUOTA_QPS = 5
+# one for all requests, as they all count against it
+QUOTA_LIMITER = RateLimiter(QUOTA_QPS, burst=QUOTA_QPS)
+
+# retry rate limited and failed requests for up to five minutes
+RETRY_POLICY = RetryPolicy(num_retries=8, max_delay=60, deadline=300)
+
+# most requests the Calendar API takes in one batch
+BATCH_SIZE = 50
+
+# exportIcs UIDs are the event ids, in this domain
+ICS_UID_DOMAIN = "triage.opensciencegrid.org"
+
+def argparse_setup():
+    ap = argparse.ArgumentParser(add_help=False)
+
+    ap.add_argument('--calendarId', type=str, default=None, metavar='CALID',
+        help="google calendar id to use.  Default is OSG Software "
+             "calendar.  Use 'primary' for current user's "
+             "calendar, or the google account name (eg, "
+             "user@gmail.com) for another specific calendar.")
+
+    start_mx  = ap.add_mutually_exclusive_group()
+    end_mx    = ap.add_mutually_exclusive_group()
+    action_mx = ap.add_mutually_exclusive_group()
+
+    action_mx.add_argument('--list', action='store_true', default=False,
+        help="list current assignments")
+
+    start_mx.add_argument('--minDate', type=str, default=None, metavar='DATE',
+        help="don't list assignments starting before YYYY-MM[-DD]")
+
+    start_mx.add_argument('--extend', action='store_true', default=False,
+        help="set minDate to start just after the last assignment")
+
+    ap.add_argument('--fanOut', type=str, nargs='+', default=[],
+        metavar='CALID', help="for load and loadRotation, also add the "
+                              "assignments to each of these calendars")
+
+    ap.add_argument('--assignee', type=str, default=None, metavar='NAME',
+        help="only list the assignments of NAME")
+
+    end_mx.add_argument('--maxDate', type=str, default=None, metavar='DATE',
+        help="don't list assignments starting after YYYY-MM[-DD]")
+
+    end_mx.add_argument('--weeks', type=int, default=None, metavar='N',
+        help="set maxDate to limit to N weeks of assignments")
+
+    end_mx.add_argument('--cycles', type=int, default=None, metavar='N',
+        help="set weeks to N * number of names to generate")
+
+#   mx = ap.add_mutually_exclusive_group()
+#   mx.add_argument('--force', action='store_true', default=False,
+#                   help="overwrite existing assignments")
+#   mx.add_argument('--nocheck', action='store_true', default=False,
+#                   help="don't check to see if new assignments"
+#                   " are for the same dates as existing ones")
+
+    action_mx.add_argument('--assign', type=str, nargs=2,
+        metavar=('DATE','NAME'), help="assign name for date")
+
+    action_mx.add_argument('--delete', type=str, default=None, metavar='DATE',
+        help="delete assignment for date, or all assignments in "
+             "minDate-maxDate range if date is \"ALL\"")
+
+    action_mx.add_argument('--load', default=None, type=argparse.FileType('r'),
+        metavar='FILE', # nargs='+',
+        help='load "DATE: NAME" lines from file')
+
+    action_mx.add_argument('--generate', default=None, type=str,
+        metavar='NAME', nargs='*',
+        help='output a list of "DATE: NAME" lines for Mondays in '
+             'minDate-maxDate range')
+
+    action_mx.add_argument('--generateFrom', default=None,
+        type=argparse.FileType('r'), metavar='FILE',
+        help='like generate, but get list of names from FILE')
+
+    action_mx.add_argument('--generateRotation', action='store_true',
+        default=False, help='same as --generateFrom=%s' % ROTATION_FILE)
+
+    action_mx.add_argument('--generateNextRotation', action='store_true',
+        default=False, help='same as --generateRotation --extend --cycles=1')
+
+    action_mx.add_argument('--loadRotation', default=None, type=str,
+        metavar='FILE', nargs='?', const=ROTATION_FILE,
+        help='load the names in FILE (default: %s) as a rotation in the '
+             'minDate-maxDate range, with one recurring event per name' %
+             ROTATION_FILE)
+
+    action_mx.add_argument('--tagEvents', action='store_true', default=False,
+        help='tag the triage events added before they were tagged, so that '
+             'they are listed; only needed once')
+
+    action_mx.add_argument('--exportIcs', '--export-ics', default=None,
+        type=str, metavar='FILE', nargs='?', const=ICS_FILE,
+        help='write the assignments in the minDate-maxDate range to FILE '
+             '(default: %s) as an iCalendar feed, changing only the events '
+             'that changed' % ICS_FILE)
+
+    action_mx.add_argument('--resume', action='store_true', default=False,
+        help='finish the changes that an interrupted load, loadRotation, '
+             'assign or delete left unsent, from --journal')
+
+    action_mx.add_argument('--serve', action='store_true', default=False,
+        help='keep running, and run the actions of later triage.py '
+             'commands, which connect to it through --socket')
+
+    ap.add_argument('--journal', default=JOURNAL_FILE, type=str,
+        metavar='FILE', help='record changes in FILE before sending them, '
+                             'for resume (default: %(default)s)')
+
+    ap.add_argument('--socket', default=SOCKET_PATH, type=str, metavar='PATH',
+        help='unix socket for serve (default: %(default)s)')
+
+    ap.add_argument('--watch', default=None, type=str, metavar='URL',
+        help='for serve, watch the calendar for changes through a webhook '
+             'channel to URL, which must forward to --watchPort, and only '
+             'list its events again after they change')
+
+    ap.add_argument('--watchPort', default=WATCH_PORT, type=int, metavar='N',
+        help='port to receive --watch notifications on (default: '
+             '%(default)s)')
+
+    add_trace_argument(ap)
+
+    return ap
+
+def add_trace_argument(ap):
+    ap.add_argument('--trace', default=None, type=str, metavar='FILE',
+        help='write the timing of each request\'s phases to FILE as JSON '
+             'lines, and a summary to stderr')
+
+def start_trace(argv):
+    """
+    start recording if --trace was given; parsed ahead of the other flags
+    so that startup is traced too
+    """
+    ap = argparse.ArgumentParser(add_help=False)
+    add_trace_argument(ap)
+    trace = ap.parse_known_args(argv[1:])[0].trace
+    if trace is None:
+        return None
+    # not imported at startup, as it's only used here
+    from apiclient.trace import PhaseRecorder
+    recorder = PhaseRecorder(open(trace, "w"))
+    recorder.install()
+    return recorder
+
+def stop_trace(recorder):
+    if recorder is not None:
+        recorder.uninstall()
+        recorder.write_summary(sys.stderr)
+
+def main(argv):
+    # make these globals for interactive use
+    if __name__ != '__main__':
+        global service
+        global flags
+
+    # if first arg is not a flag, interpret as an action
+    if (len(argv) > 1 and not argv[1].startswith("-")):
+        argv[1] = "--" + argv[1]
+
+    # hand the action to a running "triage.py serve", if there is one
+    if "--serve" in argv:
+        if server_running(socket_path(argv)):
+            fail("already serving on %s" % socket_path(argv))
+    else:
+        status = call_server(argv)
+        if status is not None:
+            sys.exit(status)
+
+    # remember the discovery document and listed pages, so unchanged ones
+    # are only revalidated
+    cache = httplib2.BoundedFileCache(CACHE_DIR)
+    service,flags = sample_tools.init(argv,'calendar','v3',__doc__,__file__,
+        parents=[argparse_setup()],
+        requestBuilder=request_builder(ETagCache(cache)),
+        parallel=True, cache=cache)
+
+    if flags.serve:
+        watch = None
+        if flags.watch:
+            watch = start_watch(service, flags.calendarId or OSG_CAL_ID,
+                                flags.watch, flags.watchPort)
+        try:
+            serve(service, flags.socket)
+        finally:
+            if watch:
+                stop_watch(watch)
+    else:
+        run(service, flags)
+
+def request_builder(etag_cache):
+    """
+    the requestBuilder for the service: listed pages are kept in etag_cache,
+    and requests stay under quota and ride out throttling during bulk loads
+    """
+    return functools.partial(HttpRequest, etag_cache=etag_cache,
+                             retry_policy=RETRY_POLICY, limiter=QUOTA_LIMITER)
+
+def run(service, flags):
+    global journal_file
+
+    calId   = flags.calendarId or OSG_CAL_ID
+    minDate = check_date(flags.minDate)
+    maxDate = check_date(flags.maxDate)
+    journal_file = flags.journal
+
+    try:
+        # options
+
+        if flags.generateNextRotation:
+            flags.generateRotation = True
+            flags.extend = True
+            if flags.cycles is None:
+                flags.cycles = 1
+
+        if flags.generateRotation:
+            flags.generateFrom = open(ROTATION_FILE)
+
+        if flags.loadRotation:
+            flags.generateFrom = (sys.stdin if flags.loadRotation == "-"
+                                  else open(flags.loadRotation))
+
+        if flags.generateFrom:
+            flags.generate = [
+                line.strip() for line in flags.generateFrom
+                if  re.search(r'\S', line)      # skip blank lines
+                and re.search(r'^[^#]', line)   # skip comment lines
+            ]
+
+        if flags.cycles is not None:
+            if not flags.generate:
+                fail("For --cycles, must specify one of the generate options "
+                     "with a non-empty list of names.")
+
+            flags.weeks = flags.cycles * len(flags.generate)
+
+        if flags.extend:
+            all_triages = get_triage_assignments(service, calId)
+            if len(all_triages) == 0:
+                fail("No triage assignments found, can't extend.")
+
+            lastdate = s2d(all_triages[-1]['start'])
+            one_week = datetime.timedelta(7)
+            minDate  = d2s(lastdate + one_week)
+
+        if flags.weeks is not None:
+            if not minDate:
+                fail("--weeks requires a minDate")
+
+            one_week = datetime.timedelta(7)
+            maxDate = s2d(minDate) + one_week * (flags.weeks - 1)
+            maxDate = d2s(maxDate)
+
+        # actions
+
+        if flags.resume:
+            resume_operations(service)
+
+        if flags.delete:
+            if flags.delete == "ALL":
+                if minDate and maxDate:
+                    delete_triage_assignments(service, calId, minDate, maxDate)
+                else:
+                    fail("--delete ALL requires --minDate and --maxDate")
+            else:
+                date = check_date(flags.delete)
+                delete_triage_assignment(service, calId, date)
+
+        if flags.assign:
+            date,name = flags.assign
+            date = check_date(date)
+            assign_triage_assignment(service, calId, name, date)
+
+        if flags.load:
+            file_handle = flags.load
+            load_triage_assignments(service, calId, file_handle,
+                                    flags.fanOut)
+
+        if flags.list:
+            list_triage_assignments(service, calId, minDate, maxDate,
+                                    flags.assignee)
+
+        if flags.tagEvents:
+            tag_triage_assignments(service, calId)
+
+        if flags.exportIcs:
+            export_ics(service, calId, flags.exportIcs, minDate, maxDate)
+
+        if flags.loadRotation:
+            if not flags.generate:
+                fail("--loadRotation requires a non-empty list of names")
+            if minDate and maxDate:
+                load_rotation(service, calId, flags.generate, minDate, maxDate,
+                              flags.fanOut)
+            else:
+                fail("--loadRotation requires --minDate and --maxDate")
+
+        elif flags.generate is not None:
+            if minDate and maxDate:
+                names = flags.generate
+                generate_triage_assignments(names, minDate, maxDate)
+            else:
+                fail("--generate requires --minDate and --maxDate")
+
+    except AccessTokenRefreshError:
+        print ("The credentials have been revoked or expired, please re-run "
+               "the application to re-authorize")
+
+def request_parser():
+    """
+    parser for the actions "triage.py serve" runs for its clients
+    """
+    return argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        parents=[tools.argparser, argparse_setup()])
+
+def server_request(argv):
+    """
+    the request call_server() sends for argv, or None if it must run here;
+    the file read by --load, --generateFrom or --loadRotation is sent along
+    with it, as the server can't be relied on to see the same files, and
+    for the same reason --exportIcs runs here
+    """
+    args = argv[1:]
+    stdin = None
+    for i,arg in enumerate(args):
+        opt,eq,val = arg.partition("=")
+        if arg == "--serve" or opt in ("--trace", "--exportIcs",
+                                       "--export-ics"):
+            return None
+        if opt in ("--load", "--generateFrom", "--loadRotation"):
+            if not eq:
+                if i + 1 == len(args):
+                    break
+                val = args[i + 1]
+                if opt == "--loadRotation" and val.startswith("-") \
+                        and val != "-":
+                    break  # the server's own ROTATION_FILE
+            try:
+                f = sys.stdin if val == "-" else open(val)
+                stdin = f.read()
+            except IOError:
+                return None  # let argparse report it
+            if f is sys.stdin:
+                # still there for the action, should it have to run here
+                sys.stdin = StringIO.StringIO(stdin)
+            args = args[:i] + [opt + "=-"] + args[i + 1 + (not eq):]
+            break
+    return {'argv': args, 'stdin': stdin}
+
+def socket_path(argv):
+    path = SOCKET_PATH
+    for i,arg in enumerate(argv):
+        if arg == "--socket" and i + 1 < len(argv):
+            path = argv[i + 1]
+        elif arg.startswith("--socket="):
+            path = arg.partition("=")[2]
+    return path
+
+def connect(path):
+    """
+    connected socket to "triage.py serve" at path, or None if it isn't up
+    """
+    if not os.path.exists(path):
+        return None
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except socket.error:
+        s.close()
+        return None
+    return s
+
+def server_running(path):
+    s = connect(path)
+    if s is not None:
+        s.close()
+    return s is not None
+
+def call_server(argv):
+    """
+    run the action in argv on "triage.py serve", copying its output here;
+    returns its exit status, or None if no server is running
+    """
+    # only read a file or stdin for a server that's actually there
+    s = connect(socket_path(argv))
+    if s is None:
+        return None
+    request = server_request(argv)
+    if request is None:
+        s.close()
+        return None
+    try:
+        s.sendall(json.dumps(request) + "\n")
+    except socket.error:
+        s.close()
+        return None  # it went away; run here, on what was already read
+
+    status = 1
+    out = {1: sys.stdout, 2: sys.stderr}
+    for line in s.makefile('r'):
+        msg = json.loads(line)
+        if 'status' in msg:
+            status = msg['status']
+            break
+        out[msg['fd']].write(msg['data'].encode('utf-8'))
+    s.close()
+    return status
+
+class ClientStream(object):
+    """
+    file-like stand-in for stdout or stderr that writes to a client
+    """
+    def __init__(self, conn, fd):
+        self.conn = conn
+        self.fd = fd
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.decode('utf-8', 'replace')
+        self.conn.sendall(json.dumps({'fd': self.fd, 'data': data}) + "\n")
+
+    def flush(self):
+        pass
+
+# held while an action runs, and by the watch while it renews or stops its
+# channel from its timer thread, as they share the service's http
+service_lock = threading.Lock()
+
+def serve_request(service, parser, conn):
+    """
+    run the action a client sent, with its output going back to it
+    """
+    line = conn.makefile('r').readline()
+    if not line:
+        return  # only checking that we're up
+    try:
+        request = json.loads(line)
+        # as they would come from the command line and files, rather than json
+        argv = [arg.encode('utf-8') for arg in request['argv']]
+    except (ValueError, TypeError, KeyError, AttributeError):
+        ClientStream(conn, 2).write("malformed request\n")
+        conn.sendall(json.dumps({'status': 1}) + "\n")
+        return
+    saved = sys.stdin, sys.stdout, sys.stderr
+    sys.stdin  = StringIO.StringIO((request.get('stdin') or '').encode('utf-8'))
+    sys.stdout = ClientStream(conn, 1)
+    sys.stderr = ClientStream(conn, 2)
+    status = 0
+    try:
+        flags = parser.parse_args(argv)
+        if flags.serve:
+            fail("already serving")
+        with service_lock:
+            run(service, flags)
+    except SystemExit as e:
+        if isinstance(e.code, basestring):
+            warn(e.code)
+        status = e.code if isinstance(e.code, int) else int(bool(e.code))
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        sys.stdin, sys.stdout, sys.stderr = saved
+    conn.sendall(json.dumps({'status': status}) + "\n")
+
+def serve(service, path):
+    """
+    run actions for clients connecting to the unix socket at path, one at
+    a time, with the service, its connections and caches kept between them
+    """
+    if server_running(path):
+        fail("already serving on %s" % path)
+    if os.path.exists(path):
+        os.remove(path)  # left behind by a server that died
+
+    # only this user may act with these credentials
+    umask = os.umask(0o077)
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.bind(path)
+    os.umask(umask)
+    s.listen(5)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    parser = request_parser()
+    warn("serving on %s" % path)
+    try:
+        while True:
+            conn, _ = s.accept()
+            try:
+                serve_request(service, parser, conn)
+            except socket.error:
+                pass  # client went away
+            finally:
+                conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        s.close()
+        os.remove(path)
+
+class EventCache(object):
+    """
+    triage events listed from the watched calendar, kept until they change;
+    they're only used while the watch channel is open, and any notification
+    or change made here drops them
+    """
+    def __init__(self, calId):
+        self.calId = calId
+        self.watch = None
+        self.lock = threading.Lock()
+        self.items = None
+        self.generation = 0
+
+    def get(self, calId):
+        """
+        the cached items for calId, or None, and the generation to pass to
+        set() once they've been listed
+        """
+        with self.lock:
+            fresh = (calId == self.calId and self.watch is not None
+                     and self.watch.active)
+            return (self.items if fresh else None), self.generation
+
+    def set(self, calId, items, generation):
+        with self.lock:
+            # unless they changed while being listed
+            if calId == self.calId and generation == self.generation:
+                self.items = items
+
+    def invalidate(self, calId=None):
+        with self.lock:
+            if calId in (None, self.calId):
+                self.items = None
+                self.generation += 1
+
+# set by start_watch() for serve --watch
+event_cache = None
+
+def start_watch(service, calId, address, port, **options):
+    """
+    open a watch channel on calId, and keep event_cache until notified;
+    options, such as ttl and renew_margin, go to the ChannelWatch
+    """
+    # not imported at startup, as it's only used here
+    from apiclient.channel import NotificationReceiver, ChannelWatch
+    global event_cache
+
+    cache = EventCache(calId)
+    receiver = NotificationReceiver(
+        lambda channel, notification: cache.invalidate(), port=port)
+    receiver.start()
+    watch = ChannelWatch(
+        functools.partial(service.events().watch, calendarId=calId,
+                          fields=WATCH_FIELDS),
+        service.channels().stop, address, receiver=receiver,
+        http_lock=service_lock, **options)
+    try:
+        watch.start()
+    except Exception:
+        receiver.stop()
+        raise
+    cache.watch = watch
+    event_cache = cache
+    warn("watching %s through %s" % (calId, address))
+    return watch, receiver
+
+def stop_watch(watch):
+    global event_cache
+    event_cache = None
+    watch, receiver = watch
+    watch.close()
+    receiver.stop()
+
+def changed(calId):
+    if event_cache is not None:
+        event_cache.invalidate(calId)
+
+class Journal(object):
+    """
+    append-only record of the changes an action makes, one JSON line each:
+    every operation is written before any is sent, and acknowledged once it
+    is done, so that resume can finish the ones left without listing the
+    calendar again
+    """
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+        self.next_op = 0
+
+    def pending(self):
+        """
+        the entries of the operations not yet acknowledged, in order
+        """
+        if not os.path.exists(self.path):
+            return []
+        entries = collections.OrderedDict()
+        for line in open(self.path):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # cut short by a crash while it was written
+            if 'ack' in entry:
+                entries.pop(entry['ack'], None)
+            else:
+                entries[entry['op']] = entry
+                self.next_op = max(self.next_op, entry['op'] + 1)
+        return entries.values()
+
+    def record(self, operations):
+        """
+        journal the (calId, description, request) operations; returns their
+        entries
+        """
+        entries = []
+        for calId, description, request in operations:
+            entries.append({'op': self.next_op, 'calId': calId,
+                            'description': description,
+                            'request': request.to_json()})
+            self.next_op += 1
+        self.write(entries)
+        return entries
+
+    def ack(self, entries):
+        self.write([{'ack': entry['op']} for entry in entries])
+
+    def write(self, entries):
+        if not entries:
+            return
+        if self.f is None:
+            self.f = open(self.path, 'a')
+        self.f.write("".join(json.dumps(entry) + "\n" for entry in entries))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        """
+        close the journal, and remove it if everything in it is done
+        """
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        if os.path.exists(self.path) and not self.pending():
+            os.remove(self.path)
+
+# set by run() from --journal
+journal_file = JOURNAL_FILE
+
+def open_journal():
+    journal = Journal(journal_file)
+    if journal.pending():
+        fail("%s has changes an earlier run didn't finish; "
+             "run \"triage.py resume\" first" % journal_file)
+    return journal
+
+def run_operations(service, calId, operations):
+    """
+    send the (description, request) operations one at a time, with all of
+    them journaled before the first is sent
+    """
+    journal = open_journal()
+    entries = journal.record((calId, description, request)
+                             for description, request in operations)
+    try:
+        for entry, (description, request) in zip(entries, operations):
+            print description
+            try:
+                ret, exception = request.execute(), None
+            except HttpError, e:
+                ret, exception = None, e
+            if not finish_operation(service, entry, ret, exception):
+                raise exception
+            journal.ack([entry])
+    finally:
+        journal.close()
+        if os.path.exists(journal_file):
+            warn("not all changes were made; run \"triage.py resume\" "
+                 "to finish them")
+
+def finish_operation(service, entry, ret, exception):
+    """
+    report how a journaled operation went; true if it is done, as it also
+    is if an earlier attempt at it got as far as the calendar
+    """
+    request = json.loads(entry['request'])
+    if exception is None:
+        pass
+    elif (request['methodId'] == 'calendar.events.insert'
+          and exception.resp.status == 409):
+        # an earlier attempt, or another operator, already added it
+        ret = existing_triage_assignment(service, entry['calId'],
+                                         json.loads(request['body']))
+    elif (request['methodId'] == 'calendar.events.delete'
+          and exception.resp.status in (404, 410)):
+        print "already deleted"
+    else:
+        return False
+    changed(entry['calId'])
+    if ret and 'htmlLink' in ret:
+        print "htmlLink: %s" % ret['htmlLink']
+    return True
+
+def resume_operations(service):
+    """
+    send the operations the journal has left, BATCH_SIZE to a batch request
+    """
+    journal = Journal(journal_file)
+    entries = journal.pending()
+    l = len(entries)
+    if l == 0:
+        print "Nothing to resume."
+        return
+    print "Resuming %d change%s." % (l, "s" * (l != 1))
+
+    requests = [HttpRequest.from_json(entry['request'], service._http,
+                                      service._model.response,
+                                      retry_policy=RETRY_POLICY,
+                                      limiter=QUOTA_LIMITER)
+                for entry in entries]
+    try:
+        send_batches(service, journal, entries, requests)
+    finally:
+        journal.close()
+        if os.path.exists(journal_file):
+            warn("not all changes were made; run \"triage.py resume\" "
+                 "again to retry them")
+
+def send_batches(service, journal, entries, requests):
+    """
+    send the requests of the journaled entries BATCH_SIZE to a batch
+    request, and acknowledge those that are done after each; returns the
+    entries that aren't
+    """
+    done = []
+    failed = []
+
+    def finish(entry, request_id, ret, exception):
+        print entry['description'].encode('utf-8')
+        if finish_operation(service, entry, ret, exception):
+            done.append(entry)
+        else:
+            warn(str(exception))
+            failed.append(entry)
+
+    for i in range(0, len(entries), BATCH_SIZE):
+        batch = service.new_batch_http_request()
+        for entry, request in zip(entries[i:i + BATCH_SIZE],
+                                  requests[i:i + BATCH_SIZE]):
+            batch.add(request, callback=functools.partial(finish, entry))
+        try:
+            batch.execute()
+        finally:
+            journal.ack(done)
+            del done[:]
+    return failed
+
+def fan_out(service, calIds, plan):
+    """
+    make the (description, request) operations plan(calId) returns on each
+    of calIds; for more than one, all of them are journaled first, and sent
+    in batch requests that mix the calendars, all through the service's one
+    authorized connection; every request in a batch counts against the
+    quota, so QUOTA_LIMITER still holds them to QUOTA_QPS, and a year of
+    weekly assignments on 20 calendars takes over 1040 / 5 = 208 seconds
+    """
+    if len(calIds) == 1:
+        return run_operations(service, calIds[0], plan(calIds[0]))
+
+    plans = [plan(calId) for calId in calIds]
+    # the same operation on each calendar in turn, so that every batch
+    # request spreads across them
+    operations = []
+    for ops in itertools.izip_longest(*plans):
+        for calId, op in zip(calIds, ops):
+            if op is not None:
+                description, request = op
+                operations.append((calId, "%s: %s" % (calId, description),
+                                   request))
+    journal = open_journal()
+    entries = journal.record(operations)
+    try:
+        failed = send_batches(service, journal, entries,
+                              [request for _, _, request in operations])
+        print "Changes made:"
+        for calId, ops in zip(calIds, plans):
+            l = len(ops) - sum(1 for x in failed if x['calId'] == calId)
+            print "%s: %d of %d" % (calId, l, len(ops))
+    finally:
+        journal.close()
+        if os.path.exists(journal_file):
+            warn("not all changes were made; run \"triage.py resume\" "
+                 "to finish them")
+
+def generate_triage_assignments(names, minDate, maxDate):
+    if len(names) == 0:
+        names = ['']
+
+    date = s2d(minDate)
+    end  = s2d(maxDate)
+
+    one_day  = datetime.timedelta(1)
+    one_week = datetime.timedelta(7)
+
+    while date.isoweekday() != 1:
+        date += one_day
+
+    for name in itertools.cycle(names):
+        if date > end:
+            break
+        print "%s: %s" % (d2s(date), name)
+        date += one_week
+
+
+def load_triage_assignments(service, calId, file_handle, fanOut=()):
+    """
+    add the "DATE: NAME" assignments in file_handle to calId, and to each
+    calendar in fanOut
+    """
+    weeks = []
+    for line in file_handle:
+        if re.search(r'^\s*$', line):
+            continue
+        m = re.search(r'^\s*(20\d{2}-\d{1,2}-\d{1,2}):\s*(.*\S)\s*$', line)
+        if m is None:
+            warn("skipping line: '%s'" % line.rstrip("\n"))
+        else:
+            date,name = m.groups()
+            date = check_date(date)
+            if is_monday(date):
+                weeks.append((name, date))
+
+    fan_out(service, targets(calId, fanOut), lambda cal:
+            [insert_triage_assignment_1w(service, cal, name, date)
+             for name, date in weeks])
+
+def targets(calId, fanOut):
+    return [calId] + [x for x in collections.OrderedDict.fromkeys(fanOut)
+                      if x != calId]
+
+def load_rotation(service, calId, names, minDate, maxDate, fanOut=()):
+    """
+    add the rotation of names for the Mondays in minDate-maxDate as one
+    event per name, repeating every len(names) weeks, to calId and to each
+    calendar in fanOut
+    """
+    date = s2d(minDate)
+    end  = s2d(maxDate)
+
+    one_day  = datetime.timedelta(1)
+    one_week = datetime.timedelta(7)
+
+    while date.isoweekday() != 1:
+        date += one_day
+
+    rrule = "RRULE:FREQ=WEEKLY;INTERVAL=%d;UNTIL=%s" % (
+        len(names), end.strftime("%Y%m%d"))
+    starts = []
+    for name in names:
+        if date > end:
+            break
+        starts.append((name, date))
+        date += one_week
+
+    fan_out(service, targets(calId, fanOut), lambda cal: [(
+        "adding rotation: %s: %s, every %d week%s" % (
+            d2s(date), name, len(names), "s" * (len(names) != 1)),
+        insert_triage_assignment(service, cal, name, d2s(date),
+                                 d2s(date + datetime.timedelta(5)),
+                                 recurrence=[rrule]))
+        for name, date in starts])
+
+def event_id(calId, start, kind="week"):
+    """
+    the id of the triage event of the given kind ("week" or "rotation")
+    starting on start, the same every time it is added; hex digits are
+    valid in the base32hex event ids the Calendar API allows
+    """
+    key = "%s\0%s\0%s" % (calId, kind, start)
+    return "triage" + hashlib.sha1(key).hexdigest()
+
+def insert_triage_assignment(service, calId, name, start, end,
+                             recurrence=None):
+    """
+    the request adding the assignment
+    """
+    event = {
+        'id':      event_id(calId, start, "rotation" if recurrence else "week"),
+        'summary': "Triage: " + name,
+        'start':   {'date': start},
+        'end':     {'date': end},
+        'transparency': 'transparent',  # ie, show as available
+        'extendedProperties': triage_properties(name)
+    }
+    if recurrence:
+        event['recurrence'] = recurrence
+
+    return service.events().insert(calendarId=calId, body=event,
+                                   fields=INSERT_FIELDS)
+
+def existing_triage_assignment(service, calId, event):
+    """
+    the event already added under the id of event; one since deleted keeps
+    its id, so it is restored as event instead
+    """
+    events = service.events()
+    old = events.get(calendarId=calId, eventId=event['id'],
+                     fields="status,summary,htmlLink").execute()
+    if old['status'] == 'cancelled':
+        print "restoring deleted assignment"
+        return events.update(calendarId=calId, eventId=event['id'],
+                             body=dict(event, status='confirmed'),
+                             fields=INSERT_FIELDS).execute()
+    if old.get('summary') == event['summary']:
+        print "already present"
+    else:
+        warn("%s is already assigned: %s" % (event['start']['date'],
+                                              old.get('summary')))
+    return old
+
+def triage_properties(name):
+    return {'private': {TAG_PROPERTY: TAG_VALUE, ASSIGNEE_PROPERTY: name}}
+
+def is_monday(start):
+    if s2d(start).isoweekday() != 1:
+        warn("%s is not a Monday, skipping..." % start)
+        return False
+    return True
+
+def insert_triage_assignment_1w(service, calId, name, start):
+    """
+    the operation adding name for the week of start, a Monday
+    """
+    td = datetime.timedelta(5)  # Mon-Fri
+    end = d2s(s2d(start) + td)
+    return ("adding assignment: %s: %s" % (start,name),
+            insert_triage_assignment(service, calId, name, start, end))
+
+def assign_triage_assignment(service, calId, name, date):
+    """
+    assign name for the week of date; a week already assigned is changed in
+    place, and one of a rotation loaded with loadRotation on its own, as an
+    exception to the series
+    """
+    for item in get_triage_assignments(service, calId, date, date):
+        operation = (
+            "reassigning: %s: %s -> %s" % (date, item['summary'], name),
+            service.events().patch(calendarId=calId, eventId=item['id'],
+                                   body={'summary': "Triage: " + name,
+                                         'extendedProperties':
+                                             triage_properties(name)},
+                                   fields=INSERT_FIELDS))
+        break
+    else:
+        if not is_monday(date):
+            return
+        operation = insert_triage_assignment_1w(service, calId, name, date)
+    run_operations(service, calId, [operation])
+
+def warn(msg):
+    sys.stderr.write(msg + "\n")
+
+def fail(msg):
+    warn(msg)
+    sys.exit(1)
+
+def s2d(s):
+    m = re.search(r'^20\d\d-\d+$', s)
+    datefmt = "%Y-%m" if m else "%Y-%m-%d"
+    return datetime.datetime.strptime(s, datefmt)
+
+def d2s(d):
+    return d.strftime("%Y-%m-%d")
+
+def check_date(s):
+    if s is not None:
+        try:
+            return d2s(s2d(s))
+        except ValueError:
+            fail("malformed date string: '%s'" % s)
+
+def delete_triage_assignment(service, calId, date):
+    delete_triage_assignments(service, calId, date, date)
+
+def delete_triage_assignments(service, calId, minStart, maxStart):
+    items = list_events(service, calId)
+    triage = select_triage_assignments(items, minStart, maxStart)
+    l = len(triage)
+    print "Found %d event%s to delete in time window." % (l, "s" * (l != 1))
+
+    # a rotation series with all of its weeks in the window is deleted in
+    # one request, and one with all of its later weeks in it is ended before
+    # the window; weeks of any other are deleted as exceptions
+    def series_weeks(assignments):
+        return collections.Counter(x['recurringEventId'] for x in assignments
+                                   if x['recurringEventId'])
+    in_window = series_weeks(triage)
+    in_all = series_weeks(select_triage_assignments(items))
+    after = series_weeks(select_triage_assignments(items,
+        d2s(s2d(check_date(maxStart)) + datetime.timedelta(1))))
+    whole = set(x for x in in_window if in_window[x] == in_all[x])
+    tail = set(x for x in in_window if x not in whole and after[x] == 0)
+
+    requests = {}
+    lines = collections.OrderedDict()
+    for item in triage:
+        series = item['recurringEventId']
+        key = series if series in whole or series in tail else item['id']
+        if key in tail and key not in requests:
+            requests[key] = end_series(service, calId, series, item['start'])
+        elif key not in requests:
+            requests[key] = service.events().delete(calendarId=calId,
+                                                    eventId=key)
+        lines.setdefault(key, []).append("Deleting assignment: %s: %s" % (
+            item['start'], item['summary']))
+
+    run_operations(service, calId, [("\n".join(lines[key]), requests[key])
+                                    for key in lines])
+
+def end_series(service, calId, series, date):
+    """
+    the request ending a rotation series before the week of date
+    """
+    ret = service.events().get(calendarId=calId, eventId=series,
+                               fields="recurrence").execute()
+    until = (s2d(date) - datetime.timedelta(1)).strftime("%Y%m%d")
+    recurrence = []
+    for rule in ret.get('recurrence', []):
+        if rule.startswith("RRULE:"):
+            parts = [x for x in rule[len("RRULE:"):].split(";")
+                     if not re.match(r'^(UNTIL|COUNT)=', x)]
+            rule = "RRULE:" + ";".join(parts + ["UNTIL=" + until])
+        recurrence.append(rule)
+    return service.events().patch(calendarId=calId, eventId=series,
+                                  body={'recurrence': recurrence},
+                                  fields="id")
+
+def istriage(item):
+    return re.search('^Triage:', item.get('summary', ''))
+
+def list_events(service, calId, assignee=None):
+    """
+    triage events, or only those of assignee, with only the fields used
+    here, from event_cache if it has them; they're selected by their tags,
+    so no other events are sent, and list pages are decoded as they're read
+    """
+    cache = event_cache
+    if cache is not None:
+        items,generation = cache.get(calId)
+        if items is not None:
+            return [x for x in items if assignee is None
+                    or x['summary'] == "Triage: " + assignee]
+
+    tags = ["%s=%s" % (TAG_PROPERTY, TAG_VALUE)]
+    if assignee is not None:
+        tags.append("%s=%s" % (ASSIGNEE_PROPERTY, assignee))
+    # with each week of a rotation series as an event of its own
+    l = service.events().list(calendarId=calId, privateExtendedProperty=tags,
+                              maxResults=2500, singleEvents=True,
+                              fields=LIST_FIELDS)
+    items = []
+    while l is not None:
+        ret = l.execute(stream=True)
+        items.extend({'id'      : x['id'],
+                      'summary' : x['summary'],
+                      'start'   : x['start'],
+                      'recurringEventId' : x.get('recurringEventId')}
+                     for x in ret)
+        l = service.events().list_next(l, ret)
+
+    if cache is not None and assignee is None:
+        cache.set(calId, items, generation)
+    return items
+
+def tag_triage_assignments(service, calId):
+    """
+    tag the triage events added before they were tagged, found as they used
+    to be, by searching for "Triage", BATCH_SIZE to a batch request; a
+    rotation series is tagged along with all of its weeks
+    """
+    l = service.events().list(calendarId=calId, q="Triage", maxResults=2500,
+                              fields=UNTAGGED_FIELDS)
+    untagged = []
+    while l is not None:
+        ret = l.execute(stream=True)
+        untagged.extend(x for x in ret if istriage(x) and
+            x.get('extendedProperties', {}).get('private', {})
+             .get(TAG_PROPERTY) != TAG_VALUE)
+        l = service.events().list_next(l, ret)
+    l = len(untagged)
+    print "Found %d event%s to tag." % (l, "s" * (l != 1))
+
+    def tagged(request_id, ret, exception):
+        if exception is not None:
+            warn("not tagged: %s; run tagEvents again to retry" % exception)
+    for i in range(0, l, BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=tagged)
+        for x in untagged[i:i + BATCH_SIZE]:
+            name = re.sub('^Triage: *', '', x['summary'])
+            print ("Tagging assignment: %s: %s" % (
+                x['start'].get('date'), name)).encode('utf-8')
+            batch.add(service.events().patch(calendarId=calId,
+                eventId=x['id'], body={'extendedProperties':
+                                       triage_properties(name)},
+                fields="id"))
+        batch.execute()
+    if l:
+        changed(calId)
+
+def get_triage_assignments(service, calId, minStart=None, maxStart=None,
+                           assignee=None):
+    return select_triage_assignments(list_events(service, calId, assignee),
+                                     minStart, maxStart)
+
+def select_triage_assignments(items, minStart=None, maxStart=None):
+    def xfilters(filters,seq):
+        """
+        like filter(), but return items for which each filter returns true
+        """
+        for x in seq:
+            for f in filters:
+                if not f(x):
+                    break
+            else:
+                yield x
+
+    def date_or_datetime(t):
+        return t.get('date') or t.get('dateTime')
+
+    def timefield(key):
+        return lambda item : date_or_datetime(item[key])
+
+    def start_ge(date):
+        return lambda item : date_or_datetime(item['start']) >= date
+
+    def start_le(date):
+        return lambda item : date_or_datetime(item['start']) <= date
+
+    filters = []
+    if minStart is not None:
+        filters.append(start_ge(check_date(minStart)))
+
+    if maxStart is not None:
+        filters.append(start_le(check_date(maxStart)))
+
+    triage = sorted(xfilters(filters,items),key=timefield('start'))
+
+    triage = [ {'start'   : x['start'].get('date'),
+                'summary' : re.sub('^Triage: *', '', x['summary']),
+                'id'      : x['id'],
+                'recurringEventId' : x['recurringEventId']} for x in triage ]
+
+    return triage
+
+def list_triage_assignments(service, calId, minStart=None, maxStart=None,
+                            assignee=None):
+    triage = get_triage_assignments(service, calId, minStart, maxStart,
+                                    assignee)
+
+    print "Triage:"
+    for x in triage:
+        print ("%s: %s" % (x['start'], x['summary'])).encode('utf-8')
+
+def ics_escape(text):
+    return re.sub(r'([\\;,])', r'\\\1', text).replace("\n", "\\n")
+
+def ics_fold(line):
+    """
+    a content line folded into lines of at most 75 octets, as RFC 5545 asks,
+    without splitting a UTF-8 character
+    """
+    out = []
+    while len(line) > 75:
+        cut = 75 if not out else 74
+        while ord(line[cut]) & 0xC0 == 0x80:
+            cut -= 1
+        out.append(line[:cut])
+        line = " " + line[cut:]
+    out.append(line)
+    return "\r\n".join(out)
+
+def ics_event(item):
+    """
+    the VEVENT lines for an item of get_triage_assignments, apart from its
+    DTSTAMP and SEQUENCE, unfolded
+    """
+    start = s2d(item['start'])
+    end = start + datetime.timedelta(5)  # Mon-Fri
+    summary = "Triage: " + item['summary']
+    return [line.encode('utf-8') for line in [
+        u"UID:%s@%s" % (item['id'], ICS_UID_DOMAIN),
+        u"DTSTART;VALUE=DATE:%s" % start.strftime("%Y%m%d"),
+        u"DTEND;VALUE=DATE:%s" % end.strftime("%Y%m%d"),
+        u"SUMMARY:%s" % ics_escape(summary),
+        u"TRANSP:TRANSPARENT",
+    ]]
+
+def read_ics_events(path):
+    """
+    the VEVENTs of an exportIcs file, as {uid line: unfolded lines}
+    """
+    events = {}
+    if not os.path.exists(path):
+        return events
+    event = None
+    for line in open(path).read().replace("\r\n ", "").split("\r\n"):
+        if line == "BEGIN:VEVENT":
+            event = []
+        elif line == "END:VEVENT" and event is not None:
+            uid = [x for x in event if x.startswith("UID:")]
+            if uid:
+                events[uid[0]] = event
+            event = None
+        elif event is not None:
+            event.append(line)
+    return events
+
+def export_ics(service, calId, path, minStart=None, maxStart=None):
+    """
+    write the assignments to path as an iCalendar file, replacing it
+    atomically, and only if they changed; events that didn't keep what they
+    had, DTSTAMP included, and changed ones get a new DTSTAMP and SEQUENCE
+    """
+    old = read_ics_events(path)
+    stamp = "DTSTAMP:" + datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+
+    events = []
+    added = updated = 0
+    for item in get_triage_assignments(service, calId, minStart, maxStart):
+        lines = ics_event(item)
+        prev = old.pop(lines[0], None)
+        if prev is None:
+            added += 1
+            lines[1:1] = [stamp, "SEQUENCE:0"]
+        elif [x for x in prev if not re.match('(DTSTAMP|SEQUENCE):', x)] \
+                == lines:
+            lines = prev
+        else:
+            updated += 1
+            sequence = [int(x[len("SEQUENCE:"):]) for x in prev
+                        if re.match(r'SEQUENCE:\d+$', x)]
+            lines[1:1] = [stamp, "SEQUENCE:%d" % (max(sequence or [0]) + 1)]
+        events.append(lines)
+    removed = len(old)
+
+    l = len(events)
+    print "Exported %d assignment%s to %s: %d added, %d changed, %d " \
+          "removed." % (l, "s" * (l != 1), path, added, updated, removed)
+    if added == updated == removed == 0 and os.path.exists(path):
+        return  # unchanged, so its readers' cached copies stay good
+
+    content = ["BEGIN:VCALENDAR",
+               "VERSION:2.0",
+               "PRODID:-//OSG Software//triage.py//EN",
+               "CALSCALE:GREGORIAN",
+               "X-WR-CALNAME:OSG Software Triage"]
+    for lines in events:
+        content += ["BEGIN:VEVENT"] + map(ics_fold, lines) + ["END:VEVENT"]
+    content.append("END:VCALENDAR")
+
+    # readers see the old file or the new one, never part of one
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        f = open(tmp, "w")
+        f.write("\r\n".join(content) + "\r\n")
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)